@@ -0,0 +1,229 @@
+"""Admission control in front of upstream Gemini calls.
+
+Two layers, both keyed by the chat `user_id`:
+
+- a per-user token bucket, so one client cannot monopolise the LLM, and
+- a global concurrency limit with a fair queue: waiting requests are
+  granted slots round-robin across users, not first-come-first-served.
+
+When the estimated queue wait exceeds the latency SLO (or the wait times
+out), the request is shed and the caller answers from the local engine
+instead. Works for threaded (Flask) and asyncio (ASGI) callers.
+"""
+import asyncio
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+import metrics
+
+ADMITTED = 'admitted'
+RATE_LIMITED = 'rate_limited'
+QUEUE_SLO = 'queue_slo'
+
+
+class TokenBucketLimiter:
+    """Per-user token buckets: `rate` tokens/second, up to `burst` stored."""
+
+    def __init__(self, rate, burst, max_users=10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_users = max_users
+        self._buckets = {}  # user_id -> [tokens, last_refill]
+        self._lock = threading.Lock()
+
+    def allow(self, user_id, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            bucket = self._buckets.get(user_id)
+            if bucket is None:
+                if len(self._buckets) >= self.max_users:
+                    self._prune(now)
+                bucket = self._buckets[user_id] = [float(self.burst), now]
+            tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if tokens >= 1.0:
+                bucket[0] = tokens - 1.0
+                return True
+            bucket[0] = tokens
+            return False
+
+    def _prune(self, now):
+        # Buckets that have refilled completely carry no state worth keeping
+        full_after = self.burst / self.rate if self.rate else float('inf')
+        for user_id in [u for u, (_, last) in self._buckets.items() if now - last >= full_after]:
+            del self._buckets[user_id]
+
+
+class _Waiter:
+    __slots__ = ('wake', 'granted')
+
+    def __init__(self, wake):
+        self.wake = wake
+        self.granted = False
+
+
+class FairGate:
+    """Global concurrency limit with per-user round-robin queueing.
+
+    Expected wait is estimated from the queue length and an EWMA of recent
+    service times; requests that would wait longer than `slo` seconds are
+    refused up front, and queued requests give up after `slo` seconds.
+    """
+
+    def __init__(self, limit, slo, initial_service_time=0.5):
+        self.limit = limit
+        self.slo = slo
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._queued = 0
+        self._queues = OrderedDict()  # user_id -> deque[_Waiter]; order is the round-robin ring
+        self._service_time = initial_service_time
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    @property
+    def queued(self):
+        return self._queued
+
+    def estimated_wait(self):
+        return (self._queued + 1) / float(self.limit) * self._service_time
+
+    def _enter(self, user_id, waiter):
+        """Admit, queue or shed; caller holds the lock."""
+        if self._in_flight < self.limit and not self._queued:
+            self._in_flight += 1
+            return ADMITTED
+        if self.estimated_wait() > self.slo:
+            return QUEUE_SLO
+        self._queues.setdefault(user_id, deque()).append(waiter)
+        self._queued += 1
+        return None
+
+    def _abandon(self, user_id, waiter):
+        """Resolve a timed-out waiter; caller holds the lock. True if it got a slot anyway."""
+        if waiter.granted:
+            return True
+        queue = self._queues.get(user_id)
+        if queue is not None:
+            try:
+                queue.remove(waiter)
+                self._queued -= 1
+            except ValueError:
+                pass
+            if not queue:
+                del self._queues[user_id]
+        return False
+
+    def acquire(self, user_id):
+        """Block until a slot is free; returns ADMITTED or QUEUE_SLO."""
+        event = threading.Event()
+        waiter = _Waiter(event.set)
+        with self._lock:
+            state = self._enter(user_id, waiter)
+        if state is not None:
+            return state
+        event.wait(self.slo)
+        with self._lock:
+            return ADMITTED if self._abandon(user_id, waiter) else QUEUE_SLO
+
+    async def acquire_async(self, user_id):
+        """Asyncio flavour of `acquire()` that waits without holding a thread."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(True))
+
+        waiter = _Waiter(wake)
+        with self._lock:
+            state = self._enter(user_id, waiter)
+        if state is not None:
+            return state
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.slo)
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            # The request went away: leave the queue, or hand back a slot granted meanwhile
+            with self._lock:
+                granted = self._abandon(user_id, waiter)
+            if granted:
+                self.release()
+            raise
+        with self._lock:
+            return ADMITTED if self._abandon(user_id, waiter) else QUEUE_SLO
+
+    def release(self, service_time=None):
+        """Free a slot, handing it straight to the next user in the ring."""
+        with self._lock:
+            if service_time is not None:
+                self._service_time = 0.8 * self._service_time + 0.2 * service_time
+            while self._queues:
+                user_id, queue = self._queues.popitem(last=False)
+                waiter = queue.popleft()
+                self._queued -= 1
+                if queue:
+                    # Back of the ring: other users go first
+                    self._queues[user_id] = queue
+                waiter.granted = True
+                waiter.wake()
+                return
+            self._in_flight -= 1
+
+
+class AdmissionController:
+    """Per-user rate limit plus a fair global gate for upstream LLM calls."""
+
+    def __init__(self, enabled=True, user_rate=1.0, user_burst=10, max_concurrency=16, queue_slo=2.0):
+        self.enabled = enabled
+        self.limiter = TokenBucketLimiter(user_rate, user_burst)
+        self.gate = FairGate(max_concurrency, queue_slo)
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            enabled=os.getenv("ADMISSION_ENABLED", "1") == "1",
+            user_rate=float(os.getenv("ADMISSION_USER_RATE", "1.0")),
+            user_burst=float(os.getenv("ADMISSION_USER_BURST", "10")),
+            max_concurrency=int(os.getenv("GEMINI_MAX_CONCURRENCY", "16")),
+            queue_slo=float(os.getenv("ADMISSION_QUEUE_SLO_MS", "2000")) / 1000.0,
+        )
+
+    def _record(self, outcome, waited):
+        metrics.inc('admission_decisions_total', outcome=outcome)
+        metrics.observe('admission_wait_seconds', waited)
+
+    def acquire(self, user_id):
+        """Returns ADMITTED, RATE_LIMITED or QUEUE_SLO. Call `release()` only when admitted."""
+        if not self.enabled:
+            return ADMITTED
+        if not self.limiter.allow(user_id):
+            self._record(RATE_LIMITED, 0.0)
+            return RATE_LIMITED
+        start = time.perf_counter()
+        outcome = self.gate.acquire(user_id)
+        self._record(outcome, time.perf_counter() - start)
+        return outcome
+
+    async def acquire_async(self, user_id):
+        if not self.enabled:
+            return ADMITTED
+        if not self.limiter.allow(user_id):
+            self._record(RATE_LIMITED, 0.0)
+            return RATE_LIMITED
+        start = time.perf_counter()
+        outcome = await self.gate.acquire_async(user_id)
+        self._record(outcome, time.perf_counter() - start)
+        return outcome
+
+    def release(self, service_time=None):
+        if self.enabled:
+            self.gate.release(service_time)
+
+
+metrics.describe('admission_decisions_total', 'counter', 'Admission decisions for Gemini calls by outcome.')
+metrics.describe('admission_wait_seconds', 'histogram', 'Time spent waiting for a Gemini slot.')
@@ -1,36 +1,121 @@
+# `python app.py [api|serve]`: dispatch to the entry points (cli.py) before
+# building anything here, since they import this module themselves
+if __name__ == "__main__":
+    import cli
+    cli.main()
+    raise SystemExit(0)
+
 import os
+import atexit
+import base64
+import hashlib
+import hmac
 import json
-import requests
-from flask import Flask, request, jsonify
-from flask_cors import CORS
+import logging
 from dotenv import load_dotenv
 import re
+import contextvars
+import tempfile
 import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import logging_setup
+import metrics
+from admission import ADMITTED, AdmissionController
+from browse import BrowseIndex, InvalidCursor
+from catalog import (DEFAULT_CURRENCY, CatalogSnapshot, extract_colors_from_product, extract_price_range,
+                     normalize_text, product_text, truncate_text)
+from compact_catalog import CompactCatalog, write_compact_catalog
+from conversation import Conversation, ConversationStore
+from prefetch import Prefetcher
+from tenants import Tenant, TenantRegistry
 
 load_dotenv()
 
+# JSON events through a non-blocking queue (LOG_* env vars, see logging_setup.py)
+logging_setup.setup()
+log = logging.getLogger(__name__)
+
 SHOP_NAME = "ecommerce-test-store-demo"
 SHOP_URL = f"https://ecommerce-test-store-demo.myshopify.com"
 SHOPIFY_ACCESS_TOKEN = os.getenv("SHOPIFY_API_KEY")
-products_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'shopify_products.json')
-full_export_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'shopify_full_export.json')
+# Client secret of the Shopify app; webhooks without a valid signature are rejected
+SHOPIFY_WEBHOOK_SECRET = os.getenv("SHOPIFY_WEBHOOK_SECRET")
+# Admin API root of the default shop (override to use a local stub, see stub_servers.py)
+SHOPIFY_BASE_URL = os.getenv("SHOPIFY_BASE_URL")
+# Directory holding the default shop's catalog files and chat histories
+DATA_DIR = os.getenv("DATA_DIR", os.path.dirname(os.path.abspath(__file__)))
+# Catalog files (shopify_products.json, shopify_full_export.json, shopify_shop.json with the
+# cached currency/validators, and the compact shopify_catalog.bin) are per shop: see Tenant.
+# Prefer the compact mmap-able catalog (compact_catalog.py) when it is the newest copy
+COMPACT_CATALOG = os.getenv("COMPACT_CATALOG", "1") == "1"
 
-# Store currency (will be fetched from Shopify)
-STORE_CURRENCY = "USD"  # Default fallback
+# Lock CORS to your Shopify store (override via ALLOWED_ORIGIN env if needed)
+ALLOWED_ORIGIN = os.getenv('ALLOWED_ORIGIN', 'https://ecommerce-test-store-demo.myshopify.com')
+
+# Additional shops served by this process (see tenants.py); their data lives in TENANTS_DIR/<domain>/
+TENANTS_FILE = os.getenv("TENANTS_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tenants.json'))
+TENANTS_DIR = os.getenv("TENANTS_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tenants'))
+# Catalogs kept in memory at once, and seconds before an idle shop's catalog is unloaded
+TENANT_MAX_LOADED = int(os.getenv("TENANT_MAX_LOADED", "50"))
+TENANT_IDLE_TTL = float(os.getenv("TENANT_IDLE_TTL", "1800"))
+
+# Seconds between background catalog revalidations (webhooks trigger one immediately)
+CATALOG_REFRESH_INTERVAL = float(os.getenv("CATALOG_REFRESH_INTERVAL", "300"))
+
+# How out-of-stock products are treated in answers: 'downrank' (default), 'filter' or 'off'
+AVAILABILITY_MODE = os.getenv("AVAILABILITY_MODE", "downrank")
+# Relevance subtracted from out-of-stock products under 'downrank' (one title-word match is worth 5),
+# so a product the shopper names still reaches the prompt, marked out of stock
+AVAILABILITY_RANK_PENALTY = float(os.getenv("AVAILABILITY_RANK_PENALTY", "5"))
 
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-GEMINI_API_URL = f"https://generativelanguage.googleapis.com/v1/models/gemini-2.0-flash:generateContent?key={GEMINI_API_KEY}"
+GEMINI_API_URL = os.getenv("GEMINI_API_URL") or f"https://generativelanguage.googleapis.com/v1/models/gemini-2.0-flash:generateContent?key={GEMINI_API_KEY}"
+
+# Per-user rate limit and fair global concurrency limit for Gemini calls (ADMISSION_* env vars)
+admission = AdmissionController.from_env()
+
+# Emit a per-request Server-Timing header with pipeline stage durations
+SERVER_TIMING = os.getenv("SERVER_TIMING", "0") == "1"
 
 # Directory to store chat histories
-CHAT_HISTORY_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'chat_histories')
+CHAT_HISTORY_DIR = os.path.join(DATA_DIR, 'chat_histories')
 os.makedirs(CHAT_HISTORY_DIR, exist_ok=True)
 
 # Thread lock for file safety
 chat_history_lock = threading.Lock()
 
-def get_chat_history(user_id):
-    """Load chat history for a user from file."""
-    path = os.path.join(CHAT_HISTORY_DIR, f"{user_id}.json")
+# Conversations kept in memory, and seconds between lazy history writes (0 = write every turn)
+CONVERSATION_CACHE_SIZE = int(os.getenv("CONVERSATION_CACHE_SIZE", "10000"))
+HISTORY_FLUSH_INTERVAL = float(os.getenv("HISTORY_FLUSH_INTERVAL", "1.0"))
+
+# Products per page when listing products in chat, and the default / maximum `limit` of GET /products
+BROWSE_PAGE_SIZE = int(os.getenv("BROWSE_PAGE_SIZE", "10"))
+BROWSE_API_LIMIT = int(os.getenv("BROWSE_API_LIMIT", "20"))
+BROWSE_API_MAX_LIMIT = int(os.getenv("BROWSE_API_MAX_LIMIT", "100"))
+
+# Speculative answers to likely follow-ups ("colors?", "on sale?", "link?"), see prefetch.py
+PREFETCH_ENABLED = os.getenv("PREFETCH_ENABLED", "0") == "1"
+PREFETCH_GEMINI = os.getenv("PREFETCH_GEMINI", "0") == "1"
+PREFETCH_BUDGET_MS = float(os.getenv("PREFETCH_BUDGET_MS", "50"))
+PREFETCH_GEMINI_MAX_INFLIGHT = int(os.getenv("PREFETCH_GEMINI_MAX_INFLIGHT", "2"))
+
+_SAFE_USER_ID = re.compile(r"[A-Za-z0-9_@-][A-Za-z0-9_.@-]{0,127}")
+
+def chat_history_path(user_id, tenant=None):
+    """History file of a user of the current shop. `user_id` comes from the client, so
+    anything but a plain name (path separators, '..', leading dots) is hashed and can
+    never resolve outside the shop's history directory."""
+    history_dir = (tenant or current_tenant()).history_dir
+    name = str(user_id)
+    if not _SAFE_USER_ID.fullmatch(name):
+        name = 'u-' + hashlib.sha256(name.encode('utf-8')).hexdigest()[:32]
+    return os.path.join(history_dir, f"{name}.json")
+
+def get_chat_history(user_id, tenant=None):
+    """Load chat history for a user (of the current shop) from file."""
+    path = chat_history_path(user_id, tenant)
     if not os.path.exists(path):
         return []
     with chat_history_lock:
@@ -40,18 +125,27 @@ def get_chat_history(user_id):
         except Exception:
             return []
 
-def save_chat_history(user_id, history):
-    """Save chat history for a user to file."""
-    path = os.path.join(CHAT_HISTORY_DIR, f"{user_id}.json")
+def chat_history_mtime(user_id, tenant=None):
+    path = chat_history_path(user_id, tenant)
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+def save_chat_history(user_id, history, tenant=None):
+    """Save chat history for a user (of the current shop) to file."""
+    path = chat_history_path(user_id, tenant)
     with chat_history_lock:
         with open(path, 'w') as f:
             json.dump(history, f, indent=2)
 
-def load_products_from_disk():
+def load_products_from_disk(tenant=None):
     """Load product data, preferring shopify_full_export.json if present.
     Returns a list of product objects compatible with existing helpers.
     """
-    # Try full export first
+    tenant = tenant or current_tenant()
+    products_file, full_export_file = tenant.products_file, tenant.full_export_file
+    # Try full export first (the scraper and catalog refreshes both keep it complete)
     try:
         if os.path.exists(full_export_file):
             with open(full_export_file, 'r') as f:
@@ -76,29 +170,102 @@ def load_products_from_disk():
         pass
     return []
 
-def fetch_store_currency():
+def _write_json_atomic(path, data):
+    # A unique temp file per writer: every WEB_CONCURRENCY worker runs its own refresher
+    with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(path) or '.', prefix=os.path.basename(path) + '.',
+                                     suffix='.tmp', delete=False) as f:
+        tmp_path = f.name
+        try:
+            json.dump(data, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        except BaseException:
+            f.close()
+            os.remove(tmp_path)
+            raise
+    os.replace(tmp_path, path)
+
+def load_compact_products(tenant=None):
+    """Products from the compact snapshot if it is at least as new as the JSON files, else None."""
+    tenant = tenant or current_tenant()
+    compact_catalog_file = tenant.compact_catalog_file
+    if not COMPACT_CATALOG or not os.path.exists(compact_catalog_file):
+        return None
+    compact_mtime = os.path.getmtime(compact_catalog_file)
+    for path in (tenant.products_file, tenant.full_export_file):
+        if os.path.exists(path) and os.path.getmtime(path) > compact_mtime:
+            return None
+    try:
+        return CompactCatalog(compact_catalog_file).products()
+    except Exception as e:
+        log.warning('compact_catalog_read_failed', extra={'shop': tenant.domain, 'error': str(e)})
+        return None
+
+def save_compact_catalog(products, tenant=None):
+    if not COMPACT_CATALOG:
+        return
+    tenant = tenant or current_tenant()
+    try:
+        write_compact_catalog(products, tenant.compact_catalog_file)
+    except Exception as e:
+        log.warning('compact_catalog_write_failed', extra={'shop': tenant.domain, 'error': str(e)})
+
+def catalog_disk_stamp(tenant):
+    """(mtime, size) of the shop's catalog files; changes when scraper.py or a refresh rewrites them."""
+    stamp = []
+    for path in (tenant.full_export_file, tenant.products_file, tenant.compact_catalog_file):
+        try:
+            st = os.stat(path)
+            stamp.append((st.st_mtime_ns, st.st_size))
+        except OSError:
+            stamp.append(None)
+    return tuple(stamp)
+
+def load_catalog_from_disk(tenant=None):
+    """Build a catalog snapshot of a shop from the files on disk (no network)."""
+    tenant = tenant or current_tenant()
+    meta = {}
+    try:
+        if os.path.exists(tenant.shop_meta_file):
+            with open(tenant.shop_meta_file, 'r') as f:
+                meta = json.load(f)
+    except Exception:
+        meta = {}
+    disk_stamp = catalog_disk_stamp(tenant)
+    products = load_compact_products(tenant)
+    if products is None:
+        products = load_products_from_disk(tenant)
+    snapshot = CatalogSnapshot(products, currency=meta.get('currency') or tenant.currency,
+                               validators=meta.get('validators'), source='disk')
+    snapshot.disk_stamp = disk_stamp
+    return snapshot
+
+def fetch_store_currency(default=DEFAULT_CURRENCY, tenant=None):
     """Fetch the store's currency from Shopify API"""
-    global STORE_CURRENCY
-    if not SHOPIFY_ACCESS_TOKEN:
-        print("Warning: SHOPIFY_ACCESS_TOKEN not set. Using default currency.")
-        return STORE_CURRENCY
+    tenant = tenant or current_tenant()
+    if not tenant.access_token:
+        log.warning('store_currency_skipped', extra={'shop': tenant.domain, 'reason': 'no access token',
+                                                     'currency': default})
+        return default
     
+    import requests
+    start = time.perf_counter()
     try:
-        url = f"https://{SHOP_NAME}.myshopify.com/admin/api/2023-01/shop.json"
+        url = f"{tenant.api_base}/shop.json"
         headers = {
-            "X-Shopify-Access-Token": SHOPIFY_ACCESS_TOKEN,
+            "X-Shopify-Access-Token": tenant.access_token,
             "Content-Type": "application/json"
         }
         response = requests.get(url, headers=headers, timeout=10)
         response.raise_for_status()
         shop_data = response.json().get('shop', {})
-        currency = shop_data.get('currency', STORE_CURRENCY)
-        STORE_CURRENCY = currency
-        print(f"Store currency: {currency}")
+        currency = shop_data.get('currency', default)
+        log.info('store_currency_fetched', extra={'shop': tenant.domain, 'currency': currency,
+                                                  'duration_ms': round((time.perf_counter() - start) * 1000.0, 2)})
         return currency
     except Exception as e:
-        print(f"Error fetching store currency: {e}")
-        return STORE_CURRENCY
+        log.warning('store_currency_failed', extra={'shop': tenant.domain, 'error': str(e)})
+        return default
 
 def get_currency_symbol(currency_code):
     """Get currency symbol from currency code"""
@@ -136,63 +303,16 @@ def get_currency_symbol(currency_code):
     }
     return currency_symbols.get(currency_code, currency_code)
 
-def extract_colors_from_product(product):
-    """Extract colors directly from product JSON structure"""
-    colors = []
-    
-    # Method 1: Get colors from product options where name is "Color"
-    for option in product.get('options', []):
-        if option.get('name', '').lower() == 'color':
-            colors.extend(option.get('values', []))
-    
-    # Method 2: Get colors from variants option1 (if not already found)
-    if not colors:
-        for variant in product.get('variants', []):
-            option1 = variant.get('option1')
-            if option1 and option1.lower() != 'default title':
-                colors.append(option1)
-    
-    # Filter out currency values and other non-color strings
-    filtered_colors = []
-    for color in colors:
-        # Skip if it contains currency symbols or looks like a price
-        if (not re.search(r'[\$€£¥₹₽₩₪₺₫₱₿]', color) and  # No currency symbols
-            not re.search(r'\d+\.?\d*', color) and  # No numbers (prices)
-            not color.lower() in ['default', 'default title', 'title'] and  # No default values
-            len(color.strip()) > 0):  # Not empty
-            filtered_colors.append(color)
-    
-    # Remove duplicates and return
-    return list(set(filtered_colors))
-
-def _normalize_text(value):
-    try:
-        return (value or "").lower()
-    except Exception:
-        return ""
-
-def _extract_price_range(query: str):
-    """Very light heuristic to detect min/max price from free text, returns (min_price,max_price) or (None,None)."""
-    q = query.replace(',', ' ')
-    nums = [float(x) for x in re.findall(r"\d+\.?\d*", q)]
-    if not nums:
-        return (None, None)
-    if len(nums) == 1:
-        # Single number – treat as max
-        return (None, nums[0])
-    # Multiple numbers – min/max of them
-    return (min(nums), max(nums))
-
 def score_product_relevance(query: str, product: dict) -> float:
     """Compute a simple relevance score using keyword overlap, colors, vendor, tags, product_type, and rough price range."""
     score = 0.0
-    q = _normalize_text(query)
+    q = normalize_text(query)
     words = [w for w in re.findall(r"\w+", q) if len(w) > 2]
-    title = _normalize_text(product.get('title'))
-    vendor = _normalize_text(product.get('vendor'))
-    tags = _normalize_text(product.get('tags'))
-    ptype = _normalize_text(product.get('product_type'))
-    body = _normalize_text(product.get('body_html'))
+    title = normalize_text(product.get('title'))
+    vendor = normalize_text(product.get('vendor'))
+    tags = normalize_text(product.get('tags'))
+    ptype = normalize_text(product.get('product_type'))
+    body = product_text(product).search_text
     colors = [c.lower() for c in extract_colors_from_product(product)]
 
     # Keyword matches
@@ -220,7 +340,7 @@ def score_product_relevance(query: str, product: dict) -> float:
         price_val = float(str(price)) if price is not None else None
     except Exception:
         price_val = None
-    pmin, pmax = _extract_price_range(q)
+    pmin, pmax = extract_price_range(q)
     if price_val is not None and (pmin is not None or pmax is not None):
         if pmin is not None and price_val < pmin:
             score -= 2
@@ -231,36 +351,147 @@ def score_product_relevance(query: str, product: dict) -> float:
 
     return score
 
-def select_top_k_products(query: str, products: list, k: int = 12) -> list:
+def select_top_k_products(query: str, products: list, k: int = 12, unavailable=None) -> list:
+    """Best `k` products for the query. Products whose id is in `unavailable`
+    lose AVAILABILITY_RANK_PENALTY points of relevance."""
     if not products:
         return []
     scored = [(score_product_relevance(query, p), p) for p in products]
+    if unavailable:
+        scored = [(s - AVAILABILITY_RANK_PENALTY if p.get('id') in unavailable else s, p) for s, p in scored]
     scored.sort(key=lambda x: x[0], reverse=True)
     return [p for _, p in scored[:k]]
 
+# Fields the scraper joins onto each product (and variant) from other resources;
+# /products.json does not return them
+SCRAPED_PRODUCT_FIELDS = ('collections', 'metafields', 'discount_rules')
+SCRAPED_VARIANT_FIELDS = ('inventory_levels',)
+
+def merge_scraped_fields(products, previous):
+    """Carry the scraper-joined fields of `previous` products over to freshly fetched `products`
+    (matched by product and variant id). Products new since the last scrape get them on the next one."""
+    by_id = {p.get('id'): p for p in previous or []}
+    for product in products:
+        old = by_id.get(product.get('id'))
+        if old is None:
+            continue
+        for field in SCRAPED_PRODUCT_FIELDS:
+            if field in old and field not in product:
+                product[field] = old[field]
+        old_variants = {v.get('id'): v for v in old.get('variants') or []}
+        for variant in product.get('variants') or []:
+            old_variant = old_variants.get(variant.get('id'))
+            for field in SCRAPED_VARIANT_FIELDS:
+                if old_variant is not None and field in old_variant and field not in variant:
+                    variant[field] = old_variant[field]
+    return products
+
+def fetch_catalog_snapshot(current=None, tenant=None):
+    """Revalidate a shop's catalog: reload it from disk if scraper.py rewrote the files,
+    else against Shopify. Returns a new CatalogSnapshot, or None if unchanged (304) or
+    no token is configured.
+    """
+    tenant = tenant or current_tenant()
+    if current is not None and getattr(current, 'disk_stamp', None) != catalog_disk_stamp(tenant):
+        log.info('catalog_reloaded_from_disk', extra={'shop': tenant.domain})
+        return load_catalog_from_disk(tenant)
+    if not tenant.access_token:
+        log.warning('catalog_fetch_skipped', extra={'shop': tenant.domain, 'reason': 'no access token'})
+        return None
+    import requests
+    validators = current.validators if current else {}
+    url = f"{tenant.api_base}/products.json"
+    headers = {
+        "X-Shopify-Access-Token": tenant.access_token,
+        "Content-Type": "application/json"
+    }
+    # Conditional request: lets Shopify answer 304 when nothing changed
+    if validators.get('etag'):
+        headers["If-None-Match"] = validators['etag']
+    if validators.get('last_modified'):
+        headers["If-Modified-Since"] = validators['last_modified']
+    start = time.perf_counter()
+    response = requests.get(url, headers=headers, params={'limit': 250}, timeout=10)
+    if response.status_code == 304:
+        log.info('catalog_not_modified', extra={'shop': tenant.domain,
+                                                'duration_ms': round((time.perf_counter() - start) * 1000.0, 2)})
+        return None
+    response.raise_for_status()
+    products_data = response.json().get('products', [])
+    # Follow the page_info cursors in the Link header for catalogs larger than one page
+    page = response
+    while page.links.get('next', {}).get('url'):
+        page = requests.get(page.links['next']['url'], headers={k: v for k, v in headers.items()
+                                                               if not k.startswith('If-')}, timeout=10)
+        page.raise_for_status()
+        products_data.extend(page.json().get('products', []))
+
+    # Currency is cached with the catalog and only refetched alongside it
+    currency = fetch_store_currency(current.currency if current else (tenant.currency or DEFAULT_CURRENCY), tenant)
+    new_validators = {
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+    }
+    merge_scraped_fields(products_data, current.products if current else None)
+    os.makedirs(tenant.data_dir, exist_ok=True)
+    _write_json_atomic(tenant.products_file, products_data)
+    _write_json_atomic(tenant.full_export_file, {'products': products_data})
+    _write_json_atomic(tenant.shop_meta_file, {'currency': currency, 'validators': new_validators})
+    log.info('catalog_fetched', extra={'shop': tenant.domain, 'products': len(products_data),
+                                       'duration_ms': round((time.perf_counter() - start) * 1000.0, 2)})
+    snapshot = CatalogSnapshot(products_data, currency=currency, validators=new_validators, source='shopify',
+                               previous=current)
+    save_compact_catalog(snapshot.products, tenant)
+    snapshot.disk_stamp = catalog_disk_stamp(tenant)
+    return snapshot
+
+# The shop configured above is the default tenant; its data stays in DATA_DIR (the project directory)
+default_tenant = Tenant(f"{SHOP_NAME}.myshopify.com", access_token=SHOPIFY_ACCESS_TOKEN, shop_url=SHOP_URL,
+                        allowed_origin=ALLOWED_ORIGIN, data_dir=DATA_DIR, history_dir=CHAT_HISTORY_DIR,
+                        api_base=SHOPIFY_BASE_URL, webhook_secret=SHOPIFY_WEBHOOK_SECRET, pinned=True)
+tenant_registry = TenantRegistry.from_file(TENANTS_FILE, default_tenant, load_catalog_from_disk,
+                                           fetch_catalog_snapshot, TENANTS_DIR,
+                                           interval=CATALOG_REFRESH_INTERVAL, max_loaded=TENANT_MAX_LOADED,
+                                           idle_ttl=TENANT_IDLE_TTL)
+
+def current_tenant():
+    """The shop the current request is for (the default shop outside requests)."""
+    return tenant_registry.current()
+
+def current_catalog():
+    """The current shop's in-memory catalog snapshot (loaded from disk on first use)."""
+    return tenant_registry.catalog()
+
+def chat_products(snapshot):
+    """Products offered to the chat pipeline, per AVAILABILITY_MODE (precomputed per snapshot)."""
+    return snapshot.availability.products_for(AVAILABILITY_MODE)
+
+def unavailable_for_ranking(snapshot):
+    return snapshot.availability.unavailable_ids if AVAILABILITY_MODE == 'downrank' else None
+
+def verify_webhook(raw_body, signature, tenant=None):
+    """True if `signature` (X-Shopify-Hmac-Sha256) is the base64 HMAC-SHA256 of the raw
+    body under the shop's webhook secret. Always False when no secret is configured."""
+    tenant = tenant or current_tenant()
+    if not tenant.webhook_secret:
+        log.warning('webhook_secret_missing', extra={'shop': tenant.domain})
+        return False
+    if not signature:
+        return False
+    digest = hmac.new(tenant.webhook_secret.encode('utf-8'), raw_body or b'', hashlib.sha256).digest()
+    return hmac.compare_digest(base64.b64encode(digest).decode('ascii'), signature.strip())
+
+def apply_inventory_level_update(payload):
+    """Apply an inventory_levels/update webhook payload to the current snapshot's index."""
+    applied = current_catalog().availability.apply_level(
+        payload.get('inventory_item_id'), payload.get('location_id'), payload.get('available'))
+    metrics.inc('inventory_updates_total', outcome='applied' if applied else 'unknown_item')
+    return applied
+
 def fetch_latest_products():
-    if not SHOPIFY_ACCESS_TOKEN:
-        print("Warning: SHOPIFY_ACCESS_TOKEN not set. Using cached data.")
-        return []
-    try:
-        # Fetch store currency first
-        fetch_store_currency()
-        
-        url = f"https://{SHOP_NAME}.myshopify.com/admin/api/2023-01/products.json"
-        headers = {
-            "X-Shopify-Access-Token": SHOPIFY_ACCESS_TOKEN,
-            "Content-Type": "application/json"
-        }
-        response = requests.get(url, headers=headers, timeout=10)
-        response.raise_for_status()
-        products_data = response.json().get('products', [])
-        with open(products_file, 'w') as f:
-            json.dump(products_data, f, indent=2)
-        print(f"Fetched {len(products_data)} products from Shopify (webhook)")
-        return products_data
-    except Exception as e:
-        print(f"Error fetching products from Shopify: {e}")
-        return []
+    """Revalidate the catalog now and return the current products."""
+    current_tenant().refresher.refresh()
+    return current_catalog().products
 
 def find_products_by_color(query, products):
     """Find products that have the specified color based on JSON data"""
@@ -323,9 +554,9 @@ def find_products_by_keyword(query, products):
             tags = product.get('tags', '').lower()
             vendor = product.get('vendor', '').lower()
             product_type = product.get('product_type', '').lower()
-            body_html = (product.get('body_html') or '').lower()
+            body_text = product_text(product).search_text
             
-            if any(k in title or k in tags or k in vendor or k in product_type or k in body_html for k in keywords):
+            if any(k in title or k in tags or k in vendor or k in product_type or k in body_text for k in keywords):
                 matches.append(product)
     
     return matches
@@ -347,14 +578,22 @@ def extract_products_in_text(text: str, products: list) -> list:
     return hits
 
 def get_all_available_colors(products):
-    """Get all available colors from the product data"""
+    """Get all available colors from the product data (cached per product list of the current shop)"""
+    caches = current_tenant().caches
+    cached = caches.get('all_colors')  # (product list, colors)
+    if cached is not None and cached[0] is products:
+        metrics.inc('cache_hits_total', cache='all_colors')
+        return cached[1]
+    metrics.inc('cache_misses_total', cache='all_colors')
     all_colors = set()
     
     for product in products:
         colors = extract_colors_from_product(product)
         all_colors.update(colors)
     
-    return sorted(list(all_colors))
+    colors = sorted(list(all_colors))
+    caches['all_colors'] = (products, colors)
+    return colors
 
 def find_matching_products(query, products):
     query = query.lower()
@@ -392,7 +631,7 @@ def generate_product_link(product):
     """Generate the product URL"""
     handle = product.get('handle', '')
     if handle:
-        return f"{SHOP_URL}/products/{handle}"
+        return f"{current_tenant().shop_url}/products/{handle}"
     return None
 
 def format_product_card(product):
@@ -400,8 +639,8 @@ def format_product_card(product):
     variant = product.get('variants', [{}])[0]
     price = variant.get('price', 'N/A')
     compare_at_price = variant.get('compare_at_price')
-    desc = (product.get('body_html') or product.get('product_type', '') or '').strip()
-    desc = desc[:90] + ('...' if len(desc) > 90 else '') if desc else 'No description available.'
+    desc = (product_text(product).text or product.get('product_type', '') or '').strip()
+    desc = truncate_text(desc, 90) if desc else 'No description available.'
     tags = product.get('tags', '')
     vendor = product.get('vendor', 'Unknown Vendor')
     
@@ -412,7 +651,7 @@ def format_product_card(product):
     link = generate_product_link(product)
     
     # Format price with correct currency and show discount if available
-    currency_symbol = get_currency_symbol(STORE_CURRENCY)
+    currency_symbol = get_currency_symbol(current_catalog().currency)
     formatted_price = f"{currency_symbol}{price}" if price != 'N/A' else 'N/A'
     discount_line = ''
     try:
@@ -436,9 +675,69 @@ def format_product_card(product):
         card += f"🔗 [View Product]({link})"
     return card
 
+def product_list_item(product):
+    """Product summary returned by GET /products (availability is added per request)."""
+    variant = (product.get('variants') or [{}])[0]
+    image = product.get('image') or {}
+    return {
+        'id': product.get('id'),
+        'title': product.get('title'),
+        'handle': product.get('handle'),
+        'vendor': product.get('vendor'),
+        'product_type': product.get('product_type'),
+        'price': variant.get('price'),
+        'compare_at_price': variant.get('compare_at_price'),
+        'url': generate_product_link(product),
+        'image': image.get('src') if isinstance(image, dict) else None,
+        'collections': [c.get('title') for c in product.get('collections') or []],
+    }
+
+_browse_index_lock = threading.Lock()
+
+def browse_index_for(snapshot, products):
+    """Collection index and rendered-page cache for this snapshot's product list (cached per shop)."""
+    caches = current_tenant().caches
+    with _browse_index_lock:
+        cached = caches.get('browse')  # (snapshot, product list, BrowseIndex)
+        if cached is None or cached[0] is not snapshot or cached[1] is not products:
+            metrics.inc('cache_misses_total', cache='browse')
+            index = BrowseIndex(products, snapshot.version, format_product_card, product_list_item)
+            cached = caches['browse'] = (snapshot, products, index)
+        else:
+            metrics.inc('cache_hits_total', cache='browse')
+        return cached[2]
+
+_MORE_PATTERN = re.compile(r"^\W*(show( me)? |see |give me )?(some )?(more|next( page| one| ones)?)( products| items| please)*\W*$")
+
+def browse_answer(query, products, memory=None, cursor=None):
+    """One page of the products (of the collection named in `query`, if any),
+    continuing from `cursor`. The next page's cursor is kept on `memory`."""
+    index = browse_index_for(current_catalog(), products)
+    try:
+        page = index.page(index.match(query), cursor=cursor, limit=BROWSE_PAGE_SIZE)
+    except InvalidCursor:
+        page = index.page(index.match(query), limit=BROWSE_PAGE_SIZE)
+    metrics.inc('browse_pages_total', source='chat')
+    if memory is not None:
+        memory.browse_cursor = page.next_cursor
+    if not page.products:
+        return "No products found."
+    scope = f" in **{page.listing.title}**" if page.listing.title else ''
+    header = f"🛍️ Products {page.start + 1}-{page.start + len(page.products)} of {page.total}{scope}:"
+    answer = f"{header}\n\n{index.page_cards(page)}"
+    if page.next_cursor:
+        answer += "\n\n➡️ Say \"more\" to see the next products."
+    return answer
+
 def generate_chatbot_response(query, products, memory=None):
+    """Local rule-based answer. `memory` is the session's Conversation (optional);
+    it lets "more" continue the last product listing."""
     query_lower = query.lower()
     
+    # Next page of the last product listing
+    if memory is not None and memory.browse_cursor and _MORE_PATTERN.match(query_lower):
+        return browse_answer(query, products, memory, cursor=memory.browse_cursor)
+    
     # Get all available colors from the data
     all_colors = get_all_available_colors(products)
     all_colors_lower = [color.lower() for color in all_colors]
@@ -484,11 +783,11 @@ def generate_chatbot_response(query, products, memory=None):
         else:
             return "Sorry, I couldn't find any products in that color. Try asking about available colors for specific products."
     
-    # Show all products
+    # Show all products (a page at a time; of a collection if the query names one)
     if 'all products' in query_lower or 'show me' in query_lower or 'list' in query_lower or 'products' in query_lower:
         if not products:
             return "No products found."
-        return '\n\n'.join([format_product_card(p) for p in products])
+        return browse_answer(query, products, memory)
     
     # Price query
     if 'price' in query_lower or 'cost' in query_lower or 'how much' in query_lower:
@@ -564,7 +863,9 @@ def generate_chatbot_response(query, products, memory=None):
 
 def format_product_data_for_prompt(products):
     entries = []
-    currency_symbol = get_currency_symbol(STORE_CURRENCY)
+    snapshot = current_catalog()
+    currency_symbol = get_currency_symbol(snapshot.currency)
+    unavailable = snapshot.availability.unavailable_ids if AVAILABILITY_MODE != 'off' else ()
     for product in products:
         variant = (product.get("variants") or [{}])[0]
         price = variant.get("price")
@@ -590,20 +891,16 @@ def format_product_data_for_prompt(products):
             "discount_pct": discount_pct,
             "colors": colors,
             "url": generate_product_link(product) or "",
-            "description": (product.get("body_html") or product.get("product_type", ""))[:180]
+            "description": product_text(product).summary or product.get("product_type", "")
         }
+        if product.get("id") in unavailable:
+            entry["availability"] = "out of stock"
         entries.append(entry)
     return json.dumps(entries, indent=2)
 
 # Gemini 2.0 Flash Request Function
 
-def query_gemini(user_query, context, temperature: float = 0.3):
-    # If key is missing, signal caller to fallback
-    if not GEMINI_API_KEY:
-        return ""
-    headers = {
-        "Content-Type": "application/json"
-    }
+def build_gemini_answer_body(user_query, context, temperature: float = 0.3):
     prompt = f"""
 You are a helpful ecommerce assistant for a Shopify store.
 Rules:
@@ -612,6 +909,7 @@ Rules:
 - When mentioning a product, include its current price; mention discounts only if available.
 - Prefer the best 1–3 matches, not long lists.
 - If colors are asked, list available colors succinctly.
+- If a product is marked out of stock, say so when you mention it.
 
 Product Catalog (JSON):
 {context}
@@ -621,7 +919,7 @@ User Question:
 
 Answer:
 """
-    body = {
+    return {
         "contents": [
             {
                 "parts": [{"text": prompt}]
@@ -634,249 +932,416 @@ Answer:
             "maxOutputTokens": 512
         }
     }
+
+def build_gemini_rewrite_body(text: str):
+    prompt = f"""
+Rewrite the following answer to be crisp, human, and at most 3 short sentences. Keep prices/discounts intact and include links if present.
+
+Answer:
+{text}
+"""
+    return {
+        "contents": [{"parts": [{"text": prompt}]}],
+        "generationConfig": {"temperature": 0.2, "maxOutputTokens": 256}
+    }
+
+def gemini_reply_text(payload):
+    return payload['candidates'][0]['content']['parts'][0]['text']
+
+def query_gemini(user_query, context, temperature: float = 0.3):
+    # If key is missing, signal caller to fallback
+    if not GEMINI_API_KEY:
+        metrics.inc('gemini_calls_total', kind='answer', outcome='skipped')
+        return ""
+    headers = {
+        "Content-Type": "application/json"
+    }
+    body = build_gemini_answer_body(user_query, context, temperature)
+    import requests
     try:
         res = requests.post(GEMINI_API_URL, headers=headers, json=body)
         res.raise_for_status()
-        reply = res.json()['candidates'][0]['content']['parts'][0]['text']
+        reply = gemini_reply_text(res.json())
+        metrics.inc('gemini_calls_total', kind='answer', outcome='ok')
         return reply
     except Exception as e:
-        print("Gemini API Error:", e)
+        metrics.inc('gemini_calls_total', kind='answer', outcome='error')
+        log.warning('gemini_error', extra={'kind': 'answer', 'error': str(e)})
         return ""
 
 def rewrite_with_gemini(text: str) -> str:
     """Use Gemini to crispen/shorten a draft answer if API is available; otherwise return original."""
     if not GEMINI_API_KEY or not text:
         return text
-    prompt = f"""
-Rewrite the following answer to be crisp, human, and at most 3 short sentences. Keep prices/discounts intact and include links if present.
-
-Answer:
-{text}
-"""
+    metrics.inc('gemini_rewrites_total')
     headers = {"Content-Type": "application/json"}
-    body = {
-        "contents": [{"parts": [{"text": prompt}]}],
-        "generationConfig": {"temperature": 0.2, "maxOutputTokens": 256}
-    }
+    body = build_gemini_rewrite_body(text)
+    import requests
     try:
         res = requests.post(GEMINI_API_URL, headers=headers, json=body)
         res.raise_for_status()
-        return res.json()['candidates'][0]['content']['parts'][0]['text']
+        reply = gemini_reply_text(res.json())
+        metrics.inc('gemini_calls_total', kind='rewrite', outcome='ok')
+        return reply
     except Exception as e:
-        print("Gemini rewrite Error:", e)
+        metrics.inc('gemini_calls_total', kind='rewrite', outcome='error')
+        log.warning('gemini_error', extra={'kind': 'rewrite', 'error': str(e)})
         return text
 
-app = Flask(__name__)
+# Chat pipeline helpers shared by the Flask and async (ASGI) handlers
 
-# Lock CORS to your Shopify store (override via ALLOWED_ORIGIN env if needed)
-ALLOWED_ORIGIN = os.getenv('ALLOWED_ORIGIN', 'https://ecommerce-test-store-demo.myshopify.com')
-CORS(
-    app,
-    resources={
-        r"/chat": {"origins": [ALLOWED_ORIGIN]},
-        r"/history": {"origins": [ALLOWED_ORIGIN]},
-        r"/webhook/*": {"origins": "*"}
-    },
-    supports_credentials=False
-)
-
-@app.after_request
-def add_cors_headers(response):
-    # Ensure headers are always present (including preflight 204)
-    response.headers.setdefault('Access-Control-Allow-Origin', ALLOWED_ORIGIN)
-    response.headers.setdefault('Vary', 'Origin')
-    response.headers.setdefault('Access-Control-Allow-Headers', 'Content-Type, Authorization')
-    response.headers.setdefault('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
-    response.headers.setdefault('Access-Control-Max-Age', '3600')
-    return response
-
-# Silence favicon 404s
-@app.route('/favicon.ico')
-def _favicon():
-    return ('', 204)
-
-@app.route('/webhook/products', methods=['POST'])
-def shopify_webhook():
-    try:
-        print("Webhook received, about to fetch products")
-        latest_products = fetch_latest_products()
-        print("Fetched and wrote products:", len(latest_products))
-        return jsonify({'status': 'success'}), 200
-    except Exception as e:
-        print(f"Webhook error: {e}")
-        return jsonify({'error': 'Webhook processing failed'}), 500
+COLOR_KEYWORDS = [
+    'black', 'white', 'red', 'blue', 'green', 'yellow', 'orange', 'purple', 'pink',
+    'brown', 'gray', 'grey', 'silver', 'gold', 'navy', 'maroon', 'olive', 'teal',
+    'cyan', 'magenta', 'lime', 'indigo', 'violet', 'coral', 'salmon', 'turquoise',
+    'beige', 'cream', 'ivory', 'charcoal', 'burgundy', 'emerald', 'sapphire', 'ruby',
+    'amber', 'bronze', 'copper', 'platinum', 'rose', 'lavender', 'mint', 'peach',
+    'ice', 'dawn', 'powder', 'electric', 'sunset', 'hydrogen', 'liquid', 'brew'
+]
 
-# Update chat endpoint to use Gemini
-@app.route('/chat', methods=['OPTIONS', 'POST'])
-def chat():
-    try:
-        # Handle CORS preflight
-        if request.method == 'OPTIONS':
-            return ('', 204)
-        products_latest = load_products_from_disk()
-        data = request.get_json(silent=True)
-        user_query = data.get('message', '') if data else ''
-        user_id = data.get('user_id', 'default_user') if data else 'default_user'
-        if not user_query:
-            return jsonify({'error': 'No message provided'}), 400
-
-        # Load chat history
-        chat_history = get_chat_history(user_id)
-        # Append new user message
-        chat_history.append({'role': 'user', 'message': user_query})
-
-        # Check if this is a color-related query
-        query_lower = user_query.lower()
-        color_keywords = [
-            'black', 'white', 'red', 'blue', 'green', 'yellow', 'orange', 'purple', 'pink', 
-            'brown', 'gray', 'grey', 'silver', 'gold', 'navy', 'maroon', 'olive', 'teal',
-            'cyan', 'magenta', 'lime', 'indigo', 'violet', 'coral', 'salmon', 'turquoise',
-            'beige', 'cream', 'ivory', 'charcoal', 'burgundy', 'emerald', 'sapphire', 'ruby',
-            'amber', 'bronze', 'copper', 'platinum', 'rose', 'lavender', 'mint', 'peach',
-            'ice', 'dawn', 'powder', 'electric', 'sunset', 'hydrogen', 'liquid', 'brew'
-        ]
-        query_has_colors = any(color in query_lower for color in color_keywords)
-        query_mentions_color = any(word in query_lower for word in ['color', 'colour', 'coor', 'colors', 'colours'])
-
-        # Infer focus products from the last bot message to support pronouns like "it/this/that"
-        focus_products = []
-        if chat_history:
-            for past in reversed(chat_history):
-                if past.get('role') == 'bot':
-                    focus_products = extract_products_in_text(past.get('message', ''), products_latest)
-                    if focus_products:
-                        break
-
-        # Use Gemini (with top-K product selection) as primary, with local fallback
-        if query_has_colors or query_mentions_color:
-            context_messages = []
-            for msg in chat_history[-10:]:
-                prefix = 'User:' if msg['role'] == 'user' else 'Bot:'
-                context_messages.append(f"{prefix} {msg['message']}")
-            top_k = select_top_k_products(user_query, products_latest, k=12)
-            # Put focus products first (if any), then the rest of top-k
-            if focus_products:
-                focus_ids = {p.get('id') for p in focus_products}
-                merged = focus_products + [p for p in top_k if p.get('id') not in focus_ids]
-                context = format_product_data_for_prompt(merged[:12])
-            else:
-                context = format_product_data_for_prompt(top_k)
-            if context_messages:
-                focus_titles = ', '.join([p.get('title','') for p in focus_products]) if focus_products else ''
-                focus_line = f"\nCurrent focus products (for pronouns): {focus_titles}\n" if focus_titles else ''
-                context = f"Chat History:\n{chr(10).join(context_messages)}{focus_line}\nProduct Catalog:\n{context}"
-
-            answer = query_gemini(user_query, context, temperature=0.25)
-            # Fallback to local logic if Gemini fails or returns too little
-            if not answer or len(answer.strip()) < 5 or 'went wrong' in answer.lower():
-                # Minimal pronoun-aware local handling
-                if any(tok in query_lower for tok in [' it ', ' this ', ' that ']) and focus_products:
-                    fp = focus_products[0]
-                    if any(k in query_lower for k in ['vendor','brand']):
-                        answer = f"Vendor for {fp.get('title','product')}: {fp.get('vendor','Unknown Vendor')}"
-                    elif query_mentions_color:
-                        cols = extract_colors_from_product(fp)
-                        ctext = ', '.join(cols) if cols else 'No color options'
-                        answer = f"Colors for {fp.get('title','product')}: {ctext}"
-                    else:
-                        answer = generate_chatbot_response(user_query, products_latest)
-                else:
-                    answer = generate_chatbot_response(user_query, products_latest)
-                answer = rewrite_with_gemini(answer)
-            else:
-                # Linkify product names in Gemini answer
-                for product in products_latest:
-                    title = product.get('title', '')
-                    title_lower = title.lower()
-                    link = generate_product_link(product)
-                    if title and link and title_lower in answer.lower():
-                        answer = re.sub(rf'(?<!\[){re.escape(title)}(?!\])', f'[{title}]({link})', answer)
+# Per-session state cached between turns (see conversation.py)
+conversations = ConversationStore(get_chat_history, save_chat_history, chat_history_mtime,
+                                  extract_products_in_text, max_sessions=CONVERSATION_CACHE_SIZE)
+atexit.register(conversations.flush)
+
+def get_conversation(user_id):
+    """The cached conversation of `user_id` in the current shop (loaded from disk on a miss)."""
+    return conversations.get(user_id, current_tenant())
+
+def persist_conversation(conversation):
+    """Write the conversation now, or leave it to the background flusher."""
+    # An evicted conversation is no longer seen by the flusher: a request that still
+    # held it when it was evicted writes its own turns
+    if HISTORY_FLUSH_INTERVAL <= 0 or not conversations.resident(conversation):
+        conversations.save(conversation)
+    else:
+        conversations.start(HISTORY_FLUSH_INTERVAL)
+
+def prepare_chat_turn(user_query, chat_history, products, unavailable=None, top_k=None, conversation=None):
+    """Work out focus products, top-k and the Gemini context for one turn.
+    `chat_history` must already include the new user message; products in
+    `unavailable` are downranked. Pass `top_k` when it was already computed
+    (batch requests score every query in one pass), and the session's
+    `conversation` to reuse its cached context window and focus products.
+    """
+    query_lower = user_query.lower()
+    query_has_colors = any(color in query_lower for color in COLOR_KEYWORDS)
+    query_mentions_color = any(word in query_lower for word in ['color', 'colour', 'coor', 'colors', 'colours'])
+    color_branch = query_has_colors or query_mentions_color
+
+    if conversation is None:
+        conversation = Conversation(chat_history, extract_products_in_text)
+
+    # Infer focus products from the last bot message to support pronouns like "it/this/that"
+    with metrics.span('focus'):
+        focus_products = conversation.focus_products(products)
+
+    if top_k is None:
+        with metrics.span('top_k'):
+            top_k = select_top_k_products(user_query, products, k=12, unavailable=unavailable)
+    conversation.remember_top_k(top_k)
+    with metrics.span('prompt_build'):
+        context_messages = conversation.context_lines()
+        # Put focus products first (if any), then the rest of top-k
+        if focus_products:
+            focus_ids = {p.get('id') for p in focus_products}
+            merged = focus_products + [p for p in top_k if p.get('id') not in focus_ids]
+            context = format_product_data_for_prompt(merged[:12])
         else:
-            # Use Gemini for non-color queries
-            context_messages = []
-            for msg in chat_history[-10:]:
-                prefix = 'User:' if msg['role'] == 'user' else 'Bot:'
-                context_messages.append(f"{prefix} {msg['message']}")
-            top_k = select_top_k_products(user_query, products_latest, k=12)
-            if focus_products:
-                focus_ids = {p.get('id') for p in focus_products}
-                merged = focus_products + [p for p in top_k if p.get('id') not in focus_ids]
-                context = format_product_data_for_prompt(merged[:12])
+            context = format_product_data_for_prompt(top_k)
+        # Add chat history context to prompt
+        if context_messages:
+            focus_titles = ', '.join([p.get('title','') for p in focus_products]) if focus_products else ''
+            focus_line = f"\nCurrent focus products (for pronouns): {focus_titles}\n" if focus_titles else ''
+            context = f"Chat History:\n{chr(10).join(context_messages)}{focus_line}\nProduct Catalog:\n{context}"
+
+    return {
+        'query_lower': query_lower,
+        'query_mentions_color': query_mentions_color,
+        'color_branch': color_branch,
+        'focus_products': focus_products,
+        'top_k': top_k,
+        'conversation': conversation,
+        'context': context,
+        'temperature': 0.25 if color_branch else 0.3,
+    }
+
+def gemini_answer_unusable(answer, turn):
+    """True when the Gemini answer is missing/too short and the local engine should answer."""
+    if not answer or len(answer.strip()) < 5:
+        return True
+    return turn['color_branch'] and 'went wrong' in answer.lower()
+
+def local_fallback_answer(user_query, turn, products):
+    """Answer from the local engine (before the optional Gemini rewrite)."""
+    query_lower = turn['query_lower']
+    focus_products = turn['focus_products']
+    # Minimal pronoun-aware local handling for color-related queries
+    if turn['color_branch'] and any(tok in query_lower for tok in [' it ', ' this ', ' that ']) and focus_products:
+        fp = focus_products[0]
+        if any(k in query_lower for k in ['vendor','brand']):
+            return f"Vendor for {fp.get('title','product')}: {fp.get('vendor','Unknown Vendor')}"
+        if turn['query_mentions_color']:
+            cols = extract_colors_from_product(fp)
+            ctext = ', '.join(cols) if cols else 'No color options'
+            return f"Colors for {fp.get('title','product')}: {ctext}"
+    return generate_chatbot_response(user_query, products, memory=turn['conversation'])
+
+def answer_shed_turn(user_query, turn, products):
+    """Answer locally when admission control refused a Gemini slot (no rewrite either)."""
+    metrics.inc('chat_fallbacks_total')
+    with metrics.span('fallback'):
+        return local_fallback_answer(user_query, turn, products)
+
+def follow_up_answer(intent, focus_products):
+    """Local answer to a short 'colors' / 'sale' / 'link' follow-up about the focus products."""
+    currency_symbol = get_currency_symbol(current_catalog().currency)
+    lines = []
+    for p in focus_products:
+        title = p.get('title', 'Product')
+        if intent == 'colors':
+            colors = get_product_colors(p)
+            if colors:
+                lines.append(f"🎨 **{title}** available colors: {', '.join(colors)}")
             else:
-                context = format_product_data_for_prompt(top_k)
-            # Add chat history context to prompt
-            if context_messages:
-                focus_titles = ', '.join([p.get('title','') for p in focus_products]) if focus_products else ''
-                focus_line = f"\nCurrent focus products (for pronouns): {focus_titles}\n" if focus_titles else ''
-                context = f"Chat History:\n{chr(10).join(context_messages)}{focus_line}\nProduct Catalog:\n{context}"
-
-            answer = query_gemini(user_query, context, temperature=0.3)
-            # Fallback to local logic if Gemini unavailable/failed
-            if not answer or len(answer.strip()) < 5:
-                answer = generate_chatbot_response(user_query, products_latest)
-                answer = rewrite_with_gemini(answer)
+                lines.append(f"🎨 **{title}**: Color not available for this product.")
+        elif intent == 'sale':
+            variant = (p.get('variants') or [{}])[0]
+            price, compare_at = variant.get('price'), variant.get('compare_at_price')
+            try:
+                on_sale = price is not None and bool(compare_at) and float(str(compare_at)) > float(str(price))
+            except Exception:
+                on_sale = False
+            if on_sale:
+                pct = int(round((float(str(compare_at)) - float(str(price))) / float(str(compare_at)) * 100))
+                lines.append(f"🏷️ **{title}** is on sale: {currency_symbol}{price} "
+                             f"(was {currency_symbol}{compare_at}, {pct}% off)")
             else:
-                # Replace product name with clickable markdown link, and do not show the raw link
-                for product in products_latest:
-                    title = product.get('title', '')
-                    title_lower = title.lower()
-                    link = generate_product_link(product)
-                    if title and link and title_lower in answer.lower():
-                        answer = re.sub(rf'(?<!\[){re.escape(title)}(?!\])', f'[{title}]({link})', answer)
-
-        # Append bot response to chat history and save
-        chat_history.append({'role': 'bot', 'message': answer})
-        save_chat_history(user_id, chat_history)
-
-        return jsonify({'response': answer})
-    except Exception as e:
-        print('Unexpected error:', e)
-        return jsonify({'error': 'An unexpected error occurred.'}), 500
+                lines.append(f"🏷️ **{title}** is not on sale right now ({currency_symbol}{price}).")
+        elif intent == 'link':
+            link = generate_product_link(p)
+            if link:
+                lines.append(f"🔗 {title}: {link}")
+    return '\n'.join(lines)
 
-# (Optional) Endpoint to fetch chat history for a user
-@app.route('/history', methods=['POST'])
-def get_history():
-    data = request.get_json(silent=True)
-    user_id = data.get('user_id', 'default_user') if data else 'default_user'
-    history = get_chat_history(user_id)
-    return jsonify({'history': history})
+def speculative_gemini_answer(question, conversation, products):
+    """Gemini answer to a predicted follow-up question, or None if unusable."""
+    snapshot = current_catalog()
+    history = conversation.history + [{'role': 'user', 'message': question}]
+    turn = prepare_chat_turn(question, history, products, unavailable_for_ranking(snapshot))
+    answer = query_gemini(question, turn['context'], temperature=turn['temperature'])
+    if gemini_answer_unusable(answer, turn):
+        return None
+    return linkify_answer(answer, products)
 
-if __name__ == "__main__":
-    import sys
-    print("Fetching initial product data...")
-    fetch_latest_products()
-    print("Initial product data loaded.")
-
-    # If 'api' is passed as an argument, run Flask API
-    if len(sys.argv) > 1 and sys.argv[1] == 'api':
-        app.run(host="0.0.0.0", port=int(os.getenv("PORT", 5000)))
-    else:
-        print("Welcome to Starky Shop Chatbot! Type 'quit' to exit.\n")
-        chat_history = []
-        while True:
-            user_query = input("You: ").strip()
-            if user_query.lower() in ['quit', 'exit', 'bye']:
-                print("Goodbye!")
-                break
+def gemini_has_spare_capacity():
+    if not GEMINI_API_KEY:
+        return False
+    return not admission.enabled or admission.gate.in_flight < admission.gate.limit // 2
+
+prefetcher = Prefetcher(follow_up_answer, speculative_gemini_answer if PREFETCH_GEMINI else None,
+                        gemini_has_spare_capacity, budget_ms=PREFETCH_BUDGET_MS,
+                        gemini_max_inflight=PREFETCH_GEMINI_MAX_INFLIGHT) if PREFETCH_ENABLED else None
+
+def schedule_prefetch(conversation, products, snapshot):
+    """Start precomputing likely follow-up answers for the turn just answered."""
+    if prefetcher is not None:
+        prefetcher.schedule(conversation, products, snapshot.version)
+
+def prefetched_answer(conversation, user_query, snapshot):
+    """The prefetched answer for this follow-up, or None."""
+    if prefetcher is None or conversation is None:
+        return None
+    with metrics.span('prefetch'):
+        return prefetcher.lookup(conversation, user_query, snapshot.version)
+
+def client_address(forwarded_for, remote_addr):
+    """The shopper's address: first X-Forwarded-For hop (behind Render's proxy), else the peer."""
+    return (forwarded_for or '').split(',')[0].strip() or remote_addr
+
+def admission_key(user_id, client=None):
+    """Rate-limit key of a chat request. The storefront widget sends no user_id, so anonymous
+    requests (`default_user`) are keyed by client address instead of sharing one bucket."""
+    if user_id == 'default_user' and client:
+        user_id = f"anon:{client}"
+    return current_tenant().qualify(user_id)
+
+def answer_chat_turn(user_query, chat_history, products, unavailable=None, top_k=None, user_id='default_user',
+                     conversation=None, client=None):
+    """Run one turn through Gemini with local fallback and return the answer.
+    `client` is the requester's address, used to rate-limit anonymous users."""
+    cached = prefetched_answer(conversation, user_query, current_catalog())
+    if cached:
+        return cached
+    turn = prepare_chat_turn(user_query, chat_history, products, unavailable, top_k, conversation)
+    with metrics.span('admission'):
+        decision = admission.acquire(admission_key(user_id, client))
+    if decision != ADMITTED:
+        return answer_shed_turn(user_query, turn, products)
+    start = time.perf_counter()
+    try:
+        with metrics.span('gemini'):
+            answer = query_gemini(user_query, turn['context'], temperature=turn['temperature'])
+        if gemini_answer_unusable(answer, turn):
+            metrics.inc('chat_fallbacks_total')
+            with metrics.span('fallback'):
+                answer = local_fallback_answer(user_query, turn, products)
+                return rewrite_with_gemini(answer)
+    finally:
+        admission.release(time.perf_counter() - start)
+    with metrics.span('linkify'):
+        return linkify_answer(answer, products)
+
+def linkify_answer(answer, products):
+    """Replace product names with clickable markdown links, without showing the raw link."""
+    for product in products:
+        title = product.get('title', '')
+        title_lower = title.lower()
+        link = generate_product_link(product)
+        if title and link and title_lower in answer.lower():
+            answer = re.sub(rf'(?<!\[){re.escape(title)}(?!\])', f'[{title}]({link})', answer)
+    return answer
+
+
+# Batch processing (/chat/batch)
+
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "1000"))
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))
+
+_batch_scorer_lock = threading.Lock()
+
+def batch_scorer_for(snapshot):
+    """Vectorized scorer over the snapshot's whole catalog, built once per catalog version
+    (availability is applied per query, so inventory changes do not rebuild it).
+    Cached per shop, so it is dropped with the rest of an unloaded tenant's catalog."""
+    from batch_scoring import BatchScorer
+    caches = current_tenant().caches
+    with _batch_scorer_lock:
+        cached = caches.get('batch_scorer')  # (catalog version, BatchScorer)
+        if cached is not None and cached[0] == snapshot.version:
+            metrics.inc('cache_hits_total', cache='batch_scorer')
+            return cached[1]
+    metrics.inc('cache_misses_total', cache='batch_scorer')
+    # Built outside the lock: a concurrent request for another shop's or version's scorer is not held up
+    scorer = BatchScorer(snapshot.products)
+    with _batch_scorer_lock:
+        caches['batch_scorer'] = (snapshot.version, scorer)
+    return scorer
+
+def products_page(params):
+    """GET /products: one page of products (of one collection when `collection`
+    is given), continuing from `cursor`. Returns (status, payload)."""
+    snapshot = current_catalog()
+    index = browse_index_for(snapshot, chat_products(snapshot))
+    try:
+        limit = max(1, min(int(params.get('limit') or BROWSE_API_LIMIT), BROWSE_API_MAX_LIMIT))
+    except ValueError:
+        return 400, {'error': 'Invalid limit'}
+    listing = index.listing(params.get('collection'))
+    if listing is None:
+        return 404, {'error': 'Unknown collection'}
+    try:
+        page = index.page(listing, cursor=params.get('cursor'), limit=limit)
+    except InvalidCursor:
+        return 400, {'error': 'Invalid cursor'}
+    metrics.inc('browse_pages_total', source='api')
+    availability = snapshot.availability
+    items = [dict(index.item(p), available=availability.is_available(p.get('id'))) for p in page.products]
+    return 200, {'products': items, 'total': page.total, 'collection': page.listing.collection,
+                 'currency': snapshot.currency, 'next_cursor': page.next_cursor}
+
+def collections_summary():
+    """GET /collections: the current shop's collections with product counts."""
+    snapshot = current_catalog()
+    return {'collections': browse_index_for(snapshot, chat_products(snapshot)).collection_summaries()}
+
+def _batch_item_error(item):
+    """Why a /chat/batch item cannot be answered, or None."""
+    if not isinstance(item, dict):
+        return 'Item must be an object'
+    if not isinstance(item.get('user_id') or '', str):
+        return 'user_id must be a string'
+    message = item.get('message')
+    if message is not None and not isinstance(message, str):
+        return 'message must be a string'
+    if not (message or '').strip():
+        return 'No message provided'
+    return None
+
+def process_chat_batch(items, client=None):
+    """Answer many {user_id, message} items against one catalog snapshot.
+
+    Items are validated up front. Top-k for every message is computed in one
+    vectorized pass. Every item goes through admission control like a /chat
+    request (its user's rate limit and a global Gemini slot, anonymous items
+    keyed by `client`); a shed item is answered by the local engine. Items
+    of the same user run in order (each
+    sees the previous turns) and that user's history is written once;
+    different users run concurrently in a bounded pool. A failed item leaves
+    no trace in the history. Returns per-item results in input order.
+    """
+    snapshot = current_catalog()
+    products = chat_products(snapshot)
+    unavailable = unavailable_for_ranking(snapshot)
+
+    results = [None] * len(items)
+    by_user = {}
+    valid = []
+    for i, item in enumerate(items):
+        error = _batch_item_error(item)
+        if error:
+            user_id = item.get('user_id') if isinstance(item, dict) else None
+            results[i] = {'index': i, 'user_id': user_id if isinstance(user_id, str) else None,
+                          'status': 'error', 'error': error, 'elapsed_ms': 0.0}
+            continue
+        valid.append(i)
+        by_user.setdefault(item.get('user_id') or 'default_user', []).append((i, item['message']))
+
+    with metrics.span('top_k'):
+        exclude = snapshot.availability.unavailable_ids if AVAILABILITY_MODE == 'filter' else None
+        top_ks = batch_scorer_for(snapshot).top_k_many(
+            [items[i]['message'] for i in valid], k=12, unavailable=unavailable, exclude=exclude,
+            unavailable_penalty=AVAILABILITY_RANK_PENALTY)
+    top_k_by_index = dict(zip(valid, top_ks))
+
+    def run_user(user_id, user_items):
+        # Runs in its own copy of the request context
+        logging_setup.bind(user_id=user_id)
+        conversation = get_conversation(user_id)
+        for i, message in user_items:
+            start = time.perf_counter()
+            # The prompt's chat history needs the message, but it is only kept once answered
+            pending = conversation.add_user(message)
             try:
-                products_latest = load_products_from_disk()
-            except Exception as e:
-                print("Error loading products:", e)
-                products_latest = []
-
-            # Build minimal context and use Gemini first
-            context_messages = []
-            for msg in chat_history[-10:]:
-                prefix = 'User:' if msg['role'] == 'user' else 'Bot:'
-                context_messages.append(f"{prefix} {msg['message']}")
-            context = format_product_data_for_prompt(products_latest)
-            if context_messages:
-                context = f"Chat History:\n{chr(10).join(context_messages)}\n\nProduct Catalog:\n{context}"
-
-            answer = query_gemini(user_query, context)
-            if not answer or len(answer.strip()) < 5:
-                answer = generate_chatbot_response(user_query, products_latest)
-
-            chat_history.append({'role': 'user', 'message': user_query})
-            chat_history.append({'role': 'bot', 'message': answer})
-            print(f"Bot: {answer}\n")
+                answer = answer_chat_turn(message, conversation.history, products, unavailable, top_k_by_index[i],
+                                          user_id=user_id, conversation=conversation, client=client)
+            except Exception:
+                conversation.discard(pending)
+                log.exception('chat_batch_item_failed', extra={'index': i})
+                results[i] = {'index': i, 'user_id': user_id, 'status': 'error',
+                              'error': 'An unexpected error occurred.'}
+            else:
+                conversation.add_bot(answer)
+                results[i] = {'index': i, 'user_id': user_id, 'status': 'ok', 'response': answer}
+            results[i]['elapsed_ms'] = round((time.perf_counter() - start) * 1000.0, 2)
+        # One grouped write per user
+        persist_conversation(conversation)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(BATCH_CONCURRENCY, len(by_user) or 1))) as pool:
+        # Each worker runs in a copy of this context so the current tenant carries over
+        futures = [pool.submit(contextvars.copy_context().run, run_user, uid, user_items)
+                   for uid, user_items in by_user.items()]
+        for future in futures:
+            future.result()
+
+    for r in results:
+        metrics.inc('chat_batch_items_total', status=r['status'])
+    return results
+
+def __getattr__(name):
+    # The Flask app (flask_app.py) is built on first use of `app.app`, so the
+    # CLI and the ASGI server never import Flask
+    if name == 'app':
+        from flask_app import app as flask_app
+        return flask_app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,392 @@
+"""Production ASGI serving mode for the chat API.
+
+Same endpoints and chat engine (app.py) as the Flask app in flask_app.py,
+but handlers are async: Gemini is called through a shared `httpx.AsyncClient`, so a request
+waiting on the LLM does not hold a thread. Each worker loads the catalog
+snapshot once at startup (other shops' on first use, see tenants.py) and
+refreshes it in the background; chat histories are saved in the
+background and pending writes are flushed on graceful shutdown.
+
+Run with:
+    python app.py serve            # WEB_CONCURRENCY workers, PORT port
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+from contextvars import ContextVar
+from urllib.parse import parse_qsl
+
+import httpx
+
+import app as chat
+import logging_setup
+import metrics
+import profiling
+
+GEMINI_TIMEOUT = float(os.getenv("GEMINI_TIMEOUT", "30"))
+GEMINI_MAX_CONNECTIONS = int(os.getenv("GEMINI_MAX_CONNECTIONS", "100"))
+GRACEFUL_SHUTDOWN_TIMEOUT = int(os.getenv("GRACEFUL_SHUTDOWN_TIMEOUT", "30"))
+
+log = logging.getLogger(__name__)
+
+# Address of the client the current request came from (rate-limit key for anonymous users)
+_client = ContextVar('client', default=None)
+
+# Per-worker state, populated by the lifespan startup handler
+_gemini_client = None
+_history_writer = None
+
+
+class HistoryWriter:
+    """Background chat-history writer over the shared conversation store.
+
+    `get()` returns the user's cached `Conversation`; `put()` returns
+    immediately and the save runs on a worker thread. Saves for the same
+    conversation are coalesced so only the latest history is written, and
+    `flush()` waits for everything in flight so a graceful shutdown loses
+    no turns. Writes start straight away (rather than on a timer) so other
+    workers reading from disk stay current.
+    """
+
+    def __init__(self):
+        self._writing = {}   # conversation key -> task currently saving it
+
+    async def get(self, user_id):
+        return await asyncio.to_thread(chat.conversations.get, user_id, chat.current_tenant())
+
+    def put(self, conversation):
+        key = conversation.key
+        if key not in self._writing:
+            self._writing[key] = asyncio.create_task(self._drain(conversation))
+
+    async def _drain(self, conversation):
+        try:
+            # Turns added while a save was running are picked up by the next pass
+            while conversation.dirty:
+                try:
+                    await asyncio.to_thread(chat.conversations.save, conversation)
+                except Exception as e:
+                    log.warning('history_save_failed', extra={'user_id': conversation.key[1], 'error': str(e)})
+                    break
+        finally:
+            self._writing.pop(conversation.key, None)
+
+    async def flush(self):
+        """Wait until every pending history write has reached disk."""
+        while self._writing:
+            await asyncio.gather(*list(self._writing.values()), return_exceptions=True)
+
+
+async def query_gemini_async(user_query, context, temperature: float = 0.3):
+    if not chat.GEMINI_API_KEY:
+        metrics.inc('gemini_calls_total', kind='answer', outcome='skipped')
+        return ""
+    body = chat.build_gemini_answer_body(user_query, context, temperature)
+    try:
+        res = await _gemini_client.post(chat.GEMINI_API_URL, json=body)
+        res.raise_for_status()
+        reply = chat.gemini_reply_text(res.json())
+        metrics.inc('gemini_calls_total', kind='answer', outcome='ok')
+        return reply
+    except Exception as e:
+        metrics.inc('gemini_calls_total', kind='answer', outcome='error')
+        log.warning('gemini_error', extra={'kind': 'answer', 'error': str(e)})
+        return ""
+
+
+async def rewrite_with_gemini_async(text: str) -> str:
+    if not chat.GEMINI_API_KEY or not text:
+        return text
+    metrics.inc('gemini_rewrites_total')
+    body = chat.build_gemini_rewrite_body(text)
+    try:
+        res = await _gemini_client.post(chat.GEMINI_API_URL, json=body)
+        res.raise_for_status()
+        reply = chat.gemini_reply_text(res.json())
+        metrics.inc('gemini_calls_total', kind='rewrite', outcome='ok')
+        return reply
+    except Exception as e:
+        metrics.inc('gemini_calls_total', kind='rewrite', outcome='error')
+        log.warning('gemini_error', extra={'kind': 'rewrite', 'error': str(e)})
+        return text
+
+
+async def _answer_turn(user_query, user_id, conversation, snapshot, products_latest):
+    cached = chat.prefetched_answer(conversation, user_query, snapshot)
+    if cached:
+        return cached
+
+    turn = await asyncio.to_thread(chat.prepare_chat_turn, user_query, conversation.history, products_latest,
+                                   chat.unavailable_for_ranking(snapshot), conversation=conversation)
+    with metrics.span('admission'):
+        decision = await chat.admission.acquire_async(chat.admission_key(user_id, _client.get()))
+    if decision != chat.ADMITTED:
+        return await asyncio.to_thread(chat.answer_shed_turn, user_query, turn, products_latest)
+    start = time.perf_counter()
+    try:
+        with metrics.span('gemini'):
+            answer = await query_gemini_async(user_query, turn['context'], temperature=turn['temperature'])
+        if chat.gemini_answer_unusable(answer, turn):
+            metrics.inc('chat_fallbacks_total')
+            with metrics.span('fallback'):
+                answer = await asyncio.to_thread(chat.local_fallback_answer, user_query, turn, products_latest)
+                return await rewrite_with_gemini_async(answer)
+    finally:
+        chat.admission.release(time.perf_counter() - start)
+    with metrics.span('linkify'):
+        return await asyncio.to_thread(chat.linkify_answer, answer, products_latest)
+
+
+async def handle_chat(data):
+    # Catalog loads, retrieval and answer formatting are CPU/disk bound: keep them off the event loop
+    snapshot = await asyncio.to_thread(chat.current_catalog)
+    products_latest = chat.chat_products(snapshot)
+    user_query = data.get('message', '') if data else ''
+    user_id = data.get('user_id', 'default_user') if data else 'default_user'
+    logging_setup.bind(user_id=user_id)
+    if not user_query:
+        return 400, {'error': 'No message provided'}
+
+    with metrics.span('history_load'):
+        conversation = await _history_writer.get(user_id)
+    # The prompt's chat history needs the message, but it is only kept once answered
+    pending = conversation.add_user(user_query)
+    try:
+        answer = await _answer_turn(user_query, user_id, conversation, snapshot, products_latest)
+    except BaseException:
+        # Also on cancellation: a turn without an answer must not reach the next prompt
+        conversation.discard(pending)
+        raise
+
+    conversation.add_bot(answer)
+    with metrics.span('history_save'):
+        _history_writer.put(conversation)
+    chat.schedule_prefetch(conversation, products_latest, snapshot)
+    return 200, {'response': answer}
+
+
+async def handle_chat_batch(data):
+    items = data.get('items') if isinstance(data, dict) else None
+    if not isinstance(items, list) or not items:
+        return 400, {'error': 'No items provided'}
+    if len(items) > chat.BATCH_MAX_ITEMS:
+        return 400, {'error': f'Too many items (max {chat.BATCH_MAX_ITEMS})'}
+    start = time.perf_counter()
+    results = await asyncio.to_thread(chat.process_chat_batch, items, _client.get())
+    return 200, {'results': results, 'elapsed_ms': round((time.perf_counter() - start) * 1000.0, 2)}
+
+
+async def handle_history(data):
+    user_id = data.get('user_id', 'default_user') if data else 'default_user'
+    conversation = await _history_writer.get(user_id)
+    return 200, {'history': list(conversation.history)}
+
+
+async def handle_products(params):
+    return chat.products_page(params or {})
+
+
+async def handle_collections(params):
+    return 200, chat.collections_summary()
+
+
+async def handle_products_webhook(data):
+    try:
+        log.info('catalog_webhook_received')
+        await asyncio.to_thread(chat.current_tenant().refresher.trigger)
+        metrics.inc('webhook_refreshes_total', outcome='ok')
+        return 200, {'status': 'success'}
+    except Exception:
+        metrics.inc('webhook_refreshes_total', outcome='error')
+        log.exception('catalog_webhook_failed')
+        return 500, {'error': 'Webhook processing failed'}
+
+
+async def handle_inventory_webhook(data):
+    try:
+        applied = chat.apply_inventory_level_update(data or {})
+        return 200, {'status': 'success' if applied else 'ignored'}
+    except Exception:
+        log.exception('inventory_webhook_failed')
+        return 500, {'error': 'Webhook processing failed'}
+
+
+ROUTES = {
+    ('POST', '/chat'): handle_chat,
+    ('POST', '/chat/batch'): handle_chat_batch,
+    ('POST', '/history'): handle_history,
+    ('GET', '/products'): handle_products,
+    ('GET', '/collections'): handle_collections,
+    ('POST', '/webhook/products'): handle_products_webhook,
+    ('POST', '/webhook/inventory_levels'): handle_inventory_webhook,
+}
+
+
+def _cors_headers(path):
+    origin = '*' if path.startswith('/webhook/') else chat.current_tenant().allowed_origin
+    return [
+        (b'access-control-allow-origin', origin.encode()),
+        (b'vary', b'Origin'),
+        (b'access-control-allow-headers', b'Content-Type, Authorization'),
+        (b'access-control-allow-methods', b'GET, POST, OPTIONS'),
+        (b'access-control-max-age', b'3600'),
+    ]
+
+
+async def _send(send, status, body=b'', content_type=b'application/json', headers=None):
+    all_headers = [(b'content-type', content_type), (b'content-length', str(len(body)).encode())]
+    all_headers.extend(headers or [])
+    await send({'type': 'http.response.start', 'status': status, 'headers': all_headers})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def _read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            break
+    return b''.join(chunks)
+
+
+async def _lifespan(receive, send):
+    global _gemini_client, _history_writer
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            try:
+                _gemini_client = httpx.AsyncClient(
+                    timeout=GEMINI_TIMEOUT,
+                    limits=httpx.Limits(max_connections=GEMINI_MAX_CONNECTIONS),
+                    headers={'Content-Type': 'application/json'},
+                )
+                _history_writer = HistoryWriter()
+                # Serve the on-disk snapshot at once; revalidate in the background
+                await asyncio.to_thread(chat.tenant_registry.start)
+                log.info('worker_started', extra={'pid': os.getpid(),
+                                                  'products': len(chat.current_catalog().products)})
+                await send({'type': 'lifespan.startup.complete'})
+            except Exception as e:
+                await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                return
+        elif message['type'] == 'lifespan.shutdown':
+            chat.tenant_registry.stop()
+            if chat.prefetcher:
+                chat.prefetcher.shutdown()
+            if _history_writer:
+                await _history_writer.flush()
+            # Batch turns are written by the conversation store's own flusher
+            await asyncio.to_thread(chat.conversations.stop)
+            if _gemini_client:
+                await _gemini_client.aclose()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+
+    method, path = scope['method'], scope['path']
+    request_headers = {k.decode('latin-1').lower(): v.decode('latin-1') for k, v in scope.get('headers', [])}
+    started = time.perf_counter()
+    request_id = request_headers.get('x-request-id') or logging_setup.new_request_id()
+    logging_setup.bind(request_id=request_id, path=path)
+    _client.set(chat.client_address(request_headers.get('x-forwarded-for'), (scope.get('client') or (None,))[0]))
+    shop_domain = request_headers.get('x-shopify-shop-domain')
+    tenant = chat.tenant_registry.resolve(shop_domain=shop_domain, origin=request_headers.get('origin'))
+    # Each request runs in its own task/context, so the tenant does not leak between requests
+    chat.tenant_registry.activate(tenant or chat.default_tenant)
+    cors = _cors_headers(path)
+    if method == 'OPTIONS':
+        await _send(send, 204, headers=cors)
+        return
+    if path == '/favicon.ico':
+        await _send(send, 204)
+        return
+    if method == 'GET' and path == '/metrics':
+        await _send(send, 200, metrics.render_prometheus().encode(),
+                    content_type=b'text/plain; version=0.0.4; charset=utf-8')
+        return
+
+    handler = ROUTES.get((method, path))
+    if handler is None:
+        await _send(send, 404, json.dumps({'error': 'Not found'}).encode(), headers=cors)
+        return
+
+    raw = await _read_body(receive)
+    if method == 'GET':
+        data = dict(parse_qsl(scope.get('query_string', b'').decode('latin-1')))
+    else:
+        try:
+            data = json.loads(raw) if raw else None
+        except ValueError:
+            data = None
+    if not shop_domain and isinstance(data, dict) and data.get('shop'):
+        tenant = chat.tenant_registry.resolve(shop=data['shop'])
+    if tenant is None:
+        await _send(send, 404, json.dumps({'error': 'Unknown shop'}).encode(), headers=cors)
+        return
+    chat.tenant_registry.activate(tenant)
+    logging_setup.bind(shop=tenant.domain)
+    if path.startswith('/webhook/') and not chat.verify_webhook(raw, request_headers.get('x-shopify-hmac-sha256')):
+        metrics.inc('webhook_rejected_total')
+        await _send(send, 401, json.dumps({'error': 'Invalid webhook signature'}).encode(), headers=cors)
+        return
+
+    # Profiles cover everything the event loop runs meanwhile, including other requests
+    # (stages offloaded with asyncio.to_thread are not sampled)
+    capture = None
+    if path == '/chat':
+        capture = profiling.start_capture(request_headers.get(profiling.PROFILE_HEADER.lower()))
+    chat.tenant_registry.acquire(tenant)
+    metrics.begin_request()
+    # 499: the client went away and the task was cancelled before the handler returned
+    status, payload = 499, None
+    try:
+        status, payload = await handler(data)
+    except Exception:
+        log.exception('chat_failed' if path == '/chat' else 'request_failed')
+        status, payload = 500, {'error': 'An unexpected error occurred.'}
+    finally:
+        # Also runs on cancellation so the profiler is never left enabled
+        chat.tenant_registry.release(tenant)
+        spans = metrics.end_request()
+        if capture is not None:
+            data = data if isinstance(data, dict) else {}
+            snapshot = tenant.store.get() if tenant.store is not None else None
+            capture.finish(path=path, query=data.get('message'), user_id=data.get('user_id', 'default_user'),
+                           shop=tenant.domain, catalog_version=getattr(snapshot, 'version', None), status=status)
+
+    headers = list(cors)
+    headers.append((b'x-request-id', request_id.encode('latin-1')))
+    if capture is not None:
+        headers.append((b'x-profile-id', capture.id.encode()))
+    if path == '/chat':
+        metrics.inc('chat_requests_total', status=status)
+        if chat.SERVER_TIMING and spans:
+            headers.append((b'server-timing', metrics.server_timing_header(spans).encode()))
+        logging_setup.log_request(log, 'chat_request', status, time.perf_counter() - started, spans)
+    await _send(send, status, json.dumps(payload).encode(), headers=headers)
+
+
+def run_server(host="0.0.0.0", port=None, workers=None):
+    """Serve `application` with uvicorn; blocks until shutdown."""
+    import uvicorn
+    uvicorn.run(
+        "asgi_app:application",
+        host=host,
+        port=port or int(os.getenv("PORT", 5000)),
+        workers=workers or int(os.getenv("WEB_CONCURRENCY", 1)),
+        lifespan="on",
+        timeout_graceful_shutdown=GRACEFUL_SHUTDOWN_TIMEOUT,
+        app_dir=os.path.dirname(os.path.abspath(__file__)),
+    )
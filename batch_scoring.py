@@ -0,0 +1,233 @@
+"""Vectorized relevance scoring of the whole catalog with NumPy.
+
+`BatchScorer` reproduces `score_product_relevance` for every product in one
+pass. Each weighted field (title, vendor, tags, product_type, description
+text) is kept as a sparse word -> product postings list; price and color
+data are kept as columns. Postings are computed on first use with
+substring search over the joined field text, so matching semantics are
+identical to the per-product scorer, and the most recently used ones are
+kept (POSTINGS_CACHE_SIZE words).
+"""
+import re
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from catalog import extract_colors_from_product, extract_price_range, normalize_text, product_text
+
+# Same fields and weights as score_product_relevance
+FIELD_WEIGHTS = (
+    (lambda p: normalize_text(p.get('title')), 5.0),
+    (lambda p: normalize_text(p.get('vendor')), 2.0),
+    (lambda p: normalize_text(p.get('tags')), 2.0),
+    (lambda p: normalize_text(p.get('product_type')), 1.5),
+    (lambda p: product_text(p).search_text, 1.0),
+)
+COLOR_BOOST = 6.0
+PRICE_IN_RANGE_BOOST = 4.0
+PRICE_OUT_OF_RANGE_PENALTY = 2.0
+# Query words whose postings are kept per scorer
+POSTINGS_CACHE_SIZE = 20000
+
+_SEP = '\x00'  # never produced by \w+, so matches cannot span two products
+
+
+def _query_words(query: str):
+    q = normalize_text(query)
+    return q, [w for w in re.findall(r"\w+", q) if len(w) > 2]
+
+
+class _FieldText:
+    """One weighted field of every product joined into a single searchable string."""
+
+    def __init__(self, values):
+        self.text = _SEP.join(values)
+        starts = np.zeros(len(values), dtype=np.int64)
+        pos = 0
+        for i, v in enumerate(values):
+            starts[i] = pos
+            pos += len(v) + 1
+        self.starts = starts
+
+    def products_containing(self, word: str) -> np.ndarray:
+        """Indices of products whose field contains `word` as a substring."""
+        hits = []
+        text = self.text
+        i = text.find(word)
+        while i != -1:
+            hits.append(i)
+            i = text.find(word, i + 1)
+        if not hits:
+            return np.empty(0, dtype=np.int64)
+        rows = np.searchsorted(self.starts, np.asarray(hits, dtype=np.int64), side='right') - 1
+        return np.unique(rows)
+
+
+class BatchScorer:
+    """Scores a fixed product list against one or many queries at once.
+
+    Build once per catalog snapshot; the object is read-only afterwards apart
+    from its bounded postings cache.
+    """
+
+    def __init__(self, products: list, warm: bool = False):
+        self.products = list(products)
+        n = len(self.products)
+        self.size = n
+
+        self._fields = [
+            (_FieldText([get(p) for p in self.products]), weight)
+            for get, weight in FIELD_WEIGHTS
+        ]
+        # word -> (product indices, weights), least recently used first
+        self._postings = OrderedDict()
+        self._postings_lock = threading.Lock()
+
+        # Price column (first variant), NaN when missing or unparsable
+        prices = np.full(n, np.nan, dtype=np.float64)
+        for i, p in enumerate(self.products):
+            v = (p.get('variants') or [{}])[0]
+            price = v.get('price')
+            try:
+                prices[i] = float(str(price)) if price is not None else np.nan
+            except Exception:
+                pass
+        self.prices = prices
+
+        # Color column: distinct lowercase color -> count per product
+        color_index = {}
+        color_rows, color_cols = [], []
+        for i, p in enumerate(self.products):
+            for c in extract_colors_from_product(p):
+                c = c.lower()
+                if not c:
+                    continue
+                color_rows.append(color_index.setdefault(c, len(color_index)))
+                color_cols.append(i)
+        self.colors = list(color_index)
+        counts = np.zeros((len(self.colors), n), dtype=np.float64)
+        if color_rows:
+            np.add.at(counts, (np.asarray(color_rows), np.asarray(color_cols)), 1.0)
+        self._color_counts = counts
+
+        if warm:
+            self.warm()
+
+    def warm(self, words=None):
+        """Precompute postings for `words`, or for every word in the catalog
+        (costly on large catalogs: one scan of the catalog text per word)."""
+        if words is None:
+            words = set()
+            for field, _ in self._fields:
+                words.update(w for w in re.findall(r"\w+", field.text) if len(w) > 2)
+        for w in words:
+            self._posting(w)
+
+    def _posting(self, word: str):
+        with self._postings_lock:
+            entry = self._postings.get(word)
+            if entry is not None:
+                self._postings.move_to_end(word)
+                return entry
+        idx_parts, weight_parts = [], []
+        for field, weight in self._fields:
+            rows = field.products_containing(word)
+            if rows.size:
+                idx_parts.append(rows)
+                weight_parts.append(np.full(rows.size, weight))
+        if idx_parts:
+            entry = (np.concatenate(idx_parts), np.concatenate(weight_parts))
+        else:
+            entry = (np.empty(0, dtype=np.int64), np.empty(0))
+        with self._postings_lock:
+            self._postings[word] = entry
+            if len(self._postings) > POSTINGS_CACHE_SIZE:
+                self._postings.popitem(last=False)
+        return entry
+
+    def score(self, query: str) -> np.ndarray:
+        """Relevance of every product for one query, in catalog order."""
+        return self.score_many([query])[0]
+
+    def score_many(self, queries: list) -> np.ndarray:
+        """Relevance matrix of shape (len(queries), len(products))."""
+        n = self.size
+        nq = len(queries)
+        if nq == 0 or n == 0:
+            return np.zeros((nq, n))
+
+        flat_idx, flat_w = [], []
+        color_hits = np.zeros((nq, len(self.colors)))
+        pmins = np.full(nq, np.nan)
+        pmaxs = np.full(nq, np.nan)
+        for qi, query in enumerate(queries):
+            q, words = _query_words(query)
+            for w in words:
+                idx, weights = self._posting(w)
+                if idx.size:
+                    flat_idx.append(idx + qi * n)
+                    flat_w.append(weights)
+            for ci, c in enumerate(self.colors):
+                if c in q:
+                    color_hits[qi, ci] = 1.0
+            pmin, pmax = extract_price_range(q)
+            if pmin is not None:
+                pmins[qi] = pmin
+            if pmax is not None:
+                pmaxs[qi] = pmax
+
+        # Keyword part: scatter-add all postings in one bincount
+        if flat_idx:
+            scores = np.bincount(
+                np.concatenate(flat_idx), weights=np.concatenate(flat_w), minlength=nq * n
+            ).reshape(nq, n)
+        else:
+            scores = np.zeros((nq, n))
+
+        if self.colors:
+            scores += COLOR_BOOST * (color_hits @ self._color_counts)
+
+        # Price hint, only where the product has a price and the query a range
+        prices = self.prices[np.newaxis, :]
+        has_min = ~np.isnan(pmins)[:, np.newaxis]
+        has_max = ~np.isnan(pmaxs)[:, np.newaxis]
+        has_price = ~np.isnan(prices)
+        active = has_price & (has_min | has_max)
+        with np.errstate(invalid='ignore'):
+            below = has_min & (prices < pmins[:, np.newaxis])
+            above = has_max & (prices > pmaxs[:, np.newaxis])
+        in_range = ~below & ~above
+        adjust = (
+            -PRICE_OUT_OF_RANGE_PENALTY * below
+            - PRICE_OUT_OF_RANGE_PENALTY * above
+            + PRICE_IN_RANGE_BOOST * in_range
+        )
+        scores += np.where(active, adjust, 0.0)
+        return scores
+
+    def top_k(self, query: str, k: int = 12, unavailable=None, exclude=None, unavailable_penalty=5.0) -> list:
+        """Same ordering as select_top_k_products (stable on ties)."""
+        return self.top_k_many([query], k, unavailable, exclude, unavailable_penalty)[0]
+
+    def top_k_many(self, queries: list, k: int = 12, unavailable=None, exclude=None,
+                   unavailable_penalty=5.0) -> list:
+        """Top-k per query; products whose id is in `unavailable` lose
+        `unavailable_penalty` points and products whose id is in `exclude` are left out."""
+        scores = self.score_many(queries)
+        if unavailable:
+            is_unavailable = np.array([p.get('id') in unavailable for p in self.products])
+            scores = scores - unavailable_penalty * is_unavailable[np.newaxis, :]
+        if exclude:
+            allowed = np.flatnonzero([p.get('id') not in exclude for p in self.products])
+        results = []
+        for row in scores:
+            if unavailable:
+                # lexsort: last key is primary -> score, then available first on ties
+                order = np.lexsort((is_unavailable, -row))
+            else:
+                order = np.argsort(-row, kind='stable')
+            if exclude:
+                order = order[np.isin(order, allowed)]
+            results.append([self.products[i] for i in order[:k]])
+        return results
@@ -0,0 +1,207 @@
+"""Collection-aware product browsing with cursor pagination.
+
+A `BrowseIndex` is built once per catalog snapshot (and product list): the
+products of each collection in catalog order, plus lookups by collection
+id, title and handle. Listings are read a page at a time through opaque
+cursors, and rendered chat cards / API items are cached per product and
+per page, so a page costs the same however large the catalog is.
+
+Cursors are URL-safe base64 of a small JSON object holding the snapshot
+version, the collection, the offset and the id of the last product served.
+Against the same snapshot the offset is used directly; after a catalog
+update the listing resumes after that product instead.
+"""
+import base64
+import binascii
+import json
+import re
+import threading
+
+import metrics
+
+# Rendered pages kept per index
+PAGE_CACHE_SIZE = 256
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(version, collection_id, offset, after_id):
+    raw = json.dumps({'v': version, 'c': collection_id, 'o': offset, 'a': after_id}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def _is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def decode_cursor(cursor):
+    """(version, collection id, offset, last product id); InvalidCursor for anything
+    that `encode_cursor` could not have produced."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        data = json.loads(raw)
+        version, collection_id, offset, after_id = data['v'], data['c'], data['o'], data['a']
+        if not (_is_int(version) and _is_int(offset) and offset >= 0
+                and (collection_id is None or _is_int(collection_id))
+                and (after_id is None or _is_int(after_id) or isinstance(after_id, str))):
+            raise ValueError('malformed cursor fields')
+        return version, collection_id, offset, after_id
+    except (binascii.Error, ValueError, TypeError, KeyError) as e:
+        raise InvalidCursor(f"Invalid cursor: {cursor!r}") from e
+
+
+def _handle(title):
+    return re.sub(r'[^a-z0-9]+', '-', (title or '').lower()).strip('-')
+
+
+class Listing:
+    """The products of one collection (or the whole catalog) in order."""
+
+    __slots__ = ('collection', 'products', 'positions')
+
+    def __init__(self, collection, products):
+        self.collection = collection  # {'id', 'title', 'type'} or None for all products
+        self.products = products
+        self.positions = {p.get('id'): i for i, p in enumerate(products)}
+
+    @property
+    def collection_id(self):
+        return self.collection.get('id') if self.collection else None
+
+    @property
+    def title(self):
+        return self.collection.get('title') if self.collection else None
+
+
+class Page:
+    __slots__ = ('listing', 'start', 'products', 'next_cursor')
+
+    def __init__(self, listing, start, products, next_cursor):
+        self.listing = listing
+        self.start = start
+        self.products = products
+        self.next_cursor = next_cursor
+
+    @property
+    def total(self):
+        return len(self.listing.products)
+
+
+class BrowseIndex:
+    """Collection -> products index over one product list, with page caches.
+
+    `render_card(product)` and `render_item(product)` produce the chat card
+    and the API item of a product; each is called at most once per product.
+    """
+
+    def __init__(self, products, version=0, render_card=None, render_item=None):
+        self.version = version
+        self._render_card = render_card
+        self._render_item = render_item
+        self.all = Listing(None, products)
+        members, collections = {}, {}
+        for p in products:
+            for c in p.get('collections') or []:
+                cid = c.get('id')
+                if cid is None:
+                    continue
+                collections.setdefault(cid, c)
+                members.setdefault(cid, []).append(p)
+        self.collections = {cid: Listing(collections[cid], members[cid]) for cid in members}
+        self._by_name = {}
+        for listing in self.collections.values():
+            title = (listing.title or '').strip().lower()
+            if title:
+                self._by_name.setdefault(title, listing)
+                self._by_name.setdefault(_handle(title), listing)
+        # Longest titles first, so "winter snowboards" wins over "snowboards"
+        titled = [((l.title or '').strip().lower(), l) for l in self.collections.values()]
+        self._title_patterns = [(re.compile(r'\b' + re.escape(title) + r'\b'), listing)
+                                for title, listing in sorted(titled, key=lambda t: -len(t[0])) if title]
+        self._cards = {}
+        self._items = {}
+        self._pages = {}
+        self._lock = threading.Lock()
+
+    def listing(self, key=None):
+        """Listing for a collection id, title or handle (all products when `key` is empty);
+        None if there is no such collection."""
+        if key in (None, ''):
+            return self.all
+        listing = self.collections.get(key)
+        if listing is None and isinstance(key, str):
+            if key.isdigit():
+                listing = self.collections.get(int(key))
+            listing = listing or self._by_name.get(key.strip().lower())
+        return listing
+
+    def match(self, query):
+        """The collection named in a chat query, or None."""
+        query_lower = (query or '').lower()
+        for pattern, listing in self._title_patterns:
+            if pattern.search(query_lower):
+                return listing
+        return None
+
+    def page(self, listing=None, cursor=None, limit=10):
+        """One page of `listing`, or of the listing a cursor continues."""
+        if cursor:
+            version, collection_id, offset, after_id = decode_cursor(cursor)
+            listing = self.all if collection_id is None else self.collections.get(collection_id)
+            if listing is None:
+                raise InvalidCursor("Collection no longer exists")
+            if version != self.version:
+                # Catalog changed since the cursor was issued: resume after the last product served
+                position = listing.positions.get(after_id)
+                offset = position + 1 if position is not None else offset
+        else:
+            listing = listing or self.all
+            offset = 0
+        offset = max(0, min(offset, len(listing.products)))
+        products = listing.products[offset:offset + limit]
+        end = offset + len(products)
+        next_cursor = None
+        if end < len(listing.products):
+            next_cursor = encode_cursor(self.version, listing.collection_id, end, products[-1].get('id'))
+        return Page(listing, offset, products, next_cursor)
+
+    def card(self, product):
+        pid = product.get('id')
+        card = self._cards.get(pid)
+        if card is None:
+            card = self._cards[pid] = self._render_card(product)
+        return card
+
+    def item(self, product):
+        pid = product.get('id')
+        item = self._items.get(pid)
+        if item is None:
+            item = self._items[pid] = self._render_item(product)
+        return item
+
+    def page_cards(self, page):
+        """The page's cards joined into one fragment, cached per page."""
+        key = (page.listing.collection_id, page.start, len(page.products))
+        fragment = self._pages.get(key)
+        if fragment is not None:
+            metrics.inc('browse_page_cache_total', outcome='hit')
+            return fragment
+        metrics.inc('browse_page_cache_total', outcome='miss')
+        fragment = '\n\n'.join(self.card(p) for p in page.products)
+        with self._lock:
+            if len(self._pages) >= PAGE_CACHE_SIZE:
+                self._pages.clear()
+            self._pages[key] = fragment
+        return fragment
+
+    def collection_summaries(self):
+        """[{'id', 'title', 'type', 'products'}] sorted by title."""
+        return sorted(({'id': l.collection_id, 'title': l.title, 'type': l.collection.get('type'),
+                        'products': len(l.products)} for l in self.collections.values()),
+                      key=lambda c: (c['title'] or '').lower())
+
+
+metrics.describe('browse_pages_total', 'counter', 'Product listing pages served, by source (chat or api).')
+metrics.describe('browse_page_cache_total', 'counter', 'Rendered chat listing pages served from / added to the cache.')
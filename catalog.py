@@ -0,0 +1,362 @@
+"""In-memory catalog snapshots and the background refresher that keeps them current.
+
+The app always reads from one immutable `CatalogSnapshot` (products plus the
+store currency) held by a `CatalogStore`. The `CatalogRefresher` serves the
+on-disk snapshot immediately and revalidates against Shopify in a
+background thread, on a schedule and on demand (webhooks), swapping the
+store's snapshot atomically when the catalog changed.
+"""
+import itertools
+import logging
+import re
+import threading
+import time
+from html.parser import HTMLParser
+
+import metrics
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CURRENCY = "USD"
+
+# Length of the plain-text description summary used in prompts
+SUMMARY_CHARS = 180
+
+_BLOCK_TAGS = {'p', 'br', 'li', 'ul', 'ol', 'div', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'tr', 'td', 'th', 'table'}
+
+
+class _TextExtractor(HTMLParser):
+    """Collects the text content of an HTML fragment (entities decoded)."""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag in _BLOCK_TAGS:
+            self.parts.append(' ')
+
+    def handle_endtag(self, tag):
+        if tag in _BLOCK_TAGS:
+            self.parts.append(' ')
+
+    def handle_data(self, data):
+        self.parts.append(data)
+
+
+def html_to_text(html):
+    """Plain text of Shopify `body_html`, whitespace collapsed."""
+    if not html:
+        return ''
+    parser = _TextExtractor()
+    try:
+        parser.feed(html)
+        parser.close()
+    except Exception:
+        return re.sub(r'\s+', ' ', re.sub(r'<[^>]*>', ' ', html)).strip()
+    return re.sub(r'\s+', ' ', ''.join(parser.parts)).strip()
+
+
+def truncate_text(text, limit):
+    """Cut `text` to at most `limit` chars on a word boundary, adding '...' when cut."""
+    if len(text) <= limit:
+        return text
+    cut = text[:limit].rsplit(' ', 1)[0] or text[:limit]
+    return cut.rstrip(' ,;:-') + '...'
+
+
+class ProductText:
+    """Description derived from `body_html`: clean text, lowercase search text
+    and a short summary."""
+
+    __slots__ = ('text', 'search_text', 'summary')
+
+    def __init__(self, body_html):
+        self.text = html_to_text(body_html)
+        self.search_text = self.text.lower()
+        self.summary = truncate_text(self.text, SUMMARY_CHARS)
+
+    @classmethod
+    def from_text(cls, text):
+        """Build from already-stripped plain text (e.g. a compact snapshot)."""
+        self = cls.__new__(cls)
+        self.text = text or ''
+        self.search_text = self.text.lower()
+        self.summary = truncate_text(self.text, SUMMARY_CHARS)
+        return self
+
+
+def product_text(product):
+    """The product's preprocessed description, built on first use if missing."""
+    cached = product.get('_text')
+    if cached is None:
+        cached = product['_text'] = ProductText(product.get('body_html'))
+    return cached
+
+
+def preprocess_products(products):
+    """Strip HTML once per catalog update; stored on each product as `_text`.
+    Keys starting with '_' are derived data and are never written back to disk."""
+    for p in products:
+        if not isinstance(p.get('_text'), ProductText):
+            p['_text'] = ProductText(p.get('body_html'))
+    return products
+
+
+def extract_colors_from_product(product):
+    """Color names of a product: its "Color" option values, else the variants' option1
+    (prices, defaults and duplicates dropped)."""
+    colors = []
+    for option in product.get('options', []):
+        if option.get('name', '').lower() == 'color':
+            colors.extend(option.get('values', []))
+    if not colors:
+        for variant in product.get('variants', []):
+            option1 = variant.get('option1')
+            if option1 and option1.lower() != 'default title':
+                colors.append(option1)
+    filtered_colors = []
+    for color in colors:
+        if (not re.search(r'[\$€£¥₹₽₩₪₺₫₱₿]', color)  # no currency symbols
+                and not re.search(r'\d+\.?\d*', color)  # no prices
+                and color.lower() not in ['default', 'default title', 'title']
+                and len(color.strip()) > 0):
+            filtered_colors.append(color)
+    return list(set(filtered_colors))
+
+
+def normalize_text(value):
+    """Lowercased text of a product field ('' for None or non-strings)."""
+    try:
+        return (value or "").lower()
+    except Exception:
+        return ""
+
+
+def extract_price_range(query):
+    """(min_price, max_price) hinted by the numbers in a query: one number is a max,
+    several give their min and max; (None, None) when there are none."""
+    nums = [float(x) for x in re.findall(r"\d+\.?\d*", query.replace(',', ' '))]
+    if not nums:
+        return (None, None)
+    if len(nums) == 1:
+        return (None, nums[0])
+    return (min(nums), max(nums))
+
+
+class AvailabilityIndex:
+    """Stock levels derived from the scraped variant `inventory_levels`.
+
+    Built once per snapshot: available units per variant, per product and
+    per location, plus the set of products that cannot be sold right now.
+    A variant is sellable unless Shopify tracks it, it denies overselling
+    and it has no units left; variants without level data count as
+    sellable. Webhook updates are applied as deltas via `apply_level()`.
+    """
+
+    def __init__(self, products, previous=None):
+        self._lock = threading.Lock()
+        self._products = products
+        self._levels = {}            # inventory_item_id -> {location_id: available}
+        self._item_variant = {}      # inventory_item_id -> (product_id, variant_id)
+        self._variant_tracked = {}   # variant_id -> bool (tracked and deny oversell)
+        self._variant_items = {}     # product_id -> [inventory_item_id, ...]
+        self.variant_available = {}  # variant_id -> units across locations
+        self.product_available = {}  # product_id -> units across variants
+        self.location_stock = {}     # location_id -> {product_id: units}
+        for p in products:
+            pid = p.get('id')
+            items = self._variant_items.setdefault(pid, [])
+            self.product_available.setdefault(pid, 0)
+            for v in p.get('variants') or []:
+                vid = v.get('id')
+                item_id = v.get('inventory_item_id')
+                self._variant_tracked[vid] = (v.get('inventory_management') == 'shopify'
+                                              and v.get('inventory_policy', 'deny') != 'continue')
+                self.variant_available[vid] = 0
+                if item_id is None:
+                    continue
+                items.append(item_id)
+                self._item_variant[item_id] = (pid, vid)
+                if 'inventory_levels' in v:
+                    levels = {lvl.get('location_id'): lvl.get('available') or 0 for lvl in v.get('inventory_levels') or []}
+                elif previous is not None and item_id in previous._levels:
+                    # Product-only refreshes carry no levels; keep the last known ones
+                    levels = dict(previous._levels[item_id])
+                else:
+                    continue
+                self._levels[item_id] = levels
+                for loc, units in levels.items():
+                    self._add_units(pid, vid, loc, units)
+        self._rebuild_unavailable()
+
+    def _add_units(self, pid, vid, location_id, units):
+        self.variant_available[vid] = self.variant_available.get(vid, 0) + units
+        self.product_available[pid] = self.product_available.get(pid, 0) + units
+        per_loc = self.location_stock.setdefault(location_id, {})
+        per_loc[pid] = per_loc.get(pid, 0) + units
+
+    def _product_sellable(self, pid):
+        for item_id in self._variant_items.get(pid, []):
+            _, vid = self._item_variant[item_id]
+            if (not self._variant_tracked.get(vid) or item_id not in self._levels
+                    or self.variant_available.get(vid, 0) > 0):
+                return True
+        # Products without any inventory item (e.g. digital) stay sellable
+        return not self._variant_items.get(pid)
+
+    def _rebuild_unavailable(self):
+        unavailable = frozenset(p.get('id') for p in self._products if not self._product_sellable(p.get('id')))
+        available = [p for p in self._products if p.get('id') not in unavailable]
+        # Replace whole objects so concurrent readers never see partial state
+        self.unavailable_ids = unavailable
+        self.available_products = available
+        self.ranked_products = available + [p for p in self._products if p.get('id') in unavailable]
+
+    def is_available(self, product_id):
+        return product_id not in self.unavailable_ids
+
+    def products_for(self, mode):
+        """Product list for the local engine: 'filter' drops unavailable items,
+        'downrank' moves them to the end, anything else keeps catalog order."""
+        if mode == 'filter':
+            return self.available_products
+        if mode == 'downrank':
+            return self.ranked_products
+        return self._products
+
+    def apply_level(self, inventory_item_id, location_id, available):
+        """Apply an inventory_levels webhook. Returns False for unknown items."""
+        with self._lock:
+            target = self._item_variant.get(inventory_item_id)
+            if target is None:
+                return False
+            pid, vid = target
+            levels = self._levels.setdefault(inventory_item_id, {})
+            delta = (available or 0) - levels.get(location_id, 0)
+            levels[location_id] = available or 0
+            if delta:
+                self._add_units(pid, vid, location_id, delta)
+            was_sellable = pid not in self.unavailable_ids
+            if was_sellable != self._product_sellable(pid):
+                self._rebuild_unavailable()
+            return True
+
+
+class CatalogSnapshot:
+    """One consistent view of the catalog. Treat as read-only once built;
+    only the availability index is updated in place (inventory webhooks)."""
+
+    def __init__(self, products, currency=DEFAULT_CURRENCY, validators=None, source='disk', version=0,
+                 previous=None):
+        self.products = preprocess_products(products)
+        self.currency = currency or DEFAULT_CURRENCY
+        # Conditional-request validators from the last fetch (etag / last_modified)
+        self.validators = dict(validators or {})
+        self.source = source
+        self.version = version
+        self.loaded_at = time.time()
+        # Catalog files' state this snapshot reflects (see app.catalog_disk_stamp)
+        self.disk_stamp = None
+        self.availability = AvailabilityIndex(products, previous.availability if previous else None)
+
+
+# Snapshot versions come from one process-wide sequence seeded from the clock (ms), so a
+# reloaded store or a restarted process never reissues a version that an outstanding
+# browse cursor or prefetch entry still refers to
+_versions = itertools.count(int(time.time() * 1000))
+
+
+class CatalogStore:
+    """Holds the current snapshot; readers never see a half-updated catalog."""
+
+    def __init__(self):
+        self._snapshot = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        return self._snapshot
+
+    def swap(self, snapshot):
+        """Install `snapshot` as current, stamping it with the next version."""
+        with self._lock:
+            snapshot.version = next(_versions)
+            self._snapshot = snapshot
+        return snapshot
+
+
+class CatalogRefresher:
+    """Stale-while-revalidate refresher.
+
+    `load_fn()` returns a snapshot from local disk. `fetch_fn(current)`
+    revalidates against the shop and returns a new snapshot, or None when the
+    catalog has not changed (e.g. a 304 on a conditional request).
+    """
+
+    def __init__(self, store, load_fn, fetch_fn, interval=300.0):
+        self.store = store
+        self._load_fn = load_fn
+        self._fetch_fn = fetch_fn
+        self.interval = interval
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._refresh_lock = threading.Lock()
+        self._thread = None
+
+    def load_initial(self):
+        """Serve from disk straight away (no network)."""
+        if self.store.get() is None:
+            self.store.swap(self._load_fn())
+        return self.store.get()
+
+    def refresh(self):
+        """Revalidate once, swapping in a new snapshot if the catalog changed."""
+        with self._refresh_lock:
+            current = self.load_initial()
+            try:
+                fresh = self._fetch_fn(current)
+            except Exception as e:
+                metrics.inc('catalog_refreshes_total', outcome='error')
+                log.warning('catalog_refresh_failed', extra={'error': str(e)})
+                return False
+            if fresh is None:
+                metrics.inc('catalog_refreshes_total', outcome='not_modified')
+                return False
+            self.store.swap(fresh)
+            metrics.inc('catalog_refreshes_total', outcome='updated')
+            return True
+
+    def trigger(self):
+        """Ask for a revalidation soon; runs inline when no background thread is active."""
+        if self.running:
+            self._wake.set()
+        else:
+            self.refresh()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.refresh()
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def start(self):
+        self.load_initial()
+        if not self.running:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='catalog-refresher', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout=5.0):
+        self._stop.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+
+
+metrics.describe('catalog_refreshes_total', 'counter', 'Background catalog revalidations by outcome.')
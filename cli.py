@@ -0,0 +1,69 @@
+"""Command-line entry point (`python app.py [api|serve]`).
+
+    python app.py              # chat with the bot in the terminal
+    python app.py api          # Flask development server (flask_app.py)
+    python app.py serve        # production ASGI server (asgi_app.py)
+
+Only the chosen mode's dependencies are imported: the terminal chat never
+loads Flask or the ASGI stack. It answers from one in-memory catalog
+snapshot (revalidated in the background once the first question is asked)
+through the same top-k retrieval, Gemini call and local fallback as the
+API, keeping the session's conversation state in memory.
+"""
+import sys
+import time
+
+_started = time.perf_counter()
+
+
+def run_terminal_chat():
+    import app as chat
+    from conversation import Conversation
+
+    snapshot = chat.current_catalog()
+    chat.log.info('catalog_loaded', extra={'shop': chat.default_tenant.domain, 'products': len(snapshot.products),
+                                           'startup_ms': round((time.perf_counter() - _started) * 1000.0, 2)})
+    conversation = Conversation([], chat.extract_products_in_text)
+    print("Welcome to Starky Shop Chatbot! Type 'quit' to exit.\n")
+    refreshing = False
+    while True:
+        try:
+            user_query = input("You: ").strip()
+        except EOFError:
+            user_query = 'quit'
+        if user_query.lower() in ['quit', 'exit', 'bye']:
+            print("Goodbye!")
+            break
+        if not user_query:
+            continue
+        if not refreshing:
+            # Keep the catalog current for the rest of the session without delaying startup
+            chat.tenant_registry.start()
+            refreshing = True
+        snapshot = chat.current_catalog()
+        products = chat.chat_products(snapshot)
+        conversation.add_user(user_query)
+        answer = chat.answer_chat_turn(user_query, conversation.history, products,
+                                       chat.unavailable_for_ranking(snapshot), user_id='cli',
+                                       conversation=conversation)
+        conversation.add_bot(answer)
+        print(f"Bot: {answer}\n")
+
+
+def main(argv=None):
+    args = sys.argv[1:] if argv is None else argv
+    mode = args[0] if args else None
+    # 'serve' runs the async production server (WEB_CONCURRENCY workers);
+    # each worker starts its own catalog refresher
+    if mode == 'serve':
+        from asgi_app import run_server
+        run_server()
+    elif mode == 'api':
+        from flask_app import run_server
+        run_server()
+    else:
+        run_terminal_chat()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,307 @@
+"""Compact binary catalog snapshot, readable through `mmap`.
+
+Layout (all integers little-endian):
+
+    header        magic, version, product count and section offsets
+    string table  u64 offsets + UTF-8 bytes; repeated strings stored once
+    string cols   u32 string ids per product for the hot text fields
+    id col        i64 product id (-1 when it is not an integer)
+    offset index  u64 (offset, length) of each product's hot and cold blobs
+    blobs         compact JSON; hot = options/variants/collections,
+                  cold = body_html, images, metafields, discount rules, ...
+    meta          JSON (currency, validators, ...)
+
+Loading only parses the header; products are `LazyProduct` mappings that
+read their hot fields on access and decode the cold blob the first time a
+cold key such as `body_html` or `images` is requested. A missing or null
+text field is left out of the mapping, so `p.get('tags', '')` behaves as
+on the JSON products. The plain-text description is stored precomputed,
+so no HTML parsing happens at load.
+
+Usage:
+    python compact_catalog.py convert [shopify_full_export.json] [shopify_catalog.bin]
+    python compact_catalog.py bench [shopify_full_export.json]
+"""
+import json
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import time
+from collections.abc import MutableMapping
+
+from catalog import ProductText
+
+MAGIC = b'SHOPCAT1'
+FORMAT_VERSION = 2
+
+# magic, version, count, string count, then section offsets
+_HEADER = struct.Struct('<8sIIIxxxxQQQQQQ')
+_U64 = struct.Struct('<Q')
+_ID = struct.Struct('<q')
+_INDEX_ENTRY = struct.Struct('<QQQQ')
+
+STRING_FIELDS = ('title', 'handle', 'vendor', 'product_type', 'tags', 'status', '_description')
+HOT_BLOB_FIELDS = ('options', 'variants', 'collections')
+_NULL_STRING = 0xFFFFFFFF
+
+
+def write_compact_catalog(products, path, meta=None):
+    """Write `products` (plain dicts) to `path` atomically."""
+    from catalog import product_text
+
+    strings, string_ids = [], {}
+
+    def intern(value):
+        if value is None:
+            return _NULL_STRING
+        value = str(value)
+        sid = string_ids.get(value)
+        if sid is None:
+            sid = string_ids[value] = len(strings)
+            strings.append(value)
+        return sid
+
+    columns = bytearray()
+    ids = bytearray()
+    blobs = bytearray()
+    index = bytearray()
+    for p in products:
+        row = []
+        for field in STRING_FIELDS:
+            if field == '_description':
+                row.append(intern(product_text(p).text))
+            else:
+                row.append(intern(p.get(field)))
+        columns += struct.pack(f'<{len(STRING_FIELDS)}I', *row)
+        pid = p.get('id')
+        ids += _ID.pack(pid if isinstance(pid, int) else -1)
+        hot = {k: p.get(k) for k in HOT_BLOB_FIELDS if k in p}
+        # Non-integer ids (never seen from Shopify) round-trip through the cold blob
+        cold = {k: v for k, v in p.items()
+                if k not in HOT_BLOB_FIELDS and k not in STRING_FIELDS and not k.startswith('_')
+                and not (k == 'id' and isinstance(v, int))}
+        hot_bytes = json.dumps(hot, separators=(',', ':')).encode('utf-8')
+        cold_bytes = json.dumps(cold, separators=(',', ':')).encode('utf-8')
+        hot_off = len(blobs)
+        blobs += hot_bytes
+        cold_off = len(blobs)
+        blobs += cold_bytes
+        index += _INDEX_ENTRY.pack(hot_off, len(hot_bytes), cold_off, len(cold_bytes))
+
+    encoded = [s.encode('utf-8') for s in strings]
+    string_table = bytearray()
+    pos = 0
+    for b in encoded:
+        string_table += _U64.pack(pos)
+        pos += len(b)
+    string_table += _U64.pack(pos)
+    for b in encoded:
+        string_table += b
+
+    meta_bytes = json.dumps(meta or {}, separators=(',', ':')).encode('utf-8')
+    strings_off = _HEADER.size
+    columns_off = strings_off + len(string_table)
+    ids_off = columns_off + len(columns)
+    index_off = ids_off + len(ids)
+    blobs_off = index_off + len(index)
+    meta_off = blobs_off + len(blobs)
+    header = _HEADER.pack(MAGIC, FORMAT_VERSION, len(products), len(strings),
+                          strings_off, columns_off, ids_off, index_off, blobs_off, meta_off)
+
+    # A unique temp file per writer, so concurrent writers (the scraper, each worker's
+    # refresher) never interleave into one file that readers then mmap
+    with tempfile.NamedTemporaryFile('wb', dir=os.path.dirname(path) or '.', prefix=os.path.basename(path) + '.',
+                                     suffix='.tmp', delete=False) as f:
+        tmp_path = f.name
+        try:
+            for section in (header, string_table, columns, ids, index, blobs, meta_bytes):
+                f.write(section)
+            f.flush()
+            os.fsync(f.fileno())
+        except BaseException:
+            f.close()
+            os.remove(tmp_path)
+            raise
+    os.replace(tmp_path, path)
+    return path
+
+
+class CompactCatalog:
+    """Read-only view of a compact catalog file backed by `mmap`."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, self.count, self._string_count, self._strings_off, self._columns_off,
+         self._ids_off, self._index_off, self._blobs_off, self._meta_off) = _HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError(f"{path} is not a version {FORMAT_VERSION} compact catalog")
+        self._string_data_off = self._strings_off + (self._string_count + 1) * _U64.size
+        self._row = struct.Struct(f'<{len(STRING_FIELDS)}I')
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def meta(self):
+        return json.loads(self._mm[self._meta_off:].decode('utf-8') or '{}')
+
+    def string(self, sid):
+        if sid == _NULL_STRING:
+            return None
+        start, = _U64.unpack_from(self._mm, self._strings_off + sid * _U64.size)
+        end, = _U64.unpack_from(self._mm, self._strings_off + (sid + 1) * _U64.size)
+        return self._mm[self._string_data_off + start:self._string_data_off + end].decode('utf-8')
+
+    def string_field(self, i, field):
+        sids = self._row.unpack_from(self._mm, self._columns_off + i * self._row.size)
+        return self.string(sids[STRING_FIELDS.index(field)])
+
+    def product_id(self, i):
+        """Integer id of product `i`, or -1 (the id is then in the cold blob)."""
+        return _ID.unpack_from(self._mm, self._ids_off + i * _ID.size)[0]
+
+    def blob(self, i, cold=False):
+        hot_off, hot_len, cold_off, cold_len = _INDEX_ENTRY.unpack_from(
+            self._mm, self._index_off + i * _INDEX_ENTRY.size)
+        off, length = (cold_off, cold_len) if cold else (hot_off, hot_len)
+        start = self._blobs_off + off
+        return json.loads(self._mm[start:start + length].decode('utf-8'))
+
+    def product(self, i):
+        return LazyProduct(self, i)
+
+    def products(self):
+        return [LazyProduct(self, i) for i in range(self.count)]
+
+
+class LazyProduct(MutableMapping):
+    """Product mapping over a `CompactCatalog` row.
+
+    The id and text fields come from the columns (null text fields are left
+    out), `options`/`variants`/`collections` from the hot blob, and
+    everything else from the cold blob, each decoded on first access.
+    Assignments are kept locally.
+    """
+
+    __slots__ = ('_catalog', '_i', '_data', '_hot_loaded', '_cold_loaded')
+
+    def __init__(self, catalog, i):
+        self._catalog = catalog
+        self._i = i
+        pid = catalog.product_id(i)
+        self._data = {'id': pid} if pid != -1 else {}
+        for field in STRING_FIELDS:
+            if field != '_description':
+                value = catalog.string_field(i, field)
+                if value is not None:
+                    self._data[field] = value
+        self._hot_loaded = False
+        self._cold_loaded = False
+
+    def _load(self, key):
+        if key in STRING_FIELDS:
+            return  # read up front; absent means null
+        if key in HOT_BLOB_FIELDS:
+            if not self._hot_loaded:
+                for k, v in self._catalog.blob(self._i).items():
+                    self._data.setdefault(k, v)
+                self._hot_loaded = True
+        elif key == '_text':
+            self._data['_text'] = ProductText.from_text(self._catalog.string_field(self._i, '_description'))
+        elif not self._cold_loaded:
+            self._load_all_cold()
+
+    def _load_all_cold(self):
+        if not self._cold_loaded:
+            for k, v in self._catalog.blob(self._i, cold=True).items():
+                self._data.setdefault(k, v)
+            self._cold_loaded = True
+
+    def __getitem__(self, key):
+        if key not in self._data:
+            self._load(key)
+        return self._data[key]
+
+    def __setitem__(self, key, value):
+        self._data[key] = value
+
+    def __delitem__(self, key):
+        self._load(key)
+        del self._data[key]
+
+    def __iter__(self):
+        self._load('options')
+        self._load_all_cold()
+        return iter([k for k in self._data if not k.startswith('_')])
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    def __repr__(self):
+        return f"LazyProduct(id={self._data.get('id')!r}, title={self._data.get('title')!r})"
+
+
+def convert(src, dst):
+    """Convert a JSON export (list or {'products': [...]}) to the compact format."""
+    with open(src, 'r') as f:
+        data = json.load(f)
+    products = data.get('products', []) if isinstance(data, dict) else data
+    write_compact_catalog(products, dst)
+    return len(products)
+
+
+def bench(src, repeat=5):
+    """Compare JSON parse + preprocessing against opening the compact file."""
+    import tempfile
+    from catalog import preprocess_products
+    dst = os.path.join(tempfile.mkdtemp(prefix='compact_bench_'), 'catalog.bin')
+    convert(src, dst)
+
+    def best(fn):
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            fn()
+            times.append(time.perf_counter() - start)
+        return min(times) * 1000.0
+
+    def load_json():
+        with open(src, 'r') as f:
+            data = json.load(f)
+        products = data.get('products', []) if isinstance(data, dict) else data
+        preprocess_products(products)
+
+    def load_compact():
+        products = CompactCatalog(dst).products()
+        preprocess_products(products)
+
+    json_ms, compact_ms = best(load_json), best(load_compact)
+    result = {
+        'source': src,
+        'json_bytes': os.path.getsize(src),
+        'compact_bytes': os.path.getsize(dst),
+        'json_load_ms': json_ms,
+        'compact_load_ms': compact_ms,
+    }
+    os.remove(dst)
+    return result
+
+
+if __name__ == "__main__":
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    command = sys.argv[1] if len(sys.argv) > 1 else 'convert'
+    src = sys.argv[2] if len(sys.argv) > 2 else os.path.join(base_dir, 'shopify_full_export.json')
+    if command == 'convert':
+        dst = sys.argv[3] if len(sys.argv) > 3 else os.path.join(base_dir, 'shopify_catalog.bin')
+        n = convert(src, dst)
+        print(f"Wrote {n} products to {dst}")
+    elif command == 'bench':
+        r = bench(src)
+        print(f"JSON    {r['json_bytes']:>10} bytes  load {r['json_load_ms']:.2f} ms")
+        print(f"compact {r['compact_bytes']:>10} bytes  load {r['compact_load_ms']:.2f} ms")
+    else:
+        print("Usage: python compact_catalog.py [convert|bench] [src.json] [dst.bin]")
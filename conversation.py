@@ -0,0 +1,229 @@
+"""Per-session conversation state kept in memory between turns.
+
+A `Conversation` holds a user's full history plus what every turn derives
+from it: the rolling window of formatted context lines, the focus product
+ids (products named in the latest bot message that named any) and the
+last top-k. Appending a turn updates these incrementally, so a follow-up
+turn does not reload or rescan the history.
+
+`ConversationStore` keeps recent conversations in an LRU and persists
+them lazily: changed conversations are written by `flush()` (run
+periodically by `start()`), when evicted, or immediately with `save()`.
+A clean cached conversation is reloaded if its history file was changed
+by another process.
+"""
+import logging
+import threading
+from collections import OrderedDict, deque
+
+import metrics
+
+log = logging.getLogger(__name__)
+
+# Number of recent messages included in the Gemini context
+CONTEXT_WINDOW = 10
+
+
+def _context_line(msg):
+    prefix = 'User:' if msg.get('role') == 'user' else 'Bot:'
+    return f"{prefix} {msg.get('message', '')}"
+
+
+class Conversation:
+    """One user's history with its derived per-turn state.
+
+    `extract_fn(text, products)` returns the products named in `text`
+    (app.extract_products_in_text). Appending and focus derivation hold a
+    per-conversation lock: the prefetch worker derives focus products in
+    the background while the next request may already be appending.
+    """
+
+    def __init__(self, history, extract_fn, key=None, mtime=None):
+        self.key = key
+        self.history = history
+        self.window = deque((_context_line(m) for m in history[-CONTEXT_WINDOW:]), maxlen=CONTEXT_WINDOW)
+        self.focus_ids = None       # None until derived from the history
+        self.last_top_k_ids = []
+        self.version = 0            # bumped on every appended message
+        self.saved_version = 0
+        self.mtime = mtime          # history file mtime when loaded / last saved
+        self._extract = extract_fn
+        self._unscanned_bot = None  # latest bot message not yet scanned for products
+        self._focus = None          # (product list, focus products) for that list
+        self.prefetch = None        # speculative follow-up answers (prefetch.py)
+        self.browse_cursor = None   # next page of the last product listing (browse.py)
+        self._lock = threading.Lock()
+
+    @property
+    def dirty(self):
+        return self.version != self.saved_version
+
+    def add_user(self, message):
+        """Append a user message; returns it (for `discard()`)."""
+        with self._lock:
+            return self._append({'role': 'user', 'message': message})
+
+    def add_bot(self, message):
+        with self._lock:
+            self._append({'role': 'bot', 'message': message})
+            # Scanned for product titles on the next turn, against that turn's catalog
+            self._unscanned_bot = message
+
+    def _append(self, msg):
+        self.history.append(msg)
+        self.window.append(_context_line(msg))
+        self.version += 1
+        return msg
+
+    def discard(self, msg):
+        """Remove `msg` again, e.g. a user message whose turn failed before it was answered."""
+        with self._lock:
+            for i in range(len(self.history) - 1, -1, -1):
+                if self.history[i] is msg:
+                    del self.history[i]
+                    break
+            else:
+                return
+            self.window = deque((_context_line(m) for m in self.history[-CONTEXT_WINDOW:]), maxlen=CONTEXT_WINDOW)
+            # Still a change: invalidates prefetched answers computed for the discarded turn
+            self.version += 1
+
+    def context_lines(self):
+        return list(self.window)
+
+    def focus_products(self, products):
+        """Products the user is most likely referring to with "it/this/that"."""
+        with self._lock:
+            return self._focus_products(products)
+
+    def _focus_products(self, products):
+        if self._unscanned_bot is not None:
+            found = self._extract(self._unscanned_bot, products)
+            self._unscanned_bot = None
+            if found:
+                self.focus_ids = tuple(p.get('id') for p in found)
+                self._focus = (products, found)
+                return found
+        cached = self._focus
+        if cached is not None and cached[0] is products:
+            return cached[1]
+        if self.focus_ids is None:
+            # First turn since loading: search back for the latest bot message naming products
+            found = []
+            for past in reversed(self.history):
+                if past.get('role') == 'bot':
+                    found = self._extract(past.get('message', ''), products)
+                    if found:
+                        break
+            self.focus_ids = tuple(p.get('id') for p in found)
+        else:
+            # Catalog changed since the focus was found: re-resolve the ids
+            wanted = set(self.focus_ids)
+            found, titles = [], set()
+            for p in products:
+                if p.get('id') in wanted and p.get('title') not in titles:
+                    found.append(p)
+                    titles.add(p.get('title'))
+        self._focus = (products, found)
+        return found
+
+    def remember_top_k(self, top_k):
+        self.last_top_k_ids = [p.get('id') for p in top_k]
+
+
+class ConversationStore:
+    """LRU of `Conversation`s keyed by (tenant, user_id), persisted lazily.
+
+    `load_fn(user_id, tenant)`, `save_fn(user_id, history, tenant)` and
+    `mtime_fn(user_id, tenant)` read, write and stat the history file.
+    """
+
+    def __init__(self, load_fn, save_fn, mtime_fn, extract_fn, max_sessions=10000):
+        self._load_fn = load_fn
+        self._save_fn = save_fn
+        self._mtime_fn = mtime_fn
+        self._extract_fn = extract_fn
+        self.max_sessions = max_sessions
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def get(self, user_id, tenant):
+        key = (tenant, user_id)
+        with self._lock:
+            conv = self._sessions.get(key)
+            if conv is not None:
+                self._sessions.move_to_end(key)
+        if conv is not None and not conv.dirty and self._mtime_fn(user_id, tenant) != conv.mtime:
+            conv = None  # written by another worker since we loaded or saved it
+        if conv is not None:
+            metrics.inc('conversation_cache_total', outcome='hit')
+            return conv
+        metrics.inc('conversation_cache_total', outcome='miss')
+        mtime = self._mtime_fn(user_id, tenant)
+        conv = Conversation(self._load_fn(user_id, tenant), self._extract_fn, key=key, mtime=mtime)
+        evicted = []
+        with self._lock:
+            self._sessions[key] = conv
+            while len(self._sessions) > self.max_sessions:
+                evicted.append(self._sessions.popitem(last=False)[1])
+        for old in evicted:
+            self.save(old)
+        return conv
+
+    def resident(self, conv):
+        """True while `conv` is the cached conversation for its key (so `flush()` covers it)."""
+        with self._lock:
+            return self._sessions.get(conv.key) is conv
+
+    def save(self, conv):
+        """Write `conv` if it changed since it was last saved."""
+        version = conv.version
+        if version == conv.saved_version:
+            return False
+        tenant, user_id = conv.key[0], conv.key[1]
+        self._save_fn(user_id, list(conv.history), tenant)
+        conv.mtime = self._mtime_fn(user_id, tenant)
+        conv.saved_version = version
+        return True
+
+    def flush(self):
+        """Persist every changed conversation; returns how many were written."""
+        with self._lock:
+            pending = [c for c in self._sessions.values() if c.dirty]
+        written = 0
+        for conv in pending:
+            try:
+                written += self.save(conv)
+            except Exception as e:
+                log.warning('history_save_failed', extra={'user_id': conv.key[1], 'error': str(e)})
+        return written
+
+    def _run(self, interval):
+        while not self._stop.wait(interval):
+            self.flush()
+
+    def start(self, interval=1.0):
+        """Flush changed conversations every `interval` seconds on a background thread."""
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, args=(interval,), name='conversation-flusher',
+                                            daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def clear(self):
+        self.flush()
+        with self._lock:
+            self._sessions.clear()
+
+
+metrics.describe('conversation_cache_total', 'counter', 'Conversation state lookups by cache outcome.')
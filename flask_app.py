@@ -0,0 +1,249 @@
+"""Flask (WSGI) app for the chat API: development server and test client.
+
+Thin HTTP layer over the chat engine in app.py; the production server is
+asgi_app.py. Kept apart from the engine so the CLI and the ASGI server do
+not import Flask.
+
+Run with:
+    python app.py api              # PORT port
+"""
+import logging
+import os
+import time
+
+from flask import Flask, g, request, jsonify
+from flask_cors import CORS
+
+import app as chat
+import logging_setup
+import metrics
+import profiling
+
+log = logging.getLogger(__name__)
+
+app = Flask(__name__)
+
+# Lock CORS to the configured Shopify stores (ALLOWED_ORIGIN plus any tenants)
+CORS(
+    app,
+    resources={
+        r"/chat": {"origins": chat.tenant_registry.allowed_origins()},
+        r"/chat/batch": {"origins": chat.tenant_registry.allowed_origins()},
+        r"/history": {"origins": chat.tenant_registry.allowed_origins()},
+        r"/products": {"origins": chat.tenant_registry.allowed_origins()},
+        r"/collections": {"origins": chat.tenant_registry.allowed_origins()},
+        r"/webhook/*": {"origins": "*"}
+    },
+    supports_credentials=False
+)
+
+@app.after_request
+def add_cors_headers(response):
+    # Ensure headers are always present (including preflight 204)
+    response.headers.setdefault('Access-Control-Allow-Origin', chat.current_tenant().allowed_origin)
+    response.headers.setdefault('Vary', 'Origin')
+    response.headers.setdefault('Access-Control-Allow-Headers', 'Content-Type, Authorization')
+    response.headers.setdefault('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
+    response.headers.setdefault('Access-Control-Max-Age', '3600')
+    return response
+
+@app.before_request
+def _start_request_timing():
+    metrics.begin_request()
+    g.request_start = time.perf_counter()
+    g.request_id = request.headers.get('X-Request-ID') or logging_setup.new_request_id()
+    g.log_token = logging_setup.bind(request_id=g.request_id, path=request.path)
+
+@app.before_request
+def _select_tenant():
+    data = request.get_json(silent=True) if request.method == 'POST' else request.args
+    tenant = chat.tenant_registry.resolve(
+        shop_domain=request.headers.get('X-Shopify-Shop-Domain'),
+        shop=data.get('shop') if isinstance(data, dict) else None,
+        origin=request.headers.get('Origin'))
+    if tenant is None:
+        return jsonify({'error': 'Unknown shop'}), 404
+    g.tenant_token = chat.tenant_registry.activate(tenant)
+    chat.tenant_registry.acquire(tenant)
+    g.tenant = tenant
+    logging_setup.bind(shop=tenant.domain)
+
+@app.before_request
+def _verify_webhook():
+    if request.path.startswith('/webhook/') and request.method == 'POST':
+        if not chat.verify_webhook(request.get_data(), request.headers.get('X-Shopify-Hmac-Sha256')):
+            metrics.inc('webhook_rejected_total')
+            return jsonify({'error': 'Invalid webhook signature'}), 401
+
+@app.teardown_request
+def _reset_tenant(exc):
+    tenant = g.pop('tenant', None)
+    if tenant is not None:
+        chat.tenant_registry.release(tenant)
+    token = g.pop('tenant_token', None)
+    if token is not None:
+        chat.tenant_registry.deactivate(token)
+
+@app.teardown_request
+def _reset_log_context(exc):
+    token = g.pop('log_token', None)
+    if token is not None:
+        logging_setup.reset(token)
+
+@app.after_request
+def _finish_request_timing(response):
+    spans = metrics.end_request()
+    if request.path == '/chat' and request.method == 'POST':
+        metrics.inc('chat_requests_total', status=response.status_code)
+        if chat.SERVER_TIMING and spans:
+            response.headers['Server-Timing'] = metrics.server_timing_header(spans)
+        logging_setup.log_request(log, 'chat_request', response.status_code,
+                                  time.perf_counter() - g.request_start, spans)
+    if 'request_id' in g:
+        response.headers['X-Request-ID'] = g.request_id
+    return response
+
+# Opt-in profiling of the whole /chat handler (X-Profile header, PROFILE_ALL, PROFILE_SAMPLE_RATE)
+@app.before_request
+def _start_profile():
+    if request.path == '/chat' and request.method == 'POST':
+        g.profile = profiling.start_capture(request.headers.get(profiling.PROFILE_HEADER))
+
+@app.after_request
+def _finish_profile(response):
+    capture = g.pop('profile', None)
+    if capture is not None:
+        data = request.get_json(silent=True) or {}
+        capture.finish(path=request.path, query=data.get('message'), user_id=data.get('user_id', 'default_user'),
+                       shop=chat.current_tenant().domain, catalog_version=chat.current_catalog().version,
+                       status=response.status_code)
+        response.headers['X-Profile-Id'] = capture.id
+    return response
+
+@app.teardown_request
+def _abandon_profile(exc):
+    # after_request is skipped when the request fails hard; never leave the profiler running
+    capture = g.pop('profile', None)
+    if capture is not None:
+        capture.finish(path=request.path, status=500, error=repr(exc))
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return (metrics.render_prometheus(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+# Silence favicon 404s
+@app.route('/favicon.ico')
+def _favicon():
+    return ('', 204)
+
+@app.route('/webhook/products', methods=['POST'])
+def shopify_webhook():
+    try:
+        log.info('catalog_webhook_received')
+        # Revalidation runs on the refresher thread; acknowledge Shopify right away
+        chat.current_tenant().refresher.trigger()
+        metrics.inc('webhook_refreshes_total', outcome='ok')
+        return jsonify({'status': 'success'}), 200
+    except Exception:
+        metrics.inc('webhook_refreshes_total', outcome='error')
+        log.exception('catalog_webhook_failed')
+        return jsonify({'error': 'Webhook processing failed'}), 500
+
+@app.route('/webhook/inventory_levels', methods=['POST'])
+def inventory_levels_webhook():
+    data = request.get_json(silent=True) or {}
+    try:
+        applied = chat.apply_inventory_level_update(data)
+        return jsonify({'status': 'success' if applied else 'ignored'}), 200
+    except Exception:
+        log.exception('inventory_webhook_failed')
+        return jsonify({'error': 'Webhook processing failed'}), 500
+
+# Update chat endpoint to use Gemini
+@app.route('/chat', methods=['OPTIONS', 'POST'])
+def chat_endpoint():
+    try:
+        # Handle CORS preflight
+        if request.method == 'OPTIONS':
+            return ('', 204)
+        with metrics.span('catalog_load'):
+            snapshot = chat.current_catalog()
+            products_latest = chat.chat_products(snapshot)
+        data = request.get_json(silent=True)
+        user_query = data.get('message', '') if data else ''
+        user_id = data.get('user_id', 'default_user') if data else 'default_user'
+        logging_setup.bind(user_id=user_id)
+        if not user_query:
+            return jsonify({'error': 'No message provided'}), 400
+
+        # Cached conversation state (history, context window, focus products)
+        with metrics.span('history_load'):
+            conversation = chat.get_conversation(user_id)
+        # Append new user message; it is only kept once answered
+        pending = conversation.add_user(user_query)
+
+        # Use Gemini (with top-K product selection) as primary, with local fallback
+        try:
+            answer = chat.answer_chat_turn(user_query, conversation.history, products_latest,
+                                           chat.unavailable_for_ranking(snapshot), user_id=user_id,
+                                           conversation=conversation,
+                                           client=chat.client_address(request.headers.get('X-Forwarded-For'),
+                                                                      request.remote_addr))
+        except Exception:
+            conversation.discard(pending)
+            raise
+
+        # Append bot response; the history is written lazily
+        conversation.add_bot(answer)
+        with metrics.span('history_save'):
+            chat.persist_conversation(conversation)
+        chat.schedule_prefetch(conversation, products_latest, snapshot)
+
+        return jsonify({'response': answer})
+    except Exception:
+        log.exception('chat_failed')
+        return jsonify({'error': 'An unexpected error occurred.'}), 500
+
+@app.route('/chat/batch', methods=['OPTIONS', 'POST'])
+def chat_batch():
+    if request.method == 'OPTIONS':
+        return ('', 204)
+    data = request.get_json(silent=True)
+    items = data.get('items') if isinstance(data, dict) else None
+    if not isinstance(items, list) or not items:
+        return jsonify({'error': 'No items provided'}), 400
+    if len(items) > chat.BATCH_MAX_ITEMS:
+        return jsonify({'error': f'Too many items (max {chat.BATCH_MAX_ITEMS})'}), 400
+    try:
+        start = time.perf_counter()
+        results = chat.process_chat_batch(
+            items, chat.client_address(request.headers.get('X-Forwarded-For'), request.remote_addr))
+        return jsonify({'results': results, 'elapsed_ms': round((time.perf_counter() - start) * 1000.0, 2)})
+    except Exception:
+        log.exception('chat_batch_failed')
+        return jsonify({'error': 'An unexpected error occurred.'}), 500
+
+# (Optional) Endpoint to fetch chat history for a user
+@app.route('/history', methods=['POST'])
+def get_history():
+    data = request.get_json(silent=True)
+    user_id = data.get('user_id', 'default_user') if data else 'default_user'
+    history = list(chat.get_conversation(user_id).history)
+    return jsonify({'history': history})
+
+@app.route('/products', methods=['GET'])
+def list_products():
+    status, payload = chat.products_page(request.args)
+    return jsonify(payload), status
+
+@app.route('/collections', methods=['GET'])
+def list_collections():
+    return jsonify(chat.collections_summary())
+
+
+def run_server(host="0.0.0.0", port=None):
+    """Serve with the Flask development server; blocks until interrupted."""
+    chat.tenant_registry.start()
+    log.info('catalog_loaded', extra={'shop': chat.default_tenant.domain,
+                                      'products': len(chat.current_catalog().products)})
+    app.run(host=host, port=port or int(os.getenv("PORT", 5000)))
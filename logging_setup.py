@@ -0,0 +1,237 @@
+"""Structured JSON logging through a non-blocking, batched queue.
+
+Modules log with the standard library (`log = logging.getLogger(__name__)`),
+using a short snake_case event name as the message and fields in `extra`:
+
+    log.info('catalog_fetched', extra={'products': 120, 'shop': domain})
+
+After `setup()`, every record goes through a `QueueHandler`: the calling
+thread only resolves the message, snapshots the request context and
+enqueues the record without blocking (when the queue is full the record is
+dropped and counted). A background writer drains the queue, formats each
+record as one JSON object per line and writes whatever has accumulated
+with a single write, to stdout or to LOG_FILE with size-based rotation.
+
+`bind()` attaches fields such as request_id, user_id and shop to every
+event logged from the current context (thread or asyncio task). Noisy
+events are sampled with LOG_SAMPLE="event=rate,..."; warnings and errors
+are never sampled, and kept events carry their `sample_rate`.
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+import time
+import uuid
+from contextvars import ContextVar
+
+import metrics
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# Write to this file (rotated at LOG_MAX_BYTES, LOG_BACKUPS old files kept) instead of stdout
+LOG_FILE = os.getenv("LOG_FILE", "")
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(50 * 1024 * 1024)))
+LOG_BACKUPS = int(os.getenv("LOG_BACKUPS", "5"))
+# Records waiting for the writer; beyond this they are dropped rather than block a request
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_BATCH_SIZE = int(os.getenv("LOG_BATCH_SIZE", "256"))
+# Fraction of each event kept (below WARNING), e.g. "chat_request=0.1,catalog_not_modified=0.2"
+LOG_SAMPLE = os.getenv("LOG_SAMPLE", "")
+# Requests slower than this are logged as warnings, so they are never sampled out
+LOG_SLOW_MS = float(os.getenv("LOG_SLOW_MS", "2000"))
+
+_context = ContextVar('log_context', default={})
+_STOP = object()
+# Attributes every LogRecord has; anything else on a record came from `extra`
+_RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {'message', 'context'}
+
+_writer = None
+
+
+def bind(**fields):
+    """Add `fields` to every event logged from this context; returns a token for `reset()`."""
+    return _context.set({**_context.get(), **fields})
+
+
+def reset(token):
+    _context.reset(token)
+
+
+def new_request_id():
+    return uuid.uuid4().hex[:16]
+
+
+def parse_sample_rates(spec):
+    rates = {}
+    for item in (spec or '').split(','):
+        name, _, rate = item.partition('=')
+        if name.strip() and rate.strip():
+            rates[name.strip()] = min(1.0, max(0.0, float(rate)))
+    return rates
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps a fraction of the records of each sampled event (by message)."""
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.rates.get(record.msg)
+        if rate is None or rate >= 1.0:
+            return True
+        if random.random() >= rate:
+            metrics.inc('log_events_sampled_out_total')
+            return False
+        record.sample_rate = rate
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        event = {
+            'ts': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created))
+                  + f".{int(record.msecs):03d}Z",
+            'level': record.levelname.lower(),
+            'logger': record.name,
+            'event': record.getMessage(),
+        }
+        event.update(getattr(record, 'context', None) or {})
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRS:
+                event[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            event['exc'] = record.exc_text
+        return json.dumps(event, default=str, separators=(',', ':'))
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """Enqueues records from the calling thread; formatting happens on the writer."""
+
+    def prepare(self, record):
+        # Resolve what depends on the caller (args, context, traceback) and nothing more
+        record.msg = record.getMessage()
+        record.args = None
+        record.context = _context.get()
+        if record.exc_info:
+            record.exc_text = self.formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.inc('log_events_dropped_total')
+
+
+class BatchWriter:
+    """Drains the log queue on a background thread, one write per batch."""
+
+    def __init__(self, records, path=None, max_bytes=0, backups=0, batch_size=256, formatter=None):
+        self.records = records
+        self.batch_size = batch_size
+        self.formatter = formatter or JsonFormatter()
+        self._file = None
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self._file = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups,
+                                                              encoding='utf-8')
+        self._thread = threading.Thread(target=self._run, name='log-writer', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch = [self.records.get()]
+            # Whatever else is already queued goes out in the same write
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.records.get_nowait())
+                except queue.Empty:
+                    break
+            if _STOP in batch:
+                stopping = True
+                batch = [r for r in batch if r is not _STOP]
+            if batch:
+                try:
+                    self._write(batch)
+                    metrics.inc('log_batches_written_total')
+                except Exception:
+                    metrics.inc('log_write_errors_total')
+
+    def _write(self, batch):
+        lines = []
+        for record in batch:
+            try:
+                lines.append(self.formatter.format(record))
+            except Exception:
+                metrics.inc('log_write_errors_total')
+        data = '\n'.join(lines) + '\n'
+        if self._file is None:
+            sys.stdout.write(data)
+            sys.stdout.flush()
+            return
+        stream = self._file.stream
+        size = stream.tell()
+        if self._file.maxBytes and size and size + len(data) >= self._file.maxBytes:
+            self._file.doRollover()
+            stream = self._file.stream
+        stream.write(data)
+        stream.flush()
+
+    def stop(self):
+        """Write everything queued so far and stop the thread."""
+        if self._thread.is_alive():
+            self.records.put(_STOP)
+            self._thread.join(timeout=5)
+        if self._file is not None:
+            self._file.close()
+
+
+def setup(level=None, path=None):
+    """Route all logging through the JSON queue (idempotent; the first call configures it)."""
+    global _writer
+    if _writer is not None:
+        return _writer
+    records = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    handler = NonBlockingQueueHandler(records)
+    handler.setFormatter(JsonFormatter())
+    handler.addFilter(SamplingFilter(parse_sample_rates(LOG_SAMPLE)))
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(level or LOG_LEVEL)
+    _writer = BatchWriter(records, path=path if path is not None else LOG_FILE, max_bytes=LOG_MAX_BYTES,
+                          backups=LOG_BACKUPS, batch_size=LOG_BATCH_SIZE).start()
+    atexit.register(_writer.stop)
+    return _writer
+
+
+def log_request(logger, event, status, duration, spans=(), **fields):
+    """Log a per-request summary with its stage durations (`spans` from
+    `metrics.end_request()`); failed or slow requests are logged as warnings."""
+    duration_ms = round(duration * 1000.0, 2)
+    level = logging.WARNING if status >= 500 or duration_ms > LOG_SLOW_MS else logging.INFO
+    if not logger.isEnabledFor(level):
+        return
+    logger.log(level, event, extra={'status': status, 'duration_ms': duration_ms,
+                                    'stages': {stage: round(ms, 3) for stage, ms in spans}, **fields})
+
+
+metrics.describe('log_events_dropped_total', 'counter', 'Log events dropped because the log queue was full.')
+metrics.describe('log_events_sampled_out_total', 'counter', 'Log events skipped by LOG_SAMPLE sampling.')
+metrics.describe('log_batches_written_total', 'counter', 'Batched writes by the log writer thread.')
+metrics.describe('log_write_errors_total', 'counter', 'Log events or batches that failed to format or write.')
@@ -0,0 +1,150 @@
+"""Lightweight in-process metrics: counters, histograms and timing spans.
+
+Everything is kept in plain dicts behind one lock and rendered in the
+Prometheus text exposition format by `render_prometheus()`. Spans also
+record into a per-request scope (a context variable, so it works for both
+threaded Flask requests and asyncio tasks) so the API can emit a
+`Server-Timing` header for the current request.
+"""
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# Seconds; tuned for a pipeline whose local stages are sub-millisecond and
+# whose upstream LLM call takes hundreds of milliseconds.
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_lock = threading.Lock()
+_counters = {}    # (name, labels) -> float
+_histograms = {}  # (name, labels) -> [bucket_counts, sum, count]
+_help = {}        # name -> (type, help text)
+_request_spans = ContextVar('metrics_request_spans', default=None)
+
+
+def describe(name, kind, text):
+    """Register HELP/TYPE text for a metric (optional)."""
+    _help[name] = (kind, text)
+
+
+def _key(name, labels):
+    return (name, tuple(sorted(labels.items())) if labels else ())
+
+
+def inc(name, value=1.0, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0.0) + value
+
+
+def observe(name, value, **labels):
+    key = _key(name, labels)
+    with _lock:
+        hist = _histograms.get(key)
+        if hist is None:
+            hist = _histograms[key] = [[0] * len(DEFAULT_BUCKETS), 0.0, 0]
+        i = bisect_left(DEFAULT_BUCKETS, value)
+        if i < len(DEFAULT_BUCKETS):
+            hist[0][i] += 1
+        hist[1] += value
+        hist[2] += 1
+
+
+def counter_value(name, **labels):
+    with _lock:
+        return _counters.get(_key(name, labels), 0.0)
+
+
+def begin_request():
+    """Start collecting spans for the current request."""
+    _request_spans.set([])
+
+
+def end_request():
+    """Stop collecting and return [(stage, duration_ms), ...] for this request."""
+    spans = _request_spans.get()
+    _request_spans.set(None)
+    return spans or []
+
+
+@contextmanager
+def span(stage):
+    """Time a pipeline stage into `chat_stage_seconds{stage=...}`."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        observe('chat_stage_seconds', elapsed, stage=stage)
+        spans = _request_spans.get()
+        if spans is not None:
+            spans.append((stage, elapsed * 1000.0))
+
+
+def server_timing_header(spans):
+    """Format spans as a Server-Timing header value (repeated stages are summed)."""
+    totals = {}
+    for stage, ms in spans:
+        totals[stage] = totals.get(stage, 0.0) + ms
+    return ', '.join(f"{stage};dur={ms:.2f}" for stage, ms in totals.items())
+
+
+def _format_labels(labels, extra=None):
+    items = list(labels) + (list(extra) if extra else [])
+    if not items:
+        return ''
+    body = ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in items)
+    return '{' + body + '}'
+
+
+def render_prometheus():
+    """All metrics in Prometheus text exposition format (version 0.0.4)."""
+    with _lock:
+        counters = dict(_counters)
+        histograms = {k: (list(v[0]), v[1], v[2]) for k, v in _histograms.items()}
+    lines = []
+    seen = set()
+
+    def header(name, default_kind):
+        if name in seen:
+            return
+        seen.add(name)
+        kind, text = _help.get(name, (default_kind, ''))
+        if text:
+            lines.append(f"# HELP {name} {text}")
+        lines.append(f"# TYPE {name} {kind}")
+
+    for (name, labels), value in sorted(counters.items()):
+        header(name, 'counter')
+        lines.append(f"{name}{_format_labels(labels)} {value:g}")
+    for (name, labels), (counts, total, count) in sorted(histograms.items()):
+        header(name, 'histogram')
+        cumulative = 0
+        for bound, c in zip(DEFAULT_BUCKETS, counts):
+            cumulative += c
+            lines.append(f"{name}_bucket{_format_labels(labels, [('le', f'{bound:g}')])} {cumulative}")
+        lines.append(f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {count}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {total:.6f}")
+        lines.append(f"{name}_count{_format_labels(labels)} {count}")
+    return '\n'.join(lines) + '\n'
+
+
+def reset():
+    """Clear all recorded values (used by benchmarks between runs)."""
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+
+describe('chat_stage_seconds', 'histogram', 'Time spent in each /chat pipeline stage.')
+describe('chat_requests_total', 'counter', 'Handled /chat requests by HTTP status.')
+describe('gemini_calls_total', 'counter', 'Upstream Gemini calls by kind and outcome.')
+describe('chat_batch_items_total', 'counter', 'Items processed through /chat/batch by status.')
+describe('chat_fallbacks_total', 'counter', 'Answers produced by the local engine instead of Gemini.')
+describe('gemini_rewrites_total', 'counter', 'Local-engine answers rewritten through Gemini.')
+describe('cache_hits_total', 'counter', 'Per-catalog derived cache hits (all_colors, browse, batch_scorer).')
+describe('cache_misses_total', 'counter', 'Per-catalog derived cache misses (rebuilds) by cache name.')
+describe('inventory_updates_total', 'counter', 'Inventory level webhooks applied to the availability index.')
+describe('webhook_refreshes_total', 'counter', 'Catalog refreshes triggered by webhooks, by outcome.')
+describe('webhook_rejected_total', 'counter', 'Webhooks rejected for a missing or invalid HMAC signature.')
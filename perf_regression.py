@@ -0,0 +1,318 @@
+"""End-to-end performance regression suite against local stubs.
+
+Starts a stub Shopify store with a synthetic catalog and a stub Gemini
+(stub_servers.py), then, in a scratch directory:
+
+1. runs the scraper (`scraper.py --fresh`) against the stub store, then
+   again against a second stub that goes down halfway through (and
+   denies metafield access), and resumes that scrape once it heals;
+2. times the terminal chat (`python app.py`) on the scraped catalog: to
+   the first prompt, and through one answered question;
+3. starts the production server (`app.py serve`) on the scraped catalog,
+   revalidating against the same stub, and times how long it takes to
+   answer;
+4. replays chat queries about the synthetic catalog over HTTP (replay.py)
+   and pages through GET /products.
+
+Every measured number is checked against perf_thresholds.json
+({section: {metric: {"min": x} or {"max": x}}}) and the run exits with
+status 1 when any of them regresses past its threshold. Results are saved
+under bench_results/.
+
+Usage:
+    python perf_regression.py
+    python perf_regression.py --products 20000 --gemini-latency-ms 200
+    python perf_regression.py --thresholds my_thresholds.json --output result.json
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+
+from replay import RESULTS_DIR, run_replay
+from stub_servers import StubGeminiServer, StubShopifyServer, synthetic_shop
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+THRESHOLDS_FILE = os.path.join(BASE_DIR, 'perf_thresholds.json')
+
+
+def chat_corpus(data, size=200, seed=0):
+    """Queries a shopper might send about the synthetic store in `data`."""
+    import random
+    rng = random.Random(seed)
+    titles = [p['title'] for p in data['products']]
+    collections = [c['title'] for c in data['custom_collections'] + data['smart_collections']]
+    templates = [
+        lambda: f"How much is {rng.choice(titles)}?",
+        lambda: f"What colors does {rng.choice(titles)} come in?",
+        lambda: f"Is {rng.choice(titles)} in stock?",
+        lambda: f"Show me {rng.choice(collections)}" if collections else "Show me all products",
+        lambda: f"Do you have a {rng.choice(['red', 'blue', 'black', 'green'])} "
+                f"{rng.choice(['snowboard', 'helmet', 'jacket', 'gloves'])}?",
+        lambda: "Show me all products",
+        lambda: "Any discounts right now?",
+        lambda: "hi",
+    ]
+    return [rng.choice(templates)() for _ in range(size)]
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def run_scrape(workdir, env, fresh=True):
+    """Run the scraper once; returns its section of the result."""
+    start = time.perf_counter()
+    args = [sys.executable, os.path.join(BASE_DIR, 'scraper.py')] + (['--fresh'] if fresh else [])
+    proc = subprocess.run(args, cwd=workdir, env=env,
+                          stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, timeout=600)
+    duration = time.perf_counter() - start
+    products = 0
+    path = os.path.join(workdir, 'shopify_products.json')
+    if proc.returncode == 0 and os.path.exists(path):
+        with open(path, 'r') as f:
+            products = len(json.load(f))
+    return {
+        'exit_code': proc.returncode,
+        'duration_s': duration,
+        'products': products,
+        'products_per_s': products / duration if duration else 0.0,
+        'output_tail': proc.stdout[-2000:] if proc.returncode else '',
+    }
+
+
+def run_scrape_resume(data, workdir, env, full_requests, page_size=250, latency_ms=5.0, seed=0):
+    """Scrape a stub that fails after half of a full scrape's requests, heal it and
+    resume. Metafields answer 403 throughout, which must not count as an outage."""
+    workdir = os.path.join(workdir, 'resume')
+    os.makedirs(workdir)
+    with StubShopifyServer(data, page_size=page_size, latency_ms=latency_ms, fail_after=full_requests // 2,
+                           forbidden=('metafields',), seed=seed) as shopify:
+        env = dict(env, SHOPIFY_BASE_URL=shopify.base_url,
+                   SCRAPE_STATE_FILE=os.path.join(workdir, 'scrape_state.jsonl'))
+        interrupted = run_scrape(workdir, env)
+        shopify.heal()
+        served_before = shopify.stats()['served']
+        resumed = run_scrape(workdir, env, fresh=False)
+        resumed_requests = shopify.stats()['served'] - served_before
+    return {
+        'interrupted_exit_code': interrupted['exit_code'],
+        'exit_code': resumed['exit_code'],
+        'duration_s': resumed['duration_s'],
+        'products': resumed['products'],
+        'requests': resumed_requests,
+        'requests_saved': 1.0 - resumed_requests / full_requests if full_requests else 0.0,
+        'output_tail': resumed['output_tail'],
+    }
+
+
+def _time_cli(env, stdin):
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, os.path.join(BASE_DIR, 'app.py')], cwd=BASE_DIR, env=env, input=stdin,
+                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, text=True, timeout=120)
+    if proc.returncode != 0:
+        raise RuntimeError(f"CLI exited with status {proc.returncode}")
+    return time.perf_counter() - start
+
+
+def run_cli(env, runs=5):
+    """Median wall time of the terminal chat quitting at the first prompt, and answering one question."""
+    startup = sorted(_time_cli(env, 'quit\n') for _ in range(runs))
+    first_turn = sorted(_time_cli(env, 'Show me a snowboard\nquit\n') for _ in range(runs))
+    return {'startup_s': startup[runs // 2], 'first_turn_s': first_turn[runs // 2]}
+
+
+def start_server(env, port, timeout=60.0):
+    """Start `app.py serve`; returns (process, seconds until it answered /metrics)."""
+    start = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, os.path.join(BASE_DIR, 'app.py'), 'serve'], cwd=BASE_DIR, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{port}/metrics"
+    while time.perf_counter() - start < timeout:
+        if proc.poll() is not None:
+            raise RuntimeError(f"Server exited during startup with status {proc.returncode}")
+        try:
+            if requests.get(url, timeout=1).status_code == 200:
+                return proc, time.perf_counter() - start
+        except requests.RequestException:
+            pass
+        time.sleep(0.05)
+    stop_server(proc)
+    raise RuntimeError(f"Server did not answer within {timeout:.0f}s")
+
+
+def stop_server(proc):
+    proc.terminate()
+    try:
+        proc.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+
+def run_browse(base_url, pages=20, limit=20):
+    """Page through GET /products; returns latency and item counts."""
+    latencies, items, cursor = [], 0, None
+    session = requests.Session()
+    for _ in range(pages):
+        params = {'limit': limit}
+        if cursor:
+            params['cursor'] = cursor
+        start = time.perf_counter()
+        resp = session.get(f"{base_url}/products", params=params, timeout=30)
+        latencies.append((time.perf_counter() - start) * 1000.0)
+        resp.raise_for_status()
+        payload = resp.json()
+        items += len(payload.get('products', []))
+        cursor = payload.get('next_cursor')
+        if not cursor:
+            break
+    latencies.sort()
+    return {
+        'pages': len(latencies),
+        'products': items,
+        'latency_ms_p50': latencies[len(latencies) // 2] if latencies else 0.0,
+        'latency_ms_max': latencies[-1] if latencies else 0.0,
+    }
+
+
+def _lookup(result, dotted):
+    value = result
+    for part in dotted.split('.'):
+        if not isinstance(value, dict) or part not in value:
+            return None
+        value = value[part]
+    return value
+
+
+def check_thresholds(result, thresholds):
+    """[(metric, value, bound, limit)] for each threshold the result violates.
+    Metrics are dotted paths inside a section, e.g. chat: {"latency_ms.p95": {"max": 500}}."""
+    violations = []
+    for section, checks in thresholds.items():
+        for metric, bounds in checks.items():
+            name = f"{section}.{metric}"
+            value = _lookup(result, name)
+            for bound, limit in bounds.items():
+                if value is None:
+                    violations.append((name, None, bound, limit))
+                elif bound == 'min' and value < limit:
+                    violations.append((name, value, bound, limit))
+                elif bound == 'max' and value > limit:
+                    violations.append((name, value, bound, limit))
+    return violations
+
+
+def run_suite(products=2000, collections=10, page_size=250, shopify_latency_ms=5.0, gemini_latency_ms=50.0,
+              gemini_jitter_ms=10.0, chat_requests=300, concurrency=16, users=50, seed=0):
+    data = synthetic_shop(products=products, collections=collections, seed=seed, description_words=40)
+    result = {'config': {'products': products, 'collections': collections, 'page_size': page_size,
+                         'shopify_latency_ms': shopify_latency_ms, 'gemini_latency_ms': gemini_latency_ms,
+                         'chat_requests': chat_requests, 'concurrency': concurrency, 'users': users, 'seed': seed}}
+    with StubShopifyServer(data, page_size=page_size, latency_ms=shopify_latency_ms, seed=seed) as shopify, \
+            StubGeminiServer(latency_ms=gemini_latency_ms, jitter_ms=gemini_jitter_ms, seed=seed) as gemini, \
+            tempfile.TemporaryDirectory(prefix='perf_regression_') as workdir:
+        port = _free_port()
+        env = dict(os.environ, SHOPIFY_BASE_URL=shopify.base_url, SHOPIFY_API_KEY='stub', SHOP_NAME='stub-store',
+                   SCRAPE_STATE_FILE=os.path.join(workdir, 'scrape_state.jsonl'), DATA_DIR=workdir,
+                   GEMINI_API_KEY='stub', GEMINI_API_URL=gemini.url, PORT=str(port), WEB_CONCURRENCY='1',
+                   TENANTS_FILE=os.path.join(workdir, 'tenants.json'), TENANTS_DIR=os.path.join(workdir, 'tenants'),
+                   SERVER_TIMING='1', LOG_LEVEL='WARNING', PYTHONUNBUFFERED='1')
+
+        result['scrape'] = run_scrape(workdir, env)
+        if result['scrape']['exit_code'] != 0:
+            return result
+        result['scrape_resume'] = run_scrape_resume(data, workdir, env, shopify.stats()['served'],
+                                                    page_size=page_size, latency_ms=shopify_latency_ms, seed=seed)
+        result['cli'] = run_cli(env)
+
+        proc, startup_s = start_server(env, port)
+        base_url = f"http://127.0.0.1:{port}"
+        try:
+            result['startup'] = {'ready_s': startup_s}
+            result['browse'] = run_browse(base_url)
+            result['chat'] = run_replay(chat_corpus(data, seed=seed), total_requests=chat_requests,
+                                        concurrency=concurrency, users=users, mode='http', base_url=base_url,
+                                        seed=seed)
+        finally:
+            stop_server(proc)
+        result['stubs'] = {'shopify': shopify.stats(), 'gemini': gemini.stats()}
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='End-to-end scraper + chat regression suite on local stubs.')
+    parser.add_argument('--products', type=int, default=2000)
+    parser.add_argument('--collections', type=int, default=10)
+    parser.add_argument('--page-size', type=int, default=250, help='Stub Shopify page size')
+    parser.add_argument('--shopify-latency-ms', type=float, default=5.0)
+    parser.add_argument('--gemini-latency-ms', type=float, default=50.0)
+    parser.add_argument('--gemini-jitter-ms', type=float, default=10.0)
+    parser.add_argument('--requests', type=int, default=300)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--thresholds', default=THRESHOLDS_FILE)
+    parser.add_argument('--output', default=None)
+    args = parser.parse_args(argv)
+
+    result = run_suite(products=args.products, collections=args.collections, page_size=args.page_size,
+                       shopify_latency_ms=args.shopify_latency_ms, gemini_latency_ms=args.gemini_latency_ms,
+                       gemini_jitter_ms=args.gemini_jitter_ms, chat_requests=args.requests,
+                       concurrency=args.concurrency, users=args.users, seed=args.seed)
+    with open(args.thresholds, 'r') as f:
+        thresholds = json.load(f)
+    violations = check_thresholds(result, thresholds)
+    result['thresholds'] = args.thresholds
+    result['violations'] = [{'metric': m, 'value': v, bound: limit} for m, v, bound, limit in violations]
+    result['timestamp'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+
+    path = args.output
+    if path is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        path = os.path.join(RESULTS_DIR, f"perf-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    with open(path, 'w') as f:
+        json.dump(result, f, indent=2)
+
+    scrape = result['scrape']
+    print(f"scrape: {scrape['products']} products in {scrape['duration_s']:.2f}s "
+          f"({scrape['products_per_s']:.0f}/s, exit {scrape['exit_code']})")
+    if scrape['exit_code']:
+        print(scrape['output_tail'])
+    if 'scrape_resume' in result:
+        resume = result['scrape_resume']
+        print(f"scrape resume: {resume['products']} products after an outage, {resume['requests']} requests "
+              f"({resume['requests_saved']:.0%} saved), exit {resume['interrupted_exit_code']} then {resume['exit_code']}")
+        if resume['exit_code']:
+            print(resume['output_tail'])
+    if 'cli' in result:
+        print(f"cli: first prompt in {result['cli']['startup_s']:.2f}s, "
+              f"first answer in {result['cli']['first_turn_s']:.2f}s")
+    if 'startup' in result:
+        print(f"server ready in {result['startup']['ready_s']:.2f}s")
+        browse = result['browse']
+        print(f"browse: {browse['pages']} pages, p50={browse['latency_ms_p50']:.1f}ms max={browse['latency_ms_max']:.1f}ms")
+        chat = result['chat']
+        lat = chat['latency_ms']
+        print(f"chat: {chat['rps']:.1f} req/s, p50={lat['p50']:.1f} p95={lat['p95']:.1f} p99={lat['p99']:.1f}ms, "
+              f"error_rate={chat['error_rate']:.2%}")
+    print(f"Saved results to {path}")
+    for v in result['violations']:
+        bound = 'min' if 'min' in v else 'max'
+        print(f"REGRESSION {v['metric']} = {v['value']} ({bound} {v[bound]})")
+    if violations:
+        sys.exit(1)
+    print("All thresholds met.")
+    return result
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+"""Speculative answers for likely follow-up questions.
+
+After a bot answer names products, the next turn is very often "what
+colors does it come in?", "is it on sale?" or "link please". When
+enabled, a background worker precomputes the local answers to those
+follow-ups for the conversation's focus products (and, with Gemini
+prefetch on, the Gemini answers to the canonical question) while the user
+reads. If the next message classifies as one of those intents, it is
+answered from the prefetched entry without the regular pipeline.
+
+Entries live on the `Conversation` and are only valid for the very next
+user message against the same catalog version. Speculative Gemini calls
+are capped (`gemini_max_inflight`) and skipped while the admission gate is
+busy, so they never compete with real traffic. Metrics report lookups by
+outcome plus the answers and seconds of work that went unused.
+"""
+import contextvars
+import logging
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+log = logging.getLogger(__name__)
+
+_REFERENCE = re.compile(r"\b(it|this|that|these|those|them|they|one|ones)\b")
+
+# intent -> (pattern, canonical question sent to Gemini when prefetching)
+FOLLOW_UP_INTENTS = {
+    'colors': (re.compile(r"\b(colou?rs?|shades?)\b"), "What colors does it come in?"),
+    'sale': (re.compile(r"\b(on sale|sale|discount(ed)?|deals?|offers?|cheaper|reduced)\b"), "Is it on sale?"),
+    'link': (re.compile(r"\b(link|url|buy|purchase)\b"), "Can I get the link to buy it?"),
+}
+
+
+def classify_follow_up(query):
+    """The follow-up intent of `query`, or None unless it is a short or
+    pronoun-style question matching exactly one intent."""
+    q = (query or '').lower()
+    if not (_REFERENCE.search(q) or len(q.split()) <= 3):
+        return None
+    hits = [intent for intent, (pattern, _) in FOLLOW_UP_INTENTS.items() if pattern.search(q)]
+    return hits[0] if len(hits) == 1 else None
+
+
+class PrefetchEntry:
+    __slots__ = ('conversation_version', 'catalog_version', 'answers', 'costs')
+
+    def __init__(self, conversation_version, catalog_version):
+        self.conversation_version = conversation_version
+        self.catalog_version = catalog_version
+        self.answers = {}  # intent -> (answer, kind)
+        self.costs = {}    # intent -> seconds spent
+
+
+class Prefetcher:
+    """Runs speculative follow-up answers on a small worker pool.
+
+    `local_fn(intent, focus_products)` returns the local answer;
+    `gemini_fn(question, conversation, products)` the Gemini answer (or a
+    false value); `gemini_ready()` says whether Gemini has spare capacity.
+    """
+
+    def __init__(self, local_fn, gemini_fn=None, gemini_ready=None, max_products=3, budget_ms=50.0,
+                 gemini_max_inflight=2, workers=2):
+        self._local_fn = local_fn
+        self._gemini_fn = gemini_fn
+        self._gemini_ready = gemini_ready or (lambda: True)
+        self.max_products = max_products
+        self.budget = budget_ms / 1000.0
+        self._gemini_slots = threading.BoundedSemaphore(gemini_max_inflight)
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='prefetch')
+
+    def schedule(self, conversation, products, catalog_version):
+        """Prefetch follow-ups for the conversation's current state in the background."""
+        self._discard(conversation, 'replaced')
+        # Run in a copy of this context so the current shop carries over
+        self._pool.submit(contextvars.copy_context().run, self._run, conversation, products, catalog_version,
+                          conversation.version)
+
+    def _run(self, conversation, products, catalog_version, conversation_version):
+        try:
+            # Also warms the focus cache the next turn would compute anyway
+            focus = conversation.focus_products(products)[:self.max_products]
+            if not focus or conversation.version != conversation_version:
+                return
+            entry = PrefetchEntry(conversation_version, catalog_version)
+            started = time.perf_counter()
+            for intent in FOLLOW_UP_INTENTS:
+                if time.perf_counter() - started > self.budget:
+                    metrics.inc('prefetch_budget_exhausted_total')
+                    break
+                self._compute(entry, intent, 'local', lambda: self._local_fn(intent, focus))
+            if self._gemini_fn is not None:
+                for intent, (_, question) in FOLLOW_UP_INTENTS.items():
+                    if conversation.version != conversation_version or not self._gemini_ready():
+                        break
+                    if not self._gemini_slots.acquire(blocking=False):
+                        break
+                    try:
+                        self._compute(entry, intent, 'gemini',
+                                      lambda: self._gemini_fn(question, conversation, products))
+                    finally:
+                        self._gemini_slots.release()
+            if conversation.version == conversation_version:
+                conversation.prefetch = entry
+            else:
+                self._waste(entry, 'late')
+        except Exception:
+            log.exception('prefetch_failed')
+
+    def _compute(self, entry, intent, kind, fn):
+        start = time.perf_counter()
+        answer = fn()
+        elapsed = time.perf_counter() - start
+        entry.costs[intent] = entry.costs.get(intent, 0.0) + elapsed
+        metrics.inc('prefetch_work_seconds_total', elapsed, kind=kind)
+        if answer:
+            # A Gemini answer supersedes the local one for the same intent
+            entry.answers[intent] = (answer, kind)
+            metrics.inc('prefetch_answers_total', intent=intent, kind=kind)
+
+    def lookup(self, conversation, query, catalog_version):
+        """Prefetched answer for `query` (the message just added), or None.
+        The entry is consumed either way."""
+        entry = getattr(conversation, 'prefetch', None)
+        if entry is None:
+            metrics.inc('prefetch_lookups_total', outcome='none')
+            return None
+        conversation.prefetch = None
+        if (entry.catalog_version != catalog_version
+                or conversation.version != entry.conversation_version + 1):
+            metrics.inc('prefetch_lookups_total', outcome='stale')
+            self._waste(entry, 'stale')
+            return None
+        intent = classify_follow_up(query)
+        hit = entry.answers.pop(intent, None) if intent else None
+        entry.costs.pop(intent, None)
+        self._waste(entry, 'unused')
+        if hit is None:
+            metrics.inc('prefetch_lookups_total', outcome='miss')
+            return None
+        metrics.inc('prefetch_lookups_total', outcome='hit')
+        metrics.inc('prefetch_hits_total', intent=intent, kind=hit[1])
+        return hit[0]
+
+    def _discard(self, conversation, reason):
+        entry = getattr(conversation, 'prefetch', None)
+        if entry is not None:
+            conversation.prefetch = None
+            self._waste(entry, reason)
+
+    def _waste(self, entry, reason):
+        for intent, (_, kind) in entry.answers.items():
+            metrics.inc('prefetch_wasted_total', intent=intent, kind=kind, reason=reason)
+        wasted = sum(entry.costs.values())
+        if wasted:
+            metrics.inc('prefetch_wasted_seconds_total', wasted)
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+metrics.describe('prefetch_lookups_total', 'counter', 'Follow-up turns checked against the prefetch cache, by outcome.')
+metrics.describe('prefetch_hits_total', 'counter', 'Follow-up turns answered from the prefetch cache.')
+metrics.describe('prefetch_answers_total', 'counter', 'Speculative follow-up answers computed.')
+metrics.describe('prefetch_wasted_total', 'counter', 'Speculative answers discarded without being served.')
+metrics.describe('prefetch_work_seconds_total', 'counter', 'Seconds spent computing speculative answers.')
+metrics.describe('prefetch_wasted_seconds_total', 'counter', 'Seconds of speculative work that went unused.')
+metrics.describe('prefetch_budget_exhausted_total', 'counter', 'Prefetch runs cut short by the local work budget.')
@@ -0,0 +1,236 @@
+"""Opt-in profiling of individual /chat requests.
+
+A request is profiled when it carries `X-Profile: <PROFILE_TOKEN>`, when
+PROFILE_ALL=1, or at random with probability PROFILE_SAMPLE_RATE. The
+whole handler is captured with cProfile (PROFILE_MODE=cprofile) or a
+low-overhead stack sampler (PROFILE_MODE=sample), and written to
+PROFILE_DIR with a JSON sidecar holding the query, user_id, shop and
+catalog version. Only the newest PROFILE_KEEP captures are kept.
+
+Aggregate captures offline:
+    python profiling.py top [-n 25] [--sort tottime|cumulative] [--dir profiles] [--match TEXT]
+"""
+import argparse
+import cProfile
+import hmac
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+
+import metrics
+
+log = logging.getLogger(__name__)
+
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), 'profiles'))
+PROFILE_MODE = os.getenv("PROFILE_MODE", "cprofile")
+# Requests sending this value in X-Profile are profiled; the header is ignored while unset
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN", "")
+PROFILE_ALL = os.getenv("PROFILE_ALL", "0") == "1"
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "200"))
+PROFILE_SAMPLE_INTERVAL_MS = float(os.getenv("PROFILE_SAMPLE_INTERVAL_MS", "5"))
+
+PROFILE_HEADER = 'X-Profile'
+
+# cProfile installs a per-thread hook, so only one capture per thread at a time
+_active = threading.local()
+
+
+def should_profile(header_value=None):
+    if PROFILE_TOKEN and header_value and hmac.compare_digest(header_value, PROFILE_TOKEN):
+        return True
+    if PROFILE_ALL:
+        return True
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+
+class StackSampler:
+    """Samples one thread's Python stack on a timer; stacks are counted in
+    collapsed (flame graph) form, root first, frames joined by ';'."""
+
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if names:
+                self.stacks[';'.join(reversed(names))] += 1
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+class Capture:
+    """One in-progress request profile. Call `finish()` from the thread that started it."""
+
+    def __init__(self, mode=None):
+        self.mode = mode or PROFILE_MODE
+        self.started_at = time.time()
+        self.id = (f"{time.strftime('%Y%m%d-%H%M%S', time.localtime(self.started_at))}"
+                   f"{int(self.started_at * 1000) % 1000:03d}-{uuid.uuid4().hex[:8]}")
+        self._start = time.perf_counter()
+        if self.mode == 'sample':
+            self._profiler = StackSampler(threading.get_ident(), PROFILE_SAMPLE_INTERVAL_MS / 1000.0).start()
+        else:
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+
+    def finish(self, **meta):
+        """Stop profiling and write the capture plus its metadata; returns the profile path."""
+        duration = time.perf_counter() - self._start
+        if self.mode == 'sample':
+            self._profiler.stop()
+        else:
+            self._profiler.disable()
+        _active.capture = None
+        try:
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            base = os.path.join(PROFILE_DIR, self.id)
+            if self.mode == 'sample':
+                path = f"{base}.stacks"
+                self._profiler.dump(path)
+            else:
+                path = f"{base}.prof"
+                self._profiler.dump_stats(path)
+            meta.update({'id': self.id, 'mode': self.mode, 'started_at': self.started_at,
+                         'duration_ms': round(duration * 1000.0, 3), 'profile': os.path.basename(path)})
+            with open(f"{base}.json", 'w') as f:
+                json.dump(meta, f, indent=2, default=str)
+            _rotate()
+            metrics.inc('profiles_captured_total', mode=self.mode)
+            return path
+        except Exception as e:
+            log.warning('profile_write_failed', extra={'profile_id': self.id, 'error': str(e)})
+            return None
+
+
+def start_capture(header_value=None):
+    """A running `Capture` if this request should be profiled, else None."""
+    if getattr(_active, 'capture', None) is not None or not should_profile(header_value):
+        return None
+    _active.capture = Capture()
+    return _active.capture
+
+
+def _rotate():
+    metas = sorted((name for name in os.listdir(PROFILE_DIR) if name.endswith('.json')),
+                   key=lambda name: os.path.getmtime(os.path.join(PROFILE_DIR, name)))
+    for name in metas[:max(0, len(metas) - PROFILE_KEEP)]:
+        stem = name[:-len('.json')]
+        for ext in ('.json', '.prof', '.stacks'):
+            try:
+                os.remove(os.path.join(PROFILE_DIR, stem + ext))
+            except FileNotFoundError:
+                pass
+
+
+def load_captures(directory=PROFILE_DIR, match=None):
+    """Metadata of the captures in `directory`, oldest first; `match` filters on the query."""
+    captures = []
+    if not os.path.isdir(directory):
+        return captures
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(directory, name), 'r') as f:
+                meta = json.load(f)
+        except Exception:
+            continue
+        if match and match.lower() not in str(meta.get('query', '')).lower():
+            continue
+        meta['path'] = os.path.join(directory, meta.get('profile', ''))
+        if os.path.exists(meta['path']):
+            captures.append(meta)
+    captures.sort(key=lambda c: c.get('started_at', 0))
+    return captures
+
+
+def aggregate_stacks(paths):
+    """(self samples, inclusive samples) per frame across collapsed-stack files."""
+    self_counts, total_counts = Counter(), Counter()
+    for path in paths:
+        with open(path, 'r') as f:
+            for line in f:
+                stack, _, count = line.rstrip('\n').rpartition(' ')
+                if not stack:
+                    continue
+                frames = stack.split(';')
+                self_counts[frames[-1]] += int(count)
+                for frame in set(frames):
+                    total_counts[frame] += int(count)
+    return self_counts, total_counts
+
+
+def top(directory=PROFILE_DIR, limit=25, sort='tottime', match=None, out=sys.stdout):
+    captures = load_captures(directory, match)
+    if not captures:
+        print(f"No profiles in {directory}", file=out)
+        return
+    durations = sorted(c.get('duration_ms', 0.0) for c in captures)
+    print(f"{len(captures)} captures, median {durations[len(durations) // 2]:.1f} ms, "
+          f"max {durations[-1]:.1f} ms", file=out)
+    slowest = max(captures, key=lambda c: c.get('duration_ms', 0.0))
+    print(f"slowest: {slowest.get('duration_ms')} ms  user={slowest.get('user_id')} "
+          f"catalog_version={slowest.get('catalog_version')}  query={slowest.get('query')!r}\n", file=out)
+
+    prof = [c['path'] for c in captures if c['path'].endswith('.prof')]
+    stacks = [c['path'] for c in captures if c['path'].endswith('.stacks')]
+    if prof:
+        import pstats
+        stats = pstats.Stats(*prof, stream=out)
+        stats.strip_dirs().sort_stats(sort).print_stats(limit)
+    if stacks:
+        self_counts, total_counts = aggregate_stacks(stacks)
+        samples = sum(self_counts.values()) or 1
+        counts = total_counts if sort == 'cumulative' else self_counts
+        print(f"{samples} samples from {len(stacks)} sampled captures", file=out)
+        print(f"{'self%':>7} {'total%':>7}  function", file=out)
+        for frame, _ in counts.most_common(limit):
+            print(f"{100.0 * self_counts[frame] / samples:7.1f} {100.0 * total_counts[frame] / samples:7.1f}  {frame}",
+                  file=out)
+
+
+metrics.describe('profiles_captured_total', 'counter', 'Request profiles written, by profiler mode.')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Aggregate captured /chat profiles")
+    parser.add_argument('command', choices=['top', 'list'])
+    parser.add_argument('--dir', default=PROFILE_DIR)
+    parser.add_argument('-n', '--limit', type=int, default=25)
+    parser.add_argument('--sort', default='tottime', choices=['tottime', 'cumulative'])
+    parser.add_argument('--match', help='Only captures whose query contains this text')
+    args = parser.parse_args()
+    if args.command == 'list':
+        for c in load_captures(args.dir, args.match):
+            print(f"{c['id']}  {c.get('duration_ms', 0):9.1f} ms  {c.get('mode'):8}  "
+                  f"v{c.get('catalog_version')}  {c.get('user_id')}: {c.get('query')!r}")
+    else:
+        top(args.dir, args.limit, args.sort, args.match)
@@ -0,0 +1,286 @@
+"""Offline replay / load-test harness for the /chat endpoint.
+
+Replays a query corpus (user turns from chat_histories/*.json plus the
+titles in requests.jsonl) against the Flask app, either in-process through
+the test client or over real HTTP, spread across many user IDs. Gemini is
+replaced by a local stub with configurable latency and failure rate.
+
+Usage:
+    python replay.py --requests 500 --concurrency 16 --users 50
+    python replay.py --mode http --base-url http://localhost:5000
+    python replay.py --compare bench_results/replay-<old>.json
+"""
+import argparse
+import glob
+import json
+import math
+import os
+import random
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from stub_servers import StubGeminiServer
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+RESULTS_DIR = os.path.join(BASE_DIR, 'bench_results')
+
+
+def load_corpus(history_dir=None, requests_file=None):
+    """Collect replayable user queries from saved chat histories and requests.jsonl."""
+    history_dir = history_dir or os.path.join(BASE_DIR, 'chat_histories')
+    requests_file = requests_file or os.path.join(BASE_DIR, 'requests.jsonl')
+    corpus = []
+    for path in sorted(glob.glob(os.path.join(history_dir, '*.json'))):
+        try:
+            with open(path, 'r') as f:
+                history = json.load(f)
+        except Exception:
+            continue
+        corpus.extend(m.get('message', '') for m in history if m.get('role') == 'user')
+    if os.path.exists(requests_file):
+        with open(requests_file, 'r') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    item = json.loads(line)
+                except Exception:
+                    continue
+                text = item.get('message') or item.get('title')
+                if text:
+                    corpus.append(text)
+    return [q for q in corpus if q and q.strip()]
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of an unsorted list (0 for empty input)."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, math.ceil(pct / 100.0 * len(ordered)) - 1))
+    return ordered[rank]
+
+
+def _summary(values):
+    return {
+        'count': len(values),
+        'mean': sum(values) / len(values) if values else 0.0,
+        'p50': percentile(values, 50),
+        'p95': percentile(values, 95),
+        'p99': percentile(values, 99),
+        'max': max(values) if values else 0.0,
+    }
+
+
+def parse_server_timing(header):
+    """Parse a Server-Timing header into {stage: duration_ms}."""
+    stages = {}
+    if not header:
+        return stages
+    for part in header.split(','):
+        fields = [f.strip() for f in part.split(';')]
+        name = fields[0]
+        for f in fields[1:]:
+            if f.startswith('dur='):
+                try:
+                    stages[name] = stages.get(name, 0.0) + float(f[4:])
+                except ValueError:
+                    pass
+    return stages
+
+
+class _TestClientTransport:
+    def __init__(self, flask_app):
+        self._app = flask_app
+        self._local = threading.local()
+
+    def post(self, path, payload):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self._app.test_client()
+        resp = client.post(path, json=payload)
+        return resp.status_code, resp.headers.get('Server-Timing')
+
+
+class _HttpTransport:
+    def __init__(self, base_url):
+        import requests
+        self._base_url = base_url.rstrip('/')
+        self._requests = requests
+        self._local = threading.local()
+
+    def post(self, path, payload):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = self._requests.Session()
+        resp = session.post(f"{self._base_url}{path}", json=payload, timeout=60)
+        return resp.status_code, resp.headers.get('Server-Timing')
+
+
+def run_replay(corpus, total_requests=200, concurrency=8, users=20, mode='client',
+               base_url=None, path='/chat', seed=0, hot_user_share=0.0):
+    """Fire `total_requests` queries from `corpus` and return a result dict.
+    `hot_user_share` routes that fraction of requests to one hot user ID."""
+    if not corpus:
+        raise ValueError('Empty replay corpus')
+    if mode == 'http':
+        transport = _HttpTransport(base_url or 'http://127.0.0.1:5000')
+    else:
+        import app as chat_app
+        transport = _TestClientTransport(chat_app.app)
+
+    rng = random.Random(seed)
+    plan = []
+    for i in range(total_requests):
+        user_id = 'default_user' if rng.random() < hot_user_share else f"replay_user_{i % users}"
+        plan.append((user_id, rng.choice(corpus)))
+    latencies, stage_samples, statuses = [], {}, {}
+    lock = threading.Lock()
+
+    def fire(item):
+        user_id, message = item
+        start = time.perf_counter()
+        try:
+            status, timing = transport.post(path, {'user_id': user_id, 'message': message})
+        except Exception:
+            status, timing = 'exception', None
+        elapsed = (time.perf_counter() - start) * 1000.0
+        with lock:
+            latencies.append(elapsed)
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+            for stage, dur in parse_server_timing(timing).items():
+                stage_samples.setdefault(stage, []).append(dur)
+
+    wall_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(fire, plan))
+    wall = time.perf_counter() - wall_start
+
+    errors = sum(n for s, n in statuses.items() if s != '200')
+    return {
+        'requests': total_requests,
+        'duration_s': wall,
+        'rps': total_requests / wall if wall else 0.0,
+        'latency_ms': _summary(latencies),
+        'error_rate': errors / total_requests,
+        'status_counts': statuses,
+        'stages_ms': {stage: _summary(v) for stage, v in sorted(stage_samples.items())},
+    }
+
+
+def compare_results(current, previous):
+    """Relative change of headline numbers between two result dicts."""
+    def rel(a, b):
+        return (a - b) / b if b else 0.0
+    return {
+        'rps': rel(current['rps'], previous['rps']),
+        'p50': rel(current['latency_ms']['p50'], previous['latency_ms']['p50']),
+        'p95': rel(current['latency_ms']['p95'], previous['latency_ms']['p95']),
+        'p99': rel(current['latency_ms']['p99'], previous['latency_ms']['p99']),
+        'error_rate': current['error_rate'] - previous['error_rate'],
+    }
+
+
+def save_results(result, path=None):
+    if path is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        path = os.path.join(RESULTS_DIR, f"replay-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    with open(path, 'w') as f:
+        json.dump(result, f, indent=2)
+    return path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay/load-test the /chat endpoint.')
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--mode', choices=['client', 'http'], default='client')
+    parser.add_argument('--base-url', default=None)
+    parser.add_argument('--gemini-latency-ms', type=float, default=50.0)
+    parser.add_argument('--gemini-jitter-ms', type=float, default=10.0)
+    parser.add_argument('--gemini-failure-rate', type=float, default=0.0)
+    parser.add_argument('--no-gemini', action='store_true', help='Run with Gemini disabled (local engine only)')
+    parser.add_argument('--hot-user-share', type=float, default=0.0,
+                        help='Fraction of requests sent as one hot user (default_user)')
+    parser.add_argument('--admission', choices=['on', 'off'], default='off',
+                        help='Admission control policy for the in-process app')
+    parser.add_argument('--user-rate', type=float, default=1.0, help='Admission: tokens/second per user')
+    parser.add_argument('--user-burst', type=float, default=10.0, help='Admission: bucket size per user')
+    parser.add_argument('--gemini-concurrency', type=int, default=16, help='Admission: concurrent Gemini calls')
+    parser.add_argument('--queue-slo-ms', type=float, default=2000.0, help='Admission: max queue wait before shedding')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None)
+    parser.add_argument('--compare', default=None, help='Previous result JSON to compare against')
+    args = parser.parse_args(argv)
+
+    corpus = load_corpus()
+    config = {k: v for k, v in vars(args).items() if k not in ('output', 'compare')}
+    config['corpus_size'] = len(corpus)
+
+    stub = None
+    history_tmp = None
+    if args.mode == 'client':
+        import app as chat_app
+        # Keep replayed turns out of the real chat_histories directory
+        history_tmp = tempfile.TemporaryDirectory(prefix='replay_histories_')
+        chat_app.tenant_registry.default.history_dir = history_tmp.name
+        # Per-stage timings come back in the Server-Timing header
+        chat_app.SERVER_TIMING = True
+        from admission import AdmissionController
+        chat_app.admission = AdmissionController(
+            enabled=args.admission == 'on', user_rate=args.user_rate, user_burst=args.user_burst,
+            max_concurrency=args.gemini_concurrency, queue_slo=args.queue_slo_ms / 1000.0)
+        metrics.reset()
+        if args.no_gemini:
+            chat_app.GEMINI_API_KEY = None
+        else:
+            stub = StubGeminiServer(latency_ms=args.gemini_latency_ms, jitter_ms=args.gemini_jitter_ms,
+                                    failure_rate=args.gemini_failure_rate, seed=args.seed).start()
+            chat_app.GEMINI_API_KEY = 'stub'
+            chat_app.GEMINI_API_URL = stub.url
+    try:
+        result = run_replay(corpus, total_requests=args.requests, concurrency=args.concurrency,
+                            users=args.users, mode=args.mode, base_url=args.base_url, seed=args.seed,
+                            hot_user_share=args.hot_user_share)
+    finally:
+        if stub:
+            stub.stop()
+        if history_tmp:
+            # Write out lazily-persisted conversations before their directory goes away
+            chat_app.conversations.clear()
+            history_tmp.cleanup()
+    result['config'] = config
+    result['gemini_stub'] = stub.stats() if stub else None
+    if args.mode == 'client':
+        result['admission'] = {
+            outcome: metrics.counter_value('admission_decisions_total', outcome=outcome)
+            for outcome in ('admitted', 'rate_limited', 'queue_slo')
+        }
+    result['timestamp'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+
+    path = save_results(result, args.output)
+    lat = result['latency_ms']
+    print(f"{result['requests']} requests in {result['duration_s']:.2f}s -> {result['rps']:.1f} req/s")
+    print(f"latency ms: p50={lat['p50']:.1f} p95={lat['p95']:.1f} p99={lat['p99']:.1f} error_rate={result['error_rate']:.2%}")
+    for stage, s in result['stages_ms'].items():
+        print(f"  {stage:<14} p50={s['p50']:.2f} p95={s['p95']:.2f} mean={s['mean']:.2f}")
+    if result.get('admission') and args.admission == 'on':
+        print("admission: " + ', '.join(f"{k}={v:g}" for k, v in result['admission'].items()))
+    print(f"Saved results to {path}")
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            previous = json.load(f)
+        delta = compare_results(result, previous)
+        print("vs {}: rps {:+.1%}, p50 {:+.1%}, p95 {:+.1%}, p99 {:+.1%}, error_rate {:+.2%}".format(
+            args.compare, delta['rps'], delta['p50'], delta['p95'], delta['p99'], delta['error_rate']))
+    return result
+
+
+if __name__ == "__main__":
+    main()
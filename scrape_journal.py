@@ -0,0 +1,148 @@
+"""Append-only journal that lets an interrupted scrape resume.
+
+Every fetched page or per-key result is appended to one JSONL state file
+(and fsynced) as it arrives:
+
+    {"resource": "products", "items": [...], "next": {"url": ..., "params": {...}}}
+    {"resource": "metafields", "key": "8882830868729", "items": [...]}
+    {"resource": "metafields", "done": true}
+
+A paged resource is complete once a page is recorded with `"next": null`;
+until then its last `next` is the `page_info` cursor to resume from. On
+load, a torn last line (crash mid-write) is truncated away. The first line
+records the store's base URL, and a journal for another store is
+discarded.
+"""
+import json
+import os
+import threading
+import time
+
+
+class ScrapeJournal:
+    """Progress of one scrape. With `path=None` nothing is persisted."""
+
+    def __init__(self, path, base_url):
+        self.path = path
+        self.base_url = base_url
+        self.resumed = False
+        self._lock = threading.Lock()
+        self._pages = {}   # resource -> [items, ...] in page order
+        self._next = {}    # resource -> {'url', 'params'} or None once complete
+        self._keyed = {}   # resource -> {key: items}
+        self._done = set()
+        self._unfinished = {}  # resource -> keys that failed this run (not persisted)
+        self._file = None
+        if path:
+            self._load()
+
+    def _load(self):
+        valid_bytes = 0
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as f:
+                lines = f.readlines()
+            for i, line in enumerate(lines):
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                if i == 0:
+                    if record.get('base_url') != self.base_url:
+                        break  # another store: start over
+                    self.resumed = True
+                else:
+                    self._apply(record)
+                valid_bytes += len(line)
+        if not self.resumed:
+            valid_bytes = 0
+            self._pages, self._next, self._keyed, self._done = {}, {}, {}, set()
+        self._file = open(self.path, 'ab')
+        self._file.truncate(valid_bytes)
+        if not self.resumed:
+            self._append({'base_url': self.base_url, 'started_at': time.time()})
+
+    def _apply(self, record):
+        name = record['resource']
+        if record.get('done'):
+            self._done.add(name)
+        elif 'key' in record:
+            self._keyed.setdefault(name, {})[record['key']] = record['items']
+        else:
+            self._pages.setdefault(name, []).append(record['items'])
+            self._next[name] = record['next']
+            if record['next'] is None:
+                self._done.add(name)
+
+    def _append(self, record):
+        if self._file is None:
+            return
+        self._file.write(json.dumps(record, separators=(',', ':')).encode('utf-8') + b'\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def _record(self, record):
+        with self._lock:
+            self._append(record)
+            self._apply(record)
+
+    # Paged resources
+
+    def cursor(self, name):
+        """The {'url', 'params'} to resume `name` from, or None to start from the first page."""
+        with self._lock:
+            return self._next.get(name)
+
+    def record_page(self, name, items, next_page):
+        self._record({'resource': name, 'items': items, 'next': next_page})
+
+    def items(self, name):
+        with self._lock:
+            return [item for page in self._pages.get(name, []) for item in page]
+
+    # Per-key resources (e.g. metafields per product)
+
+    def results(self, name):
+        """{key: items} recorded so far for `name` (keys are strings)."""
+        with self._lock:
+            return dict(self._keyed.get(name, {}))
+
+    def record_result(self, name, key, items):
+        self._record({'resource': name, 'key': str(key), 'items': items})
+
+    def mark_unfinished(self, name, keys):
+        """Keys of `name` that failed this run; a rerun fetches them again."""
+        with self._lock:
+            if keys:
+                self._unfinished[name] = sorted(str(k) for k in keys)
+            else:
+                self._unfinished.pop(name, None)
+
+    def unfinished(self):
+        """{resource: [keys]} left unfinished by this run; empty when everything was fetched."""
+        with self._lock:
+            return {name: list(keys) for name, keys in self._unfinished.items()}
+
+    def mark_done(self, name):
+        self._record({'resource': name, 'done': True})
+
+    def is_done(self, name):
+        with self._lock:
+            return name in self._done
+
+    def progress(self):
+        """{resource: items or results recorded} for logging."""
+        with self._lock:
+            counts = {name: sum(len(p) for p in pages) for name, pages in self._pages.items()}
+            counts.update({name: len(results) for name, results in self._keyed.items()})
+            return counts
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def complete(self):
+        """The scrape's outputs are written: the journal is no longer needed."""
+        self.close()
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
@@ -1,15 +1,30 @@
 import requests
 import json
+import logging
 import sys
 import os
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse, parse_qs
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from config import SHOPIFY_API_KEY, SHOP_NAME
+from compact_catalog import write_compact_catalog
+import logging_setup
+from scrape_journal import ScrapeJournal
 
 API_VERSION = "2023-01"
-BASE_URL = f"https://{SHOP_NAME}.myshopify.com/admin/api/{API_VERSION}"
+# Override to scrape another endpoint, e.g. the local stub (stub_servers.py)
+BASE_URL = os.getenv("SHOPIFY_BASE_URL") or f"https://{SHOP_NAME}.myshopify.com/admin/api/{API_VERSION}"
+# Journal of the scrape in progress (scrape_journal.py); a rerun after a failure resumes from it
+SCRAPE_STATE_FILE = os.getenv("SCRAPE_STATE_FILE", "scrape_state.jsonl")
+# Resource pipelines run in parallel, and concurrent per-product / per-rule requests within one
+SCRAPE_WORKERS = int(os.getenv("SCRAPE_WORKERS", "5"))
+SCRAPE_KEY_CONCURRENCY = int(os.getenv("SCRAPE_KEY_CONCURRENCY", "4"))
+SCRAPE_MAX_CONSECUTIVE_FAILURES = int(os.getenv("SCRAPE_MAX_CONSECUTIVE_FAILURES", "5"))
+
+log = logging.getLogger(__name__)
 
 session = requests.Session()
 session.headers.update({
@@ -24,79 +39,157 @@ def _get(url, params=None, retries=3, timeout=15):
             if resp.status_code == 429:
                 # Rate limited – backoff using Retry-After
                 retry_after = int(resp.headers.get("Retry-After", "2"))
+                log.warning('shopify_rate_limited', extra={'url': url, 'retry_after': retry_after})
                 time.sleep(retry_after)
                 continue
             resp.raise_for_status()
             return resp
         except Exception as e:
-            if attempt == retries - 1:
+            # A 4xx (no access, not found) will not change on retry
+            if attempt == retries - 1 or _client_error(e):
                 raise
+            log.warning('shopify_request_retry', extra={'url': url, 'attempt': attempt + 1, 'error': str(e)})
             time.sleep(1 + attempt)
 
+def _client_error(e):
+    """True when `e` is a 4xx answer from the store rather than an outage (5xx, connection)."""
+    resp = getattr(e, 'response', None)
+    return resp is not None and 400 <= resp.status_code < 500
+
+def _next_page(resp):
+    """{'url', 'params'} of the next page from the Link header (page_info cursor), or None."""
+    link = resp.headers.get("Link")
+    if not link or 'rel="next"' not in link:
+        return None
+    try:
+        parts = [p.strip() for p in link.split(",")]
+        next_link = next(p for p in parts if 'rel="next"' in p)
+        next_url = next_link[next_link.find("<")+1:next_link.find(">")]
+        parsed = urlparse(next_url)
+        q = parse_qs(parsed.query)
+        params = {"page_info": q.get("page_info", [None])[0]}
+        # page_info requests may only repeat limit
+        if "limit" in q:
+            params["limit"] = q["limit"][0]
+        return {"url": f"{parsed.scheme}://{parsed.netloc}{parsed.path}", "params": params}
+    except Exception:
+        return None
+
 def _iterate_pages(path, root_key, params=None):
-    params = dict(params or {})
-    url = f"{BASE_URL}/{path}.json"
-    while True:
-        resp = _get(url, params=params)
+    page = {"url": f"{BASE_URL}/{path}.json", "params": dict(params or {})}
+    while page:
+        resp = _get(page["url"], params=page["params"])
         payload = resp.json()
         items = payload.get(root_key, [])
         for item in items:
             yield item
-
         # Handle cursor pagination via Link header with page_info
-        link = resp.headers.get("Link")
-        if not link or 'rel="next"' not in link:
-            break
-        # Extract next page_info
+        page = _next_page(resp)
+
+def _journaled_pages(journal, name, path, root_key, params=None):
+    """All items of a paged resource, fetching only the pages `journal` does not have yet."""
+    if not journal.is_done(name):
+        page = journal.cursor(name) or {"url": f"{BASE_URL}/{path}.json", "params": dict(params or {})}
+        while page:
+            resp = _get(page["url"], params=page["params"])
+            next_page = _next_page(resp)
+            journal.record_page(name, resp.json().get(root_key, []), next_page)
+            page = next_page
+    return journal.items(name)
+
+def _journaled_per_key(journal, name, keys, fetch_fn):
+    """{str(key): fetch_fn(key)} for every key, fetching only the keys `journal` does not have yet.
+    A key answered with a 4xx (e.g. a product without metafield access) is recorded as
+    empty. A key that fails with a 5xx or connection error is left out, listed in
+    `journal.unfinished()` and retried by a rerun; after SCRAPE_MAX_CONSECUTIVE_FAILURES
+    of those in a row the store is assumed down and the error is raised, so a rerun
+    resumes here."""
+    results = journal.results(name)
+    if journal.is_done(name):
+        return results
+    pending = [key for key in keys if str(key) not in results]
+    state = {'failed': [], 'streak': 0, 'error': None}
+    lock = threading.Lock()
+
+    def fetch(key):
+        if state['error'] is not None:
+            return
         try:
-            parts = [p.strip() for p in link.split(",")]
-            next_link = next(p for p in parts if 'rel="next"' in p)
-            next_url = next_link[next_link.find("<")+1:next_link.find(">")]
-            parsed = urlparse(next_url)
-            q = parse_qs(parsed.query)
-            params = {"page_info": q.get("page_info", [None])[0]}
-            url = f"{parsed.scheme}://{parsed.netloc}{parsed.path}"
-        except Exception:
-            break
-
-def fetch_price_rules():
-    rules = list(_iterate_pages("price_rules", "price_rules"))
+            items = fetch_fn(key)
+        except Exception as e:
+            if not _client_error(e):
+                log.warning('scrape_item_failed', extra={'resource': name, 'key': key, 'error': str(e)})
+                with lock:
+                    state['failed'].append(key)
+                    state['streak'] += 1
+                    if state['streak'] >= SCRAPE_MAX_CONSECUTIVE_FAILURES:
+                        state['error'] = e
+                return
+            log.info('scrape_item_skipped', extra={'resource': name, 'key': key, 'error': str(e)})
+            items = []
+        with lock:
+            state['streak'] = 0
+        journal.record_result(name, key, items)
+        results[str(key)] = items
+
+    with ThreadPoolExecutor(max_workers=max(1, SCRAPE_KEY_CONCURRENCY)) as pool:
+        list(pool.map(fetch, pending))
+    if state['error'] is not None:
+        raise state['error']
+    journal.mark_unfinished(name, state['failed'])
+    if not state['failed']:
+        journal.mark_done(name)
+    return results
+
+def fetch_price_rules(journal=None):
+    journal = journal or ScrapeJournal(None, BASE_URL)
+    rules = _journaled_pages(journal, "price_rules", "price_rules", "price_rules")
+    codes = _journaled_per_key(journal, "discount_codes", [rule.get("id") for rule in rules],
+                               lambda rule_id: list(_iterate_pages(f"price_rules/{rule_id}/discount_codes",
+                                                                   "discount_codes")))
     codes_by_rule = {}
     for rule in rules:
         rule_id = rule.get("id")
-        try:
-            codes = list(_iterate_pages(f"price_rules/{rule_id}/discount_codes", "discount_codes"))
-        except Exception:
-            codes = []
-        codes_by_rule[rule_id] = [c.get("code") for c in codes]
+        codes_by_rule[rule_id] = [c.get("code") for c in codes.get(str(rule_id), [])]
     return rules, codes_by_rule
 
-def fetch_collections_map():
+def _collections_map(custom, smart, collects):
     collections = {}
     # Custom and Smart collections
-    for c in _iterate_pages("custom_collections", "custom_collections"):
+    for c in custom:
         collections[c["id"]] = {"id": c["id"], "title": c.get("title"), "type": "custom"}
-    for c in _iterate_pages("smart_collections", "smart_collections"):
+    for c in smart:
         collections[c["id"]] = {"id": c["id"], "title": c.get("title"), "type": "smart"}
     # Collects links product to collection
     product_to_collections = {}
-    for collect in _iterate_pages("collects", "collects"):
+    for collect in collects:
         pid = collect.get("product_id")
         cid = collect.get("collection_id")
         if pid and cid in collections:
             product_to_collections.setdefault(pid, []).append(collections[cid])
     return product_to_collections
 
-def fetch_inventory_levels(inventory_item_ids):
-    levels_by_item = {}
+def fetch_collections_map(journal=None):
+    journal = journal or ScrapeJournal(None, BASE_URL)
+    return _collections_map(*(_journaled_pages(journal, name, name, name)
+                              for name in ("custom_collections", "smart_collections", "collects")))
+
+def fetch_inventory_levels(inventory_item_ids, journal=None):
+    journal = journal or ScrapeJournal(None, BASE_URL)
     # Shopify supports comma-separated ids up to a limit; chunk requests
     ids = [str(iid) for iid in inventory_item_ids if iid]
     CHUNK = 40
-    for i in range(0, len(ids), CHUNK):
-        chunk = ids[i:i+CHUNK]
-        params = {"inventory_item_ids": ",".join(chunk)}
+    chunks = [ids[i:i+CHUNK] for i in range(0, len(ids), CHUNK)]
+
+    def fetch_chunk(index):
+        params = {"inventory_item_ids": ",".join(chunks[index])}
         resp = _get(f"{BASE_URL}/inventory_levels.json", params=params)
-        for lvl in resp.json().get("inventory_levels", []):
+        return resp.json().get("inventory_levels", [])
+
+    levels_by_item = {}
+    results = _journaled_per_key(journal, "inventory_levels", range(len(chunks)), fetch_chunk)
+    for index in range(len(chunks)):
+        for lvl in results.get(str(index), []):
             levels_by_item.setdefault(lvl.get("inventory_item_id"), []).append({
                 "available": lvl.get("available"),
                 "location_id": lvl.get("location_id"),
@@ -104,22 +197,25 @@ def fetch_inventory_levels(inventory_item_ids):
             })
     return levels_by_item
 
+def _metafield_entries(mfs):
+    # Map by namespace.key for convenience
+    return [{
+        "id": m.get("id"),
+        "namespace": m.get("namespace"),
+        "key": m.get("key"),
+        "value": m.get("value"),
+        "type": m.get("type"),
+    } for m in mfs]
+
 def fetch_product_metafields(product_id):
     try:
-        mfs = list(_iterate_pages(f"products/{product_id}/metafields", "metafields"))
-        # Map by namespace.key for convenience
-        return [{
-            "id": m.get("id"),
-            "namespace": m.get("namespace"),
-            "key": m.get("key"),
-            "value": m.get("value"),
-            "type": m.get("type"),
-        } for m in mfs]
+        return _metafield_entries(_iterate_pages(f"products/{product_id}/metafields", "metafields"))
     except Exception:
         return []
 
-def fetch_products_comprehensive():
-    products_raw = list(_iterate_pages("products", "products", params={"limit": 250}))
+def _fetch_products_pipeline(journal):
+    """Products, then their inventory levels and metafields."""
+    products_raw = _journaled_pages(journal, "products", "products", "products", params={"limit": 250})
 
     # Build inventory lookup (levels by inventory_item_id)
     all_inventory_item_ids = []
@@ -127,13 +223,30 @@ def fetch_products_comprehensive():
         for v in p.get("variants", []):
             if v.get("inventory_item_id"):
                 all_inventory_item_ids.append(v["inventory_item_id"])
-    levels_by_item = fetch_inventory_levels(all_inventory_item_ids) if all_inventory_item_ids else {}
+    levels_by_item = fetch_inventory_levels(all_inventory_item_ids, journal) if all_inventory_item_ids else {}
+
+    metafields = _journaled_per_key(
+        journal, "metafields", [p.get("id") for p in products_raw],
+        lambda pid: _metafield_entries(_iterate_pages(f"products/{pid}/metafields", "metafields")))
+    return products_raw, levels_by_item, metafields
+
+def fetch_products_comprehensive(journal=None):
+    """Fetch and join every resource. Independent resources run as parallel
+    pipelines; pass a `ScrapeJournal` to make the scrape resumable."""
+    journal = journal or ScrapeJournal(None, BASE_URL)
+    with ThreadPoolExecutor(max_workers=max(1, SCRAPE_WORKERS)) as pool:
+        products_job = pool.submit(_fetch_products_pipeline, journal)
+        collection_jobs = [pool.submit(_journaled_pages, journal, name, name, name)
+                           for name in ("custom_collections", "smart_collections", "collects")]
+        rules_job = pool.submit(fetch_price_rules, journal)
+    # Every pipeline has finished (and journaled what it could) before the first error is raised
+    products_raw, levels_by_item, metafields = products_job.result()
 
     # Collections map
-    product_to_collections = fetch_collections_map()
+    product_to_collections = _collections_map(*(job.result() for job in collection_jobs))
 
     # Discounts / price rules
-    price_rules, codes_by_rule = fetch_price_rules()
+    price_rules, codes_by_rule = rules_job.result()
 
     # Prepare transformed products
     products = []
@@ -204,7 +317,7 @@ def fetch_products_comprehensive():
             "images": images,
             "image": pr.get("image"),
             "collections": product_to_collections.get(pid, []),
-            "metafields": fetch_product_metafields(pid),
+            "metafields": metafields.get(str(pid), []),
             "discount_rules": applicable_rules,
         }
         products.append(product_obj)
@@ -219,12 +332,36 @@ def save_json(data, path):
         json.dump(data, f, indent=2)
 
 if __name__ == "__main__":
+    logging_setup.setup()
+    # --fresh discards the journal of an interrupted run instead of resuming it
+    if "--fresh" in sys.argv[1:] and os.path.exists(SCRAPE_STATE_FILE):
+        os.remove(SCRAPE_STATE_FILE)
+    journal = ScrapeJournal(SCRAPE_STATE_FILE, BASE_URL)
+    if journal.resumed:
+        log.info('scrape_resumed', extra={'state_file': SCRAPE_STATE_FILE, 'progress': journal.progress()})
     try:
-        result = fetch_products_comprehensive()
+        start = time.perf_counter()
+        result = fetch_products_comprehensive(journal)
+        unfinished = journal.unfinished()
+        if unfinished:
+            # Publishing now would drop data the last export had: keep the old files and the journal
+            journal.close()
+            log.error('scrape_incomplete', extra={'state_file': SCRAPE_STATE_FILE,
+                                                  'unfinished': {k: len(v) for k, v in unfinished.items()},
+                                                  'keys': {k: v[:20] for k, v in unfinished.items()}})
+            sys.exit(1)
+        log.info('scrape_fetched', extra={'products': len(result.get('products', [])),
+                                          'price_rules': result.get('price_rules_total'),
+                                          'duration_ms': round((time.perf_counter() - start) * 1000.0, 2)})
         save_json(result.get("products", []), "shopify_products.json")
-        print(f"Saved {len(result.get('products', []))} products to shopify_products.json")
+        log.info('scrape_saved', extra={'path': 'shopify_products.json'})
         # Optionally also save rules
         save_json(result, "shopify_full_export.json")
-        print("Saved full export to shopify_full_export.json")
-    except Exception as e:
-        print("Error during scraping:", e)
+        log.info('scrape_saved', extra={'path': 'shopify_full_export.json'})
+        write_compact_catalog(result.get("products", []), "shopify_catalog.bin")
+        log.info('scrape_saved', extra={'path': 'shopify_catalog.bin'})
+        journal.complete()
+    except Exception:
+        journal.close()
+        log.exception('scrape_failed', extra={'state_file': SCRAPE_STATE_FILE, 'progress': journal.progress()})
+        sys.exit(1)
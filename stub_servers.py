@@ -0,0 +1,385 @@
+"""Local stand-ins for the external services the chatbot talks to.
+
+Used by the replay/load-test harness, the end-to-end regression suite
+(perf_regression.py) and for scraper runs so they are offline and
+repeatable. Both can also run standalone:
+
+    python stub_servers.py shopify --port 8081 --products 5000
+    python stub_servers.py gemini --port 8082 --latency-ms 200
+"""
+import argparse
+import base64
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class StubGeminiServer:
+    """Minimal generateContent endpoint with tunable latency and failure rate.
+
+    Replies with a short canned answer that mentions the first product title
+    found in the prompt, so the linkify step has real work to do.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency_ms=50.0, jitter_ms=0.0,
+                 failure_rate=0.0, seed=None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.failure_rate = failure_rate
+        self._rng = random.Random(seed)
+        self._rng_lock = threading.Lock()
+        self.calls = 0
+        self.failures = 0
+        self._stats_lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1/models/gemini-2.0-flash:generateContent?key=stub"
+
+    def _make_handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                raw = self.rfile.read(length) if length else b''
+                status, payload = stub.handle(raw)
+                body = json.dumps(payload).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def handle(self, raw: bytes):
+        with self._rng_lock:
+            delay = self.latency_ms + (self._rng.uniform(-self.jitter_ms, self.jitter_ms) if self.jitter_ms else 0.0)
+            fail = self._rng.random() < self.failure_rate
+        if delay > 0:
+            time.sleep(delay / 1000.0)
+        with self._stats_lock:
+            self.calls += 1
+            if fail:
+                self.failures += 1
+        if fail:
+            return 500, {'error': {'code': 500, 'message': 'stub failure'}}
+        try:
+            prompt = json.loads(raw or b'{}')['contents'][0]['parts'][0]['text']
+        except Exception:
+            prompt = ''
+        return 200, {
+            'candidates': [{'content': {'parts': [{'text': canned_answer(prompt)}]}}]
+        }
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def stats(self):
+        with self._stats_lock:
+            return {'calls': self.calls, 'failures': self.failures}
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+_TITLE_RE = re.compile(r'"title":\s*"((?:[^"\\]|\\.)*)"')
+_PRICE_RE = re.compile(r'"price":\s*"((?:[^"\\]|\\.)*)"')
+
+
+def canned_answer(prompt: str) -> str:
+    """A plausible short reply built from the catalog context in the prompt."""
+    title = _TITLE_RE.search(prompt)
+    if not title:
+        return "I'm here to help with product details, pricing, or availability."
+    name = json.loads('"' + title.group(1) + '"')
+    price = _PRICE_RE.search(prompt, title.end())
+    price_text = ''
+    if price and price.group(1):
+        price_text = ' for ' + json.loads('"' + price.group(1) + '"')
+    return f"You might like the {name}{price_text}. Let me know if you want colors or a link!"
+
+
+def synthetic_shop(products=50, collections=5, price_rules=3, seed=0, max_variants=3, description_words=8):
+    """Raw Shopify REST resources for a made-up store (as served by `StubShopifyServer`).
+    `max_variants` and `description_words` set the size of each product."""
+    rng = random.Random(seed)
+    colors = ['Red', 'Blue', 'Black', 'White', 'Green', 'Ice', 'Sunset']
+    kinds = ['Snowboard', 'Skateboard', 'Ski Wax', 'Helmet', 'Jacket', 'Gloves']
+    data = {'products': [], 'custom_collections': [], 'smart_collections': [], 'collects': [],
+            'price_rules': [], 'discount_codes': {}, 'metafields': {}, 'inventory_levels': [],
+            'shop': {'name': 'Stub Store', 'currency': 'USD'}}
+    for c in range(collections):
+        kind = 'custom_collections' if c % 2 == 0 else 'smart_collections'
+        data[kind].append({'id': 9000 + c, 'title': f"{kinds[c % len(kinds)]}s {c}"})
+    for i in range(products):
+        pid = 1000 + i
+        kind = kinds[i % len(kinds)]
+        title = f"The {rng.choice(colors)} {kind} {i}"
+        variants = []
+        for j, color in enumerate(rng.sample(colors, rng.randint(1, min(max_variants, len(colors))))):
+            item_id = pid * 10 + j
+            price = rng.randint(10, 800)
+            variants.append({'id': pid * 100 + j, 'title': color, 'sku': f"SKU-{pid}-{j}", 'price': f"{price}.00",
+                             'compare_at_price': f"{price + 50}.00" if rng.random() < 0.2 else None,
+                             'option1': color, 'option2': None, 'option3': None, 'inventory_item_id': item_id,
+                             'inventory_policy': 'deny', 'inventory_management': 'shopify'})
+            data['inventory_levels'].append({'inventory_item_id': item_id, 'location_id': 1,
+                                             'available': rng.randint(0, 20), 'updated_at': None})
+        words = ' '.join(rng.choice(_FILLER) for _ in range(max(0, description_words - 6)))
+        data['products'].append({
+            'id': pid, 'title': title, 'handle': re.sub(r'[^a-z0-9]+', '-', title.lower()).strip('-'),
+            'body_html': f"<p>A dependable {kind.lower()} for every season.</p>" + (f"<p>{words}</p>" if words else ''),
+            'vendor': f"Vendor {i % 7}",
+            'product_type': kind.lower(), 'tags': f"{kind.lower()}, stub", 'status': 'active',
+            'options': [{'name': 'Color', 'values': [v['option1'] for v in variants]}], 'variants': variants,
+            'images': [], 'image': None,
+        })
+        if collections:
+            data['collects'].append({'id': 50000 + i, 'product_id': pid, 'collection_id': 9000 + i % collections})
+        data['metafields'][pid] = [{'id': 70000 + i, 'namespace': 'custom', 'key': 'material',
+                                    'value': rng.choice(['wood', 'carbon', 'wool']), 'type': 'single_line_text_field'}]
+    for r in range(price_rules):
+        rule_id = 8000 + r
+        data['price_rules'].append({'id': rule_id, 'title': f"SAVE{5 * (r + 1)}", 'value_type': 'percentage',
+                                    'value': f"-{5 * (r + 1)}.0", 'target_selection': 'all' if r == 0 else 'entitled',
+                                    'entitled_product_ids': [1000 + r]})
+        data['discount_codes'][rule_id] = [{'id': 80000 + r, 'code': f"SAVE{5 * (r + 1)}"}]
+    return data
+
+
+_FILLER = ['durable', 'lightweight', 'waterproof', 'classic', 'warm', 'fast', 'flexible', 'recycled',
+           'comfortable', 'all-mountain', 'park', 'powder', 'carbon', 'maple', 'everyday', 'premium']
+
+
+class StubShopifyServer:
+    """Read-only Shopify Admin REST API over `data` (see `synthetic_shop`).
+
+    Lists are paginated with `page_info` cursors in `Link` headers like the
+    real API, and carry an `ETag` (a request with a matching `If-None-Match`
+    gets a 304). Failures can be injected: `failure_rate` answers that share
+    of requests with a 503, `rate_limit_rate` with a 429, and after
+    `fail_after` successful requests every request fails until `heal()`.
+    Resources named in `forbidden` (e.g. 'metafields') answer 403, like a
+    token without that access scope.
+    """
+
+    def __init__(self, data, host='127.0.0.1', port=0, page_size=50, latency_ms=0.0, failure_rate=0.0,
+                 rate_limit_rate=0.0, fail_after=None, forbidden=(), seed=None):
+        self.data = data
+        self.forbidden = set(forbidden)
+        self.page_size = page_size
+        self.latency_ms = latency_ms
+        self.failure_rate = failure_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.fail_after = fail_after
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.failures = 0
+        self.served = 0
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/admin/api/2023-01"
+
+    def _make_handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                status, payload, headers = stub.handle(self.path, self.headers.get('If-None-Match'))
+                body = json.dumps(payload).encode('utf-8') if status != 304 else b''
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def heal(self):
+        """Stop failing after `fail_after` requests."""
+        with self._lock:
+            self.fail_after = None
+
+    def _injected_failure(self):
+        with self._lock:
+            self.calls += 1
+            if self.fail_after is not None and self.served >= self.fail_after:
+                self.failures += 1
+                return 503, {'errors': 'stub outage'}, {}
+            roll = self._rng.random()
+            if roll < self.rate_limit_rate:
+                self.failures += 1
+                return 429, {'errors': 'Exceeded 2 calls per second for api client.'}, {'Retry-After': '0'}
+            if roll < self.rate_limit_rate + self.failure_rate:
+                self.failures += 1
+                return 503, {'errors': 'stub failure'}, {}
+            self.served += 1
+            return None
+
+    def _resource(self, path, query):
+        """(root key, items or None) for an API path relative to the base URL."""
+        parts = path.strip('/').split('/')
+        if parts == ['shop']:
+            return 'shop', self.data.get('shop', {})
+        if len(parts) == 1 and parts[0] in ('products', 'custom_collections', 'smart_collections', 'collects',
+                                            'price_rules'):
+            return parts[0], self.data.get(parts[0], [])
+        if parts == ['inventory_levels']:
+            wanted = {int(i) for i in query.get('inventory_item_ids', [''])[0].split(',') if i}
+            return 'inventory_levels', [lvl for lvl in self.data.get('inventory_levels', [])
+                                        if lvl.get('inventory_item_id') in wanted]
+        if len(parts) == 3 and parts[0] == 'products' and parts[2] == 'metafields':
+            return 'metafields', self.data.get('metafields', {}).get(int(parts[1]), [])
+        if len(parts) == 3 and parts[0] == 'price_rules' and parts[2] == 'discount_codes':
+            return 'discount_codes', self.data.get('discount_codes', {}).get(int(parts[1]), [])
+        return None, None
+
+    def handle(self, raw_path, if_none_match=None):
+        """(status, payload, extra headers) for a GET request path."""
+        if self.latency_ms > 0:
+            time.sleep(self.latency_ms / 1000.0)
+        failure = self._injected_failure()
+        if failure is not None:
+            return failure
+        url = urlparse(raw_path)
+        prefix = urlparse(self.base_url).path
+        if not url.path.startswith(prefix) or not url.path.endswith('.json'):
+            return 404, {'errors': 'Not Found'}, {}
+        query = parse_qs(url.query)
+        path = url.path[len(prefix):-len('.json')]
+        try:
+            root, items = self._resource(path, query)
+        except ValueError:
+            return 400, {'errors': 'Bad Request'}, {}
+        if root is None:
+            return 404, {'errors': 'Not Found'}, {}
+        if root in self.forbidden:
+            return 403, {'errors': '[API] This action requires merchant approval for this scope.'}, {}
+        if not isinstance(items, list) or root == 'inventory_levels':
+            return 200, {root: items}, {}
+        limit = min(int(query.get('limit', [self.page_size])[0]), 250)
+        offset = 0
+        if 'page_info' in query:
+            try:
+                offset = int(base64.urlsafe_b64decode(query['page_info'][0]).decode())
+            except ValueError:
+                return 400, {'errors': 'Invalid page_info'}, {}
+        etag = self._etag(root, len(items))
+        if if_none_match and if_none_match == etag:
+            return 304, None, {'ETag': etag}
+        headers = {'ETag': etag}
+        links = []
+        page_url = f"{self.base_url}{path}.json"
+        if offset > 0:
+            token = base64.urlsafe_b64encode(str(max(0, offset - limit)).encode()).decode()
+            links.append(f'<{page_url}?limit={limit}&page_info={token}>; rel="previous"')
+        if offset + limit < len(items):
+            token = base64.urlsafe_b64encode(str(offset + limit).encode()).decode()
+            links.append(f'<{page_url}?limit={limit}&page_info={token}>; rel="next"')
+        if links:
+            headers['Link'] = ', '.join(links)
+        return 200, {root: items[offset:offset + limit]}, headers
+
+    def _etag(self, root, count):
+        # Changes whenever the resource list is replaced or resized
+        key = f"{root}:{id(self.data.get(root))}:{count}"
+        return '"' + hashlib.sha1(key.encode()).hexdigest()[:16] + '"'
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def stats(self):
+        with self._lock:
+            return {'calls': self.calls, 'failures': self.failures, 'served': self.served}
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run a local Shopify or Gemini stub until interrupted.')
+    parser.add_argument('service', choices=['shopify', 'gemini'])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--latency-ms', type=float, default=None)
+    parser.add_argument('--jitter-ms', type=float, default=0.0, help='Gemini: random +/- latency')
+    parser.add_argument('--failure-rate', type=float, default=0.0)
+    parser.add_argument('--products', type=int, default=50, help='Shopify: synthetic catalog size')
+    parser.add_argument('--collections', type=int, default=5)
+    parser.add_argument('--price-rules', type=int, default=3)
+    parser.add_argument('--max-variants', type=int, default=3)
+    parser.add_argument('--description-words', type=int, default=8)
+    parser.add_argument('--page-size', type=int, default=50)
+    parser.add_argument('--forbidden', nargs='*', default=[], help='Shopify: resources answered with 403')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    if args.service == 'shopify':
+        data = synthetic_shop(products=args.products, collections=args.collections, price_rules=args.price_rules,
+                              seed=args.seed, max_variants=args.max_variants,
+                              description_words=args.description_words)
+        stub = StubShopifyServer(data, host=args.host, port=args.port, page_size=args.page_size,
+                                 latency_ms=args.latency_ms or 0.0, failure_rate=args.failure_rate,
+                                 forbidden=args.forbidden, seed=args.seed)
+        print(f"Stub Shopify ({args.products} products) at {stub.base_url}  (SHOPIFY_BASE_URL)", flush=True)
+    else:
+        stub = StubGeminiServer(host=args.host, port=args.port,
+                                latency_ms=50.0 if args.latency_ms is None else args.latency_ms,
+                                jitter_ms=args.jitter_ms, failure_rate=args.failure_rate, seed=args.seed)
+        print(f"Stub Gemini at {stub.url}  (GEMINI_API_URL)", flush=True)
+    stub.start()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stub.stop()
+        print(json.dumps(stub.stats()))
+
+
+if __name__ == "__main__":
+    main()
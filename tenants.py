@@ -0,0 +1,263 @@
+"""Multi-store support: one process serving several Shopify shops.
+
+Each `Tenant` (keyed by its `*.myshopify.com` domain) has its own catalog
+snapshot and refresher, search caches, history directory, storefront URL,
+CORS origin and currency. The `TenantRegistry` resolves the tenant of a
+request and keeps at most `max_loaded` tenants' catalogs in memory,
+unloading the least recently used (and any idle longer than `idle_ttl`);
+an unloaded tenant is reloaded from disk on its next request. Requests
+hold their tenant with `acquire()`/`release()`, and a tenant is never
+unloaded while a request is using it.
+
+The tenant of the request being handled is held in a context variable, so
+the chat pipeline reads it via `TenantRegistry.current()` instead of
+module globals.
+"""
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextvars import ContextVar
+from urllib.parse import urlparse
+
+import metrics
+from catalog import CatalogRefresher, CatalogStore
+
+_current_tenant = ContextVar('tenant', default=None)
+
+
+def normalize_domain(value):
+    """'Shop-Name', 'https://shop-name.myshopify.com/' -> 'shop-name.myshopify.com'."""
+    value = (value or '').strip().lower()
+    if '//' in value:
+        value = urlparse(value).netloc
+    value = value.split('/')[0]
+    if value and '.' not in value:
+        value = f"{value}.myshopify.com"
+    return value
+
+
+class Tenant:
+    """One shop's configuration plus its in-memory catalog state."""
+
+    def __init__(self, domain, access_token=None, shop_url=None, allowed_origin=None, currency=None,
+                 data_dir='.', history_dir=None, api_base=None, webhook_secret=None, pinned=False):
+        self.domain = normalize_domain(domain)
+        self.shop_name = self.domain.split('.')[0]
+        self.access_token = access_token
+        # The app's client secret; Shopify signs webhook bodies with it (X-Shopify-Hmac-Sha256)
+        self.webhook_secret = webhook_secret
+        self.api_base = (api_base or f"https://{self.domain}/admin/api/2023-01").rstrip('/')
+        self.shop_url = (shop_url or f"https://{self.domain}").rstrip('/')
+        self.allowed_origin = allowed_origin or self.shop_url
+        self.currency = currency
+        self.data_dir = data_dir
+        self.history_dir = history_dir or os.path.join(data_dir, 'chat_histories')
+        self.products_file = os.path.join(data_dir, 'shopify_products.json')
+        self.full_export_file = os.path.join(data_dir, 'shopify_full_export.json')
+        self.shop_meta_file = os.path.join(data_dir, 'shopify_shop.json')
+        self.compact_catalog_file = os.path.join(data_dir, 'shopify_catalog.bin')
+        # The default tenant is never unloaded
+        self.pinned = pinned
+        self.last_used = time.monotonic()
+        self.in_use = 0  # requests holding this tenant (TenantRegistry.acquire)
+        self.store = None
+        self.refresher = None
+        self.caches = {}  # per-snapshot derived data (e.g. the batch scorer)
+
+    def qualify(self, key):
+        """Namespace a per-user key (rate limits, caches) by shop; unchanged for the pinned shop."""
+        return key if self.pinned else f"{self.domain}:{key}"
+
+    def __repr__(self):
+        return f"Tenant({self.domain!r})"
+
+
+class TenantRegistry:
+    """Known tenants by domain, with LRU unloading of idle catalogs.
+
+    `load_fn(tenant)` and `fetch_fn(current, tenant)` are the per-tenant
+    versions of the `CatalogRefresher` callbacks.
+    """
+
+    def __init__(self, default, load_fn, fetch_fn, interval=300.0, max_loaded=50, idle_ttl=1800.0):
+        self.default = default
+        self._load_fn = load_fn
+        self._fetch_fn = fetch_fn
+        self.interval = interval
+        self.max_loaded = max_loaded
+        self.idle_ttl = idle_ttl
+        self.background = False  # start refreshers for tenants as they load
+        self._lock = threading.Lock()
+        self._tenants = {}
+        self._aliases = {}         # storefront / origin host -> domain
+        self._loaded = OrderedDict()  # domain -> tenant, least recently used first
+        self.add(default)
+
+    @classmethod
+    def from_file(cls, path, default, load_fn, fetch_fn, base_dir, **kwargs):
+        """Registry with `default` plus the tenants listed in `path` (if it exists).
+
+        File format: {"tenants": [{"domain": ..., "access_token_env": ...,
+        "webhook_secret_env": ..., "shop_url": ..., "allowed_origin": ..., "currency": ...,
+        "api_base": ...}, ...]}.
+        Each tenant's data lives in `base_dir/<domain>/`.
+        """
+        registry = cls(default, load_fn, fetch_fn, **kwargs)
+        if path and os.path.exists(path):
+            with open(path, 'r') as f:
+                config = json.load(f)
+            for entry in config.get('tenants', []):
+                domain = normalize_domain(entry.get('domain'))
+                if not domain or domain == default.domain:
+                    continue
+                data_dir = os.path.join(base_dir, domain)
+                token = entry.get('access_token') or os.getenv(entry.get('access_token_env') or '')
+                secret = entry.get('webhook_secret') or os.getenv(entry.get('webhook_secret_env') or '')
+                registry.add(Tenant(domain, access_token=token, shop_url=entry.get('shop_url'),
+                                    allowed_origin=entry.get('allowed_origin'),
+                                    currency=entry.get('currency'), data_dir=data_dir,
+                                    api_base=entry.get('api_base'), webhook_secret=secret or None))
+        return registry
+
+    def add(self, tenant):
+        os.makedirs(tenant.history_dir, exist_ok=True)
+        self._reset_catalog(tenant)
+        with self._lock:
+            self._tenants[tenant.domain] = tenant
+            for url in (tenant.shop_url, tenant.allowed_origin):
+                host = urlparse(url).netloc.lower()
+                if host:
+                    self._aliases.setdefault(host, tenant.domain)
+        return tenant
+
+    def _reset_catalog(self, tenant):
+        # A fresh store/refresher pair, so a stopping refresher thread can never
+        # write into the catalog of a reloaded tenant
+        tenant.store = CatalogStore()
+        tenant.refresher = CatalogRefresher(tenant.store, lambda: self._load_fn(tenant),
+                                            lambda current: self._fetch_fn(current, tenant),
+                                            interval=self.interval)
+        tenant.caches = {}
+
+    def __len__(self):
+        return len(self._tenants)
+
+    def __iter__(self):
+        return iter(list(self._tenants.values()))
+
+    def allowed_origins(self):
+        return sorted({t.allowed_origin for t in self._tenants.values()})
+
+    def get(self, domain):
+        """Tenant for a shop domain or storefront host, or None if unknown."""
+        domain = normalize_domain(domain)
+        tenant = self._tenants.get(domain)
+        if tenant is None and domain in self._aliases:
+            tenant = self._tenants.get(self._aliases[domain])
+        return tenant
+
+    def resolve(self, shop_domain=None, shop=None, origin=None):
+        """Tenant for a request: the X-Shopify-Shop-Domain header, then a `shop`
+        field in the body, then the Origin header, else the default tenant.
+        Returns None when an explicitly named shop is unknown."""
+        for explicit in (shop_domain, shop):
+            if explicit:
+                return self.get(explicit)
+        if origin:
+            tenant = self.get(origin)
+            if tenant is not None:
+                return tenant
+        return self.default
+
+    def current(self):
+        return _current_tenant.get() or self.default
+
+    @staticmethod
+    def activate(tenant):
+        """Make `tenant` current for this context; returns a token for `deactivate()`."""
+        return _current_tenant.set(tenant)
+
+    @staticmethod
+    def deactivate(token):
+        _current_tenant.reset(token)
+
+    def acquire(self, tenant):
+        """Mark `tenant` in use by a request (until `release()`) and touch its LRU entry."""
+        with self._lock:
+            tenant.in_use += 1
+            tenant.last_used = time.monotonic()
+            if tenant.domain in self._loaded:
+                self._loaded.move_to_end(tenant.domain)
+        self._evict()
+
+    def release(self, tenant):
+        with self._lock:
+            tenant.in_use -= 1
+            tenant.last_used = time.monotonic()
+
+    def catalog(self, tenant=None):
+        """The tenant's current snapshot, loading it (and evicting others) if needed."""
+        tenant = tenant or self.current()
+        snapshot = tenant.store.get()
+        if snapshot is not None:
+            return snapshot
+        snapshot = tenant.refresher.load_initial()
+        metrics.inc('tenant_catalog_loads_total')
+        if self.background and not tenant.refresher.running:
+            tenant.refresher.start()
+        with self._lock:
+            tenant.last_used = time.monotonic()
+            self._loaded[tenant.domain] = tenant
+            self._loaded.move_to_end(tenant.domain)
+        self._evict()
+        return snapshot
+
+    def _evict(self):
+        now = time.monotonic()
+        victims = []
+        with self._lock:
+            for domain, tenant in list(self._loaded.items()):
+                over_capacity = len(self._loaded) > self.max_loaded
+                # Tenants serving a request stay loaded; the context check covers callers
+                # outside a request (background refreshes, prefetch)
+                if tenant.pinned or tenant.in_use or tenant is self.current():
+                    continue
+                if over_capacity or now - tenant.last_used > self.idle_ttl:
+                    victims.append(tenant)
+                    del self._loaded[domain]
+                else:
+                    break  # remaining tenants are more recently used
+        for tenant in victims:
+            self.unload(tenant)
+
+    def unload(self, tenant):
+        """Drop a tenant's in-memory catalog and caches; reloaded from disk on next use."""
+        refresher = tenant.refresher
+        self._reset_catalog(tenant)
+        # Signal the old refresher thread without waiting for it
+        refresher.stop(timeout=0)
+        with self._lock:
+            self._loaded.pop(tenant.domain, None)
+        metrics.inc('tenant_evictions_total')
+
+    def loaded(self):
+        with self._lock:
+            return list(self._loaded.values())
+
+    def start(self):
+        """Load the default tenant and refresh loaded tenants in the background."""
+        self.background = True
+        self.catalog(self.default)
+        self.default.refresher.start()
+        return self
+
+    def stop(self):
+        self.background = False
+        for tenant in self.loaded():
+            tenant.refresher.stop()
+
+
+metrics.describe('tenant_catalog_loads_total', 'counter', 'Tenant catalogs loaded into memory.')
+metrics.describe('tenant_evictions_total', 'counter', 'Idle tenant catalogs unloaded from memory.')
@@ -0,0 +1,39 @@
+"""FairGate slot accounting when an async waiter is cancelled."""
+import asyncio
+
+from admission import ADMITTED, FairGate
+
+
+def test_cancelled_queued_waiter_leaves_the_queue():
+    async def run():
+        gate = FairGate(limit=1, slo=5.0, initial_service_time=0.01)
+        assert await gate.acquire_async('a') == ADMITTED
+        task = asyncio.create_task(gate.acquire_async('b'))
+        await asyncio.sleep(0.01)
+        assert gate.queued == 1
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        assert gate.queued == 0
+        gate.release()
+        assert gate.in_flight == 0
+        assert await gate.acquire_async('c') == ADMITTED
+
+    asyncio.run(run())
+
+
+def test_cancelled_granted_waiter_hands_the_slot_back():
+    async def run():
+        gate = FairGate(limit=1, slo=5.0, initial_service_time=0.01)
+        assert await gate.acquire_async('a') == ADMITTED
+        task = asyncio.create_task(gate.acquire_async('b'))
+        await asyncio.sleep(0.01)
+        # Grant the slot, then cancel before the waiter gets to run
+        gate.release()
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        assert task.cancelled()
+        assert gate.in_flight == 0
+        assert gate.queued == 0
+        assert await gate.acquire_async('c') == ADMITTED
+
+    asyncio.run(run())